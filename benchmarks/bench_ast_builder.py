@@ -0,0 +1,91 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Compares the time taken and memory allocated when building a fortify
+AST directly during parsing with those when a Lark parse tree is built
+first and then transformed.
+
+Usage (with fortify installed or on PYTHONPATH):
+
+    python benchmarks/bench_ast_builder.py [--grammar FILE] SOURCE...
+
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from fortify import parser as fparser
+from fortify.ast import ASTBuilder
+
+
+def measure(function, sources, repeats):
+    """Returns the best time taken to apply `function` to each of the
+    `sources`, and the peak memory allocated while doing so.
+
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        for source in sources:
+            function(source)
+        best = min(best, time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    for source in sources:
+        result = function(source)
+        del result
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--grammar", default=fparser.GRAMMAR_FILE)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    arg_parser.add_argument("sources", nargs="+")
+    args = arg_parser.parse_args()
+
+    sources = []
+    for path in args.sources:
+        with open(path) as f:
+            sources.append(f.read())
+    tree_parser = fparser.get_parser(args.grammar)
+    inline_parser = fparser.get_parser(args.grammar,
+                                       transformer=ASTBuilder())
+    builder = ASTBuilder()
+
+    two_pass = measure(lambda s: builder.transform(tree_parser.parse(s)),
+                       sources, args.repeats)
+    inline = measure(inline_parser.parse, sources, args.repeats)
+    print("{:<24}{:>12}{:>16}".format("mode", "time (s)", "peak (KiB)"))
+    for name, (elapsed, peak) in (("parse then transform", two_pass),
+                                  ("inline transformer", inline)):
+        print("{:<24}{:>12.4f}{:>16.1f}".format(name, elapsed, peak / 1024))
+    print("time saved: {:.1%}, peak memory saved: {:.1%}".format(
+        1 - inline[0] / two_pass[0], 1 - inline[1] / two_pass[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Measures the memory used by each fortify AST node, comparing the
+`__slots__`-based node classes with equivalent dictionary-backed
+objects. If source files are given then ASTs built from them are
+measured too.
+
+Usage (with fortify installed or on PYTHONPATH):
+
+    python benchmarks/bench_ast_memory.py [--grammar FILE] [SOURCE...]
+
+"""
+
+import argparse
+import gc
+import sys
+import tracemalloc
+
+from fortify import ast
+from fortify import parser as fparser
+
+
+class DictNode(object):
+    """A node storing the same data as fortify.ast.Node, but in a
+    per-instance dictionary.
+
+    """
+
+    def __init__(self, children, line=None, column=None, start_pos=None,
+                 end_line=None, end_column=None, end_pos=None):
+        self.children = children
+        self.line = line
+        self.column = column
+        self.start_pos = start_pos
+        self.end_line = end_line
+        self.end_column = end_column
+        self.end_pos = end_pos
+
+
+def allocated(function):
+    """Returns the result of `function` and the memory it allocated."""
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def per_node(cls, count):
+    """Returns the bytes allocated per instance of `cls`. The instances
+    share a single children list and use small (cached) integers for
+    their positions, so only the nodes themselves are measured.
+
+    """
+    children = []
+    nodes, size = allocated(lambda: [cls(children, 1, 1, 0, 1, 10, 10)
+                                     for _ in range(count)])
+    return (size - sys.getsizeof(nodes)) / count
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--grammar", default=fparser.GRAMMAR_FILE)
+    arg_parser.add_argument("--count", type=int, default=100000)
+    arg_parser.add_argument("sources", nargs="*")
+    args = arg_parser.parse_args()
+
+    slotted = ast.node_class("benchmark_node")
+    print("bytes per node ({} nodes):".format(args.count))
+    print("  __slots__ node:   {:.1f}".format(per_node(slotted, args.count)))
+    print("  dictionary node:  {:.1f}".format(per_node(DictNode,
+                                                       args.count)))
+
+    if args.sources:
+        parser = fparser.get_parser(args.grammar,
+                                    transformer=ast.ASTBuilder())
+        for path in args.sources:
+            with open(path) as f:
+                source = f.read()
+            tree, size = allocated(lambda: parser.parse(source))
+            count = sum(1 for _ in tree.iter_subtrees())
+            print("{}: {} nodes, {:.1f} bytes per node including children "
+                  "and tokens".format(path, count, size / count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Measures the throughput of the fixed-form lexer, comparing the time
+taken to parse fixed-form files with that taken to parse the same code
+in free form, and the time taken to convert them to free form line by
+line with that taken using vectorised line classification.
+
+Usage (with fortify installed or on PYTHONPATH):
+
+    python benchmarks/bench_fixed_form.py [--grammar FILE] SOURCE...
+
+"""
+
+import argparse
+import gc
+import time
+
+from fortify import parser as fparser
+from fortify.lexers import FixedFormLexer
+
+
+def measure(function, sources, repeats):
+    """Returns the best time taken to apply `function` to each of the
+    `sources`.
+
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        for source in sources:
+            function(source)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--grammar", default=fparser.GRAMMAR_FILE)
+    arg_parser.add_argument("--line-length", type=int, default=72)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    arg_parser.add_argument("sources", nargs="+")
+    args = arg_parser.parse_args()
+
+    sources = []
+    for path in args.sources:
+        with open(path) as f:
+            sources.append(f.read())
+    lines = sum(source.count("\n") for source in sources)
+    parser = fparser.get_parser(args.grammar)
+    lexer = FixedFormLexer(args.line_length)
+    free_sources = [lexer.free_form(source)[0] for source in sources]
+    line_lexer = FixedFormLexer(args.line_length)
+    line_lexer.vectorize_threshold = float("inf")
+    vector_lexer = FixedFormLexer(args.line_length)
+    vector_lexer.vectorize_threshold = 0
+
+    by_line = measure(line_lexer.free_form, sources, args.repeats)
+    vectorised = measure(vector_lexer.free_form, sources, args.repeats)
+    fixed = measure(lambda s: fparser.parse(s, parser, True,
+                                            args.line_length),
+                    sources, args.repeats)
+    free = measure(parser.parse, free_sources, args.repeats)
+    print("{:<24}{:>12}{:>16}".format("stage", "time (s)", "lines/s"))
+    for name, elapsed in (("line-by-line conversion", by_line),
+                          ("vectorised conversion", vectorised),
+                          ("fixed-form parse", fixed),
+                          ("free-form parse", free)):
+        print("{:<24}{:>12.4f}{:>16.0f}".format(name, elapsed,
+                                                lines / elapsed))
+    print("fixed-form parsing takes {:.2f} times as long".format(
+        fixed / free))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Compares the time taken to parse a corpus of Fortran files using
+Lark's contextual lexer with that using
+`fortify.fortran_lexer.FortranLexer`, checking that both produce the
+same tokens.
+
+Usage (with fortify installed or on PYTHONPATH):
+
+    python benchmarks/bench_lexer.py [--grammar FILE] SOURCE...
+
+"""
+
+import argparse
+import gc
+import time
+
+from fortify import parser as fparser
+from fortify.fortran_lexer import FortranLexer
+
+
+def measure(parser, sources, repeats):
+    """Returns the best time taken by `parser` to parse all of the
+    `sources`.
+
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        for source in sources:
+            parser.parse(source)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def tokens(tree):
+    return [(token.type, token.value, token.start_pos, token.end_pos)
+            for token in tree.scan_values(lambda v: v is not None)]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--grammar", default=fparser.GRAMMAR_FILE)
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    arg_parser.add_argument("sources", nargs="+")
+    args = arg_parser.parse_args()
+
+    sources = []
+    for path in args.sources:
+        with open(path) as f:
+            sources.append(f.read())
+    lark_parser = fparser.get_parser(args.grammar, lexer="contextual")
+    fortify_parser = fparser.get_parser(args.grammar, lexer=FortranLexer)
+    for path, source in zip(args.sources, sources):
+        if tokens(lark_parser.parse(source)) != \
+           tokens(fortify_parser.parse(source)):
+            raise SystemExit("Lexers disagree on {}".format(path))
+
+    lark_time = measure(lark_parser, sources, args.repeats)
+    fortify_time = measure(fortify_parser, sources, args.repeats)
+    print("{:<24}{:>12}".format("lexer", "time (s)"))
+    for name, elapsed in (("lark contextual", lark_time),
+                          ("FortranLexer", fortify_time)):
+        print("{:<24}{:>12.4f}".format(name, elapsed))
+    print("time saved: {:.1%}".format(1 - fortify_time / lark_time))
+
+
+if __name__ == "__main__":
+    main()
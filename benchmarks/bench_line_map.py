@@ -0,0 +1,91 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Measures the time taken to build a LineMap for generated source with
+many line directives (from a string and from bytes), to map every line
+of it, one at a time with `map_line` and all at once with `map_lines`,
+and to map every line of the main file back with `generated_lines`.
+
+Usage (with fortify installed or on PYTHONPATH):
+
+    python benchmarks/bench_line_map.py [--directives N] [--lines N]
+
+"""
+
+import argparse
+import time
+
+from fortify.line_map import create_line_map
+
+
+def generate(directives, lines):
+    """Returns preprocessed source code in which each of `directives`
+    included files contributes `lines` lines.
+
+    """
+    pieces = ['# 1 "main.F90"\n']
+    for i in range(directives):
+        pieces.append('# 1 "include{}.h" 1\n'.format(i % 100))
+        pieces.append("x = 1\n" * lines)
+        pieces.append('# {} "main.F90" 2\n'.format(i + 2))
+    return "".join(pieces)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--directives", type=int, default=50000)
+    arg_parser.add_argument("--lines", type=int, default=10)
+    args = arg_parser.parse_args()
+
+    source = generate(args.directives, args.lines)
+    start = time.perf_counter()
+    line_map = create_line_map(source, "main.F90")
+    built = time.perf_counter() - start
+    encoded = source.encode()
+    start = time.perf_counter()
+    create_line_map(encoded, "main.F90")
+    built_from_bytes = time.perf_counter() - start
+    lines = range(2, source.count("\n") + 1)
+
+    start = time.perf_counter()
+    for line in lines:
+        line_map.map_line(line)
+    one_at_a_time = time.perf_counter() - start
+    start = time.perf_counter()
+    line_map.map_lines(lines)
+    all_at_once = time.perf_counter() - start
+    start = time.perf_counter()
+    for line in range(1, args.directives + 1):
+        line_map.generated_lines("main.F90", line)
+    reverse = time.perf_counter() - start
+
+    print("{} directives, {} lines".format(len(line_map), len(lines)))
+    print("{:<24}{:>12}".format("operation", "time (s)"))
+    for name, elapsed in (("create_line_map", built),
+                          ("create_line_map (bytes)", built_from_bytes),
+                          ("map_line", one_at_a_time),
+                          ("map_lines", all_at_once),
+                          ("generated_lines", reverse)):
+        print("{:<24}{:>12.4f}".format(name, elapsed))
+
+
+if __name__ == "__main__":
+    main()
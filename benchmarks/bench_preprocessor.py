@@ -0,0 +1,85 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Compares the time taken to preprocess a set of files with
+`fortify.preprocessors.Preprocessor` with that taken by running an
+external preprocessor (by default `cpp -traditional-cpp -P`) on each
+of them.
+
+Usage (with fortify installed or on PYTHONPATH):
+
+    python benchmarks/bench_preprocessor.py [-I DIR]... SOURCE...
+
+"""
+
+import argparse
+import gc
+import shlex
+import subprocess
+import time
+
+from fortify.preprocessors import Preprocessor
+
+
+def measure(function, paths, repeats):
+    """Returns the best time taken to apply `function` to each of the
+    `paths`.
+
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        for path in paths:
+            function(path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("-I", dest="include_path", action="append",
+                            default=[])
+    arg_parser.add_argument("--command", default="cpp -traditional-cpp -P")
+    arg_parser.add_argument("--repeats", type=int, default=3)
+    arg_parser.add_argument("sources", nargs="+")
+    args = arg_parser.parse_args()
+
+    preprocessor = Preprocessor(args.include_path)
+    command = shlex.split(args.command) + \
+        ["-I" + directory for directory in args.include_path]
+
+    def external(path):
+        subprocess.run(command + [path], check=True,
+                       stdout=subprocess.DEVNULL)
+
+    native = measure(preprocessor.preprocess_file, args.sources,
+                     args.repeats)
+    forked = measure(external, args.sources, args.repeats)
+    print("{:<24}{:>12}".format("preprocessor", "time (s)"))
+    for name, elapsed in (("fortify", native), (args.command, forked)):
+        print("{:<24}{:>12.4f}".format(name, elapsed))
+    print("files per second: {:.0f} (fortify), {:.0f} (external)".format(
+        len(args.sources) / native, len(args.sources) / forked))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""Fortify provides tools for parsing Fortran code and analysing the
+resulting parse tree. Its submodules are only imported when first
+accessed as attributes of the package, so that ``import fortify`` is
+cheap and programs using only some features (e.g., line mapping) do
+not pay for loading the parser.
+
+"""
+
+import importlib
+
+__version__ = "0.1.0.dev0"
+
+__all__ = ["ast", "cst", "flat_ast", "fortran_lexer", "lexers", "line_map",
+           "parser", "preprocessors"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}"
+                         .format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,30 @@
+"""Provides helpers for writing the files of fortify's caches.
+
+"""
+
+import os
+import tempfile
+
+
+def atomic_write(path, write, mode="wb"):
+    """Creates or replaces the file at `path` (and any missing
+    directories above it), calling `write` with a file object opened
+    with `mode` to write its contents. The contents are written to a
+    temporary file which is then renamed, so that other processes (even
+    those writing the same file concurrently) see either the old file
+    or the complete new one, never a partial write. Returns the size of
+    the new file.
+
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        size = os.path.getsize(tmp_name)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return size
@@ -0,0 +1,212 @@
+"""Provides classes representing the nodes of an abstract syntax tree
+(AST) for Fortran code, along with a Lark transformer which builds
+them. The transformer can be passed to the parser (see
+`fortify.parser.get_parser`) so that nodes are created directly as each
+grammar rule is reduced, without first building a Lark parse tree.
+
+Whole-project ASTs can contain tens of millions of nodes, so nodes use
+`__slots__` rather than per-instance dictionaries. There is a node
+class for each grammar rule, with properties named after the rules
+which can appear among its children.
+
+"""
+
+import lark
+
+
+_POSITION_ATTRIBUTES = ("line", "column", "start_pos", "end_line",
+                        "end_column", "end_pos")
+
+
+class Node(object):
+    """A node in a Fortran AST, corresponding to the grammar rule given
+    by the class attribute `kind`. Its `children` are other nodes or
+    Lark tokens. The position of the node in the source code is that
+    spanned by its children; it is None if none of its children have
+    positions. Instances should be created through the class returned
+    by `node_class`.
+
+    """
+
+    __slots__ = ("children",) + _POSITION_ATTRIBUTES
+    kind = None
+    fields = ()
+
+    def __init__(self, children, line=None, column=None, start_pos=None,
+                 end_line=None, end_column=None, end_pos=None):
+        self.children = children
+        self.line = line
+        self.column = column
+        self.start_pos = start_pos
+        self.end_line = end_line
+        self.end_column = end_column
+        self.end_pos = end_pos
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.kind == other.kind and \
+            self.children == other.children
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # As for Lark trees, consistent with __eq__
+        return hash((self.kind, tuple(self.children)))
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.children)
+
+    def __reduce__(self):
+        return _make_node, (self.kind, self.children,
+                            tuple(getattr(self, name)
+                                  for name in _POSITION_ATTRIBUTES))
+
+    def children_of_kind(self, kind):
+        """Returns a list of the children which are nodes of `kind`."""
+        return [child for child in self.children
+                if getattr(child, "kind", None) == kind]
+
+    def iter_subtrees(self):
+        """Iterates over this node and all nodes beneath it, in pre-order."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed([child for child in node.children
+                                   if isinstance(child, Node)]))
+
+
+_NODE_CLASSES = {}
+
+
+def _class_name(kind):
+    return "".join(part.capitalize() for part in kind.split("_"))
+
+
+def _child_field(kind):
+    def field(self):
+        for child in self.children:
+            if getattr(child, "kind", None) == kind:
+                return child
+        return None
+    field.__name__ = kind
+    field.__doc__ = "The first child which is a `{}` node, or None."\
+        .format(kind)
+    return property(field)
+
+
+def node_class(kind, fields=()):
+    """Returns the Node subclass for the grammar rule `kind`, creating it
+    if necessary. The class is given a property for each of the rule
+    names in `fields`, returning the first child of that kind (or None
+    if there is no such child). Fields whose names clash with existing
+    attributes are skipped.
+
+    """
+    cls = _NODE_CLASSES.get(kind)
+    if cls is None:
+        cls = type(_class_name(kind), (Node,),
+                   {"__slots__": (), "kind": kind, "fields": (),
+                    "__module__": __name__})
+        _NODE_CLASSES[kind] = cls
+    new_fields = [field for field in fields if field not in cls.fields and
+                  not hasattr(cls, field)]
+    for field in new_fields:
+        setattr(cls, field, _child_field(field))
+    if new_fields:
+        cls.fields = cls.fields + tuple(new_fields)
+    return cls
+
+
+def _make_node(kind, children, positions):
+    return node_class(kind)(children, *positions)
+
+
+def spanning_node(kind, children):
+    """Returns a node of `kind` with `children`, positioned so as to span
+    them, as built by `ASTBuilder`.
+
+    """
+    cls = _NODE_CLASSES.get(kind) or node_class(kind)
+    for child in children:
+        if getattr(child, "start_pos", None) is not None:
+            line, column, start_pos = child.line, child.column, \
+                child.start_pos
+            break
+    else:
+        return cls(children)
+    for child in reversed(children):
+        if getattr(child, "end_pos", None) is not None:
+            return cls(children, line, column, start_pos, child.end_line,
+                       child.end_column, child.end_pos)
+    return cls(children, line, column, start_pos)
+
+
+def rule_fields(rules):
+    """Takes the Lark rules of a grammar and returns a dictionary mapping
+    the kind of each node which they can produce to a tuple of the node
+    kinds which can appear among its children. Rules which are always
+    inlined (with names beginning in an underscore) are looked through,
+    and both a conditionally inlined rule (those prefixed with `?`) and
+    its possible children are included.
+
+    """
+    expansions = {}
+    expand1 = set()
+    for rule in rules:
+        expansions.setdefault(rule.origin.name, []).append(rule)
+        if rule.options.expand1:
+            expand1.add(rule.origin.name)
+
+    def child_kinds(names, seen):
+        kinds = []
+        for name in names:
+            if name in seen:
+                continue
+            seen.add(name)
+            if not name.startswith("_"):
+                kinds.append(name)
+            if name.startswith("_") or name in expand1:
+                for rule in expansions.get(name, ()):
+                    if rule.alias and not name.startswith("_"):
+                        kinds.append(rule.alias)
+                    kinds.extend(child_kinds(
+                        [symbol.name for symbol in rule.expansion
+                         if not symbol.is_term], seen))
+        return kinds
+
+    fields = {}
+    for name, name_rules in expansions.items():
+        for rule in name_rules:
+            kind = rule.alias or name
+            if kind.startswith("_"):
+                continue
+            children = child_kinds([symbol.name for symbol in rule.expansion
+                                    if not symbol.is_term], set())
+            existing = fields.setdefault(kind, [])
+            existing.extend(child for child in children
+                            if child not in existing)
+    return {kind: tuple(children) for kind, children in fields.items()}
+
+
+class ASTBuilder(lark.Transformer):
+    """A Lark transformer which converts each reduced grammar rule into
+    a Node. It can either be passed as the `transformer` option when
+    creating a LALR parser, in which case nodes are built during
+    parsing, or be applied to an existing parse tree with `transform`.
+    Calling `register_rules` with the parser's rules gives the node
+    classes their named fields; `fortify.parser.get_parser` does this
+    automatically.
+
+    """
+
+    def register_rules(self, rules):
+        """Creates the node classes for the grammar with the given Lark
+        rules.
+
+        """
+        for kind, fields in rule_fields(rules).items():
+            node_class(kind, fields)
+
+    def __default__(self, data, children, meta):
+        return spanning_node(data, children)
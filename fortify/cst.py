@@ -0,0 +1,301 @@
+"""Provides a lossless concrete syntax tree (CST) for Fortran code,
+suitable for refactoring tools which must write back the files they
+edit. The parser discards whitespace, comments and continuation
+markers, so here they are recovered as "trivia" from the gaps between
+tokens. Each node records its extent as offsets into the original
+source (which is shared, not copied), so printing a tree reproduces
+that source exactly. A subtree can be replaced by new code, after which
+printing the tree reproduces the original everywhere else, without
+re-lexing or re-parsing.
+
+"""
+
+from .parser import get_parser, parse
+
+
+class CSTNode(object):
+    """A node in a concrete syntax tree: either a token (whose
+    `children` is None and which holds the parsed `value`) or a node of
+    the grammar rule `kind`. The text of the node is `source[start:end]`.
+    It is preceded by its leading trivia, starting at `leading`, and
+    followed by its trailing trivia, ending at `trailing`. A token's
+    trailing trivia runs up to and including the end of its line (so a
+    token ending a line has none); all other trivia before the next
+    token leads that token. The leading trivia of the first token starts
+    at the beginning of the source and the trailing trivia of the last
+    runs to its end, so the extents of the tokens, with their trivia,
+    cover the source without overlap, and the extent of a node is that
+    of its tokens. The offsets of a node with no tokens are None.
+
+    Offsets always refer to `source`. Replacing a subtree (see
+    `replace`) gives the new nodes their own source, and leaves the
+    offsets of all other nodes unchanged.
+
+    """
+
+    __slots__ = ("kind", "children", "value", "parent", "source", "leading",
+                 "start", "end", "trailing", "_edited")
+
+    def __init__(self, kind, children, source, value=None, leading=None,
+                 start=None, end=None, trailing=None):
+        self.kind = kind
+        self.children = children
+        self.value = value
+        self.parent = None
+        self.source = source
+        self.leading = leading
+        self.start = start
+        self.end = end
+        self.trailing = trailing
+        # Whether any descendant has been replaced, so that the node must
+        # be printed from its children rather than from `source`
+        self._edited = False
+
+    def __repr__(self):
+        if self.is_token:
+            return "CSTNode({!r}, {!r})".format(self.kind, self.value)
+        return "CSTNode({!r}, {!r})".format(self.kind, self.children)
+
+    def __str__(self):
+        """Returns the text of the node, including its trivia."""
+        pieces = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._edited:
+                stack.extend(reversed(node.children))
+            elif node.leading is not None:
+                pieces.append(node.source[node.leading:node.trailing])
+        return "".join(pieces)
+
+    @property
+    def is_token(self):
+        return self.children is None
+
+    @property
+    def text(self):
+        """The text of the node, excluding its leading and trailing
+        trivia.
+
+        """
+        text = str(self)
+        return text[len(self.leading_trivia):len(text) -
+                    len(self.trailing_trivia)]
+
+    @property
+    def leading_trivia(self):
+        node = self._first_token()
+        if node is None:
+            return ""
+        return node.source[node.leading:node.start]
+
+    @property
+    def trailing_trivia(self):
+        node = self._last_token()
+        if node is None:
+            return ""
+        return node.source[node.end:node.trailing]
+
+    def _first_token(self):
+        node = self
+        while not node.is_token:
+            node = next((child for child in node.children
+                         if child.leading is not None), None)
+            if node is None:
+                return None
+        return node
+
+    def _last_token(self):
+        node = self
+        while not node.is_token:
+            node = next((child for child in reversed(node.children)
+                         if child.leading is not None), None)
+            if node is None:
+                return None
+        return node
+
+    def iter_subtrees(self):
+        """Iterates over this node and all nodes (including tokens)
+        beneath it, in pre-order.
+
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            if not node.is_token:
+                stack.extend(reversed(node.children))
+
+    def find(self, kind):
+        """Returns a list of the nodes of `kind` beneath this one."""
+        return [node for node in self.iter_subtrees()
+                if node.kind == kind and node is not self]
+
+    def replace(self, replacement):
+        """Replaces this node, in its parent, by `replacement`, returning
+        the new node. This node's leading and trailing trivia are kept.
+        `replacement` may be a string, which becomes the text of a token
+        of the same `kind`, or a CSTNode (e.g., from `parse_cst`), which
+        is copied without its own leading and trailing trivia; it must
+        not itself hold replaced subtrees.
+
+        """
+        leading = self.leading_trivia
+        trailing = self.trailing_trivia
+        if isinstance(replacement, CSTNode):
+            if replacement._edited:
+                raise ValueError("cannot copy a node holding replaced "
+                                 "subtrees")
+            text = replacement.text
+        else:
+            text = replacement
+        source = leading + text + trailing
+        if isinstance(replacement, CSTNode):
+            new = _rebase(replacement, source, len(leading) -
+                          (replacement.start or 0))
+        else:
+            new = CSTNode(self.kind, None, source, replacement)
+        new.leading = 0
+        new.start = len(leading)
+        new.end = len(leading) + len(text)
+        new.trailing = len(source)
+        parent = self.parent
+        if parent is not None:
+            index = next(i for i, child in enumerate(parent.children)
+                         if child is self)
+            parent.children[index] = new
+            new.parent = parent
+            self.parent = None
+            while parent is not None and not parent._edited:
+                parent._edited = True
+                parent = parent.parent
+        return new
+
+
+def _rebase(root, source, delta):
+    """Returns a copy of the subtree `root`, in `source`, in which the
+    text of each node is found `delta` characters later than in the
+    original. The leading and trailing trivia of `root` become the start
+    and end of `source`.
+
+    """
+    copies = {}
+    for node in root.iter_subtrees():
+        children = None if node.is_token else []
+        copy = copies[id(node)] = CSTNode(node.kind, children, source,
+                                          node.value)
+        if node.leading is not None:
+            copy.leading = 0 if node.leading == root.leading else \
+                node.leading + delta
+            copy.start = node.start + delta
+            copy.end = node.end + delta
+            copy.trailing = len(source) if node.trailing == root.trailing \
+                else node.trailing + delta
+        if node is not root:
+            copy.parent = copies[id(node.parent)]
+            copy.parent.children.append(copy)
+    return copies[id(root)]
+
+
+def build_cst(tree, source):
+    """Converts a tree of Lark Trees and Tokens, or of fortify AST nodes
+    and Tokens, parsed from `source` (with positions mapped back to it,
+    as by `fortify.parser.parse`), to a CST. Any tokens which the parser
+    dropped from the tree become part of the trivia, so for the nodes to
+    span their keywords and punctuation the parser should be created
+    with `keep_all_tokens=True`.
+
+    """
+    root = None
+    tokens = []
+    stack = [(tree, None)]
+    while stack:
+        item, parent = stack.pop()
+        children = getattr(item, "children", None)
+        if children is None:
+            node = CSTNode(item.type, None, source, str(item))
+            node.start = getattr(item, "start_pos", None)
+            node.end = getattr(item, "end_pos", None)
+            tokens.append(node)
+        else:
+            kind = getattr(item, "kind", None)
+            node = CSTNode(str(item.data) if kind is None else kind, [],
+                           source)
+            stack.extend((child, node) for child in reversed(children)
+                         if child is not None)
+        if parent is None:
+            root = node
+        else:
+            node.parent = parent
+            parent.children.append(node)
+
+    # Tokens without positions, or found before the end of the token
+    # before them (e.g., newlines ending statements from whose middle
+    # comments were moved when joining lines), are taken to be empty,
+    # and placed after the token before them
+    position = 0
+    for token in tokens:
+        if token.start is None or token.end is None or \
+                token.start < position:
+            token.start = token.end = position
+        position = token.end
+    # Split the gap before each token into the trailing trivia of the
+    # token before it, up to the end of its line, and its leading trivia
+    previous = None
+    for token in tokens:
+        if previous is None:
+            split = 0
+        else:
+            if source.endswith("\n", previous.start, previous.end):
+                split = previous.end
+            else:
+                newline = source.find("\n", previous.end, token.start)
+                split = token.start if newline < 0 else newline + 1
+            previous.trailing = split
+        token.leading = split
+        previous = token
+    if previous is not None:
+        previous.trailing = len(source)
+
+    # Give each node the extent of its tokens, working up from the leaves
+    for node in reversed(list(root.iter_subtrees())):
+        if node.is_token:
+            continue
+        spanned = [child for child in node.children
+                   if child.leading is not None]
+        if spanned:
+            node.leading = spanned[0].leading
+            node.start = spanned[0].start
+            node.end = spanned[-1].end
+            node.trailing = spanned[-1].trailing
+    if root.leading is None:
+        root.leading = root.start = root.end = 0
+        root.trailing = len(source)
+    return root
+
+
+_default_parser = None
+
+
+def default_parser():
+    """Returns a parser for the default grammar which keeps all tokens,
+    as needed by `build_cst`. It is only constructed (or loaded) the
+    first time this function is called.
+
+    """
+    global _default_parser
+    if _default_parser is None:
+        _default_parser = get_parser(keep_all_tokens=True)
+    return _default_parser
+
+
+def parse_cst(source, parser=None, fixed_form=False, line_length=72):
+    """Parses the Fortran code in the string `source`, as by
+    `fortify.parser.parse`, returning the root of its CST. If `parser`
+    is given, it should keep all tokens (see `build_cst`); otherwise the
+    one returned by `default_parser` is used.
+
+    """
+    if parser is None:
+        parser = default_parser()
+    return build_cst(parse(source, parser, fixed_form, line_length), source)
@@ -0,0 +1,285 @@
+"""Provides a compact, array-based representation of a syntax tree,
+suitable for holding the trees of a whole code base at once. Nodes are
+stored in pre-order in parallel NumPy arrays, so that bulk queries
+(e.g., finding every `call_stmt` within a given module) can be
+performed with vectorised operations rather than by recursing through
+Python objects. A lightweight NodeView gives object-like access to
+individual nodes.
+
+"""
+
+import numpy as np
+
+
+class FlatTree(object):
+    """A tree stored as parallel arrays, indexed by node number. Nodes
+    are numbered in pre-order, so the descendants of node `i` are the
+    nodes numbered from `i + 1` up to (but not including)
+    `subtree_end[i]`. The arrays are:
+
+    - `kind`: index into `kinds` of the grammar rule (for nodes) or
+      terminal type (for tokens)
+    - `parent`, `first_child`, `next_sibling`: node numbers, or -1 if
+      there is no such node
+    - `subtree_end`: one past the last descendant of the node
+    - `start`, `end`: character offsets spanned in the source, or -1 if
+      unknown
+    - `string`: index into `strings` of a token's text, or -1 for nodes
+
+    Strings and kinds are interned, so each distinct value is stored
+    only once. Placeholders for absent optional children (None) are
+    omitted.
+
+    """
+
+    def __init__(self, kinds, strings, kind, parent, first_child,
+                 next_sibling, subtree_end, start, end, string):
+        self.kinds = kinds
+        self.strings = strings
+        self.kind = kind
+        self.parent = parent
+        self.first_child = first_child
+        self.next_sibling = next_sibling
+        self.subtree_end = subtree_end
+        self.start = start
+        self.end = end
+        self.string = string
+        self._kind_ids = {name: i for i, name in enumerate(kinds)}
+
+    @classmethod
+    def from_tree(cls, root):
+        """Converts a tree of Lark Trees and Tokens, or of fortify AST
+        nodes and Tokens, to a FlatTree.
+
+        """
+        return cls.from_trees([root], None)
+
+    @classmethod
+    def from_trees(cls, roots, root_kind="project"):
+        """Converts several trees into a single FlatTree. Unless
+        `root_kind` is None, they are made the children of a new root
+        node of that kind; if it is None, there must be exactly one
+        tree.
+
+        """
+        kinds = []
+        kind_ids = {}
+        strings = []
+        string_ids = {}
+        kind = []
+        parent = []
+        first_child = []
+        next_sibling = []
+        subtree_end = []
+        start = []
+        end = []
+        string = []
+
+        def add(item_kind, item_parent, item_start, item_end, item_string):
+            index = len(kind)
+            kind_id = kind_ids.get(item_kind)
+            if kind_id is None:
+                kind_id = kind_ids[item_kind] = len(kinds)
+                kinds.append(item_kind)
+            kind.append(kind_id)
+            parent.append(item_parent)
+            first_child.append(-1)
+            next_sibling.append(-1)
+            subtree_end.append(index + 1)
+            start.append(-1 if item_start is None else item_start)
+            end.append(-1 if item_end is None else item_end)
+            if item_string is None:
+                string.append(-1)
+            else:
+                string_id = string_ids.get(item_string)
+                if string_id is None:
+                    string_id = string_ids[item_string] = len(strings)
+                    strings.append(item_string)
+                string.append(string_id)
+            return index
+
+        if root_kind is None:
+            if len(roots) != 1:
+                raise ValueError("Exactly one tree is needed when no "
+                                 "root_kind is given")
+            stack = [(roots[0], -1)]
+        else:
+            add(root_kind, -1, None, None, None)
+            stack = [(root, 0) for root in reversed(roots)]
+        # Holds, for each node currently being built, its index and the
+        # index of its most recently added child.
+        open_nodes = [] if root_kind is None else [[0, -1]]
+        while stack:
+            item, item_parent = stack.pop()
+            while open_nodes and open_nodes[-1][0] != item_parent:
+                closed = open_nodes.pop()[0]
+                subtree_end[closed] = len(kind)
+            children = _children(item)
+            if children is None:
+                index = add(item.type, item_parent,
+                            getattr(item, "start_pos", None),
+                            getattr(item, "end_pos", None), str(item))
+            else:
+                item_start, item_end = _span(item)
+                index = add(_kind(item), item_parent, item_start, item_end,
+                            None)
+            if open_nodes:
+                siblings = open_nodes[-1]
+                if siblings[1] < 0:
+                    first_child[siblings[0]] = index
+                else:
+                    next_sibling[siblings[1]] = index
+                siblings[1] = index
+            if children:
+                open_nodes.append([index, -1])
+                stack.extend((child, index) for child in reversed(children)
+                             if child is not None)
+        while open_nodes:
+            subtree_end[open_nodes.pop()[0]] = len(kind)
+
+        return cls(kinds, strings, np.array(kind, dtype=np.int32),
+                   np.array(parent, dtype=np.int64),
+                   np.array(first_child, dtype=np.int64),
+                   np.array(next_sibling, dtype=np.int64),
+                   np.array(subtree_end, dtype=np.int64),
+                   np.array(start, dtype=np.int64),
+                   np.array(end, dtype=np.int64),
+                   np.array(string, dtype=np.int32))
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("node index out of range")
+        return NodeView(self, index)
+
+    @property
+    def root(self):
+        return NodeView(self, 0)
+
+    def kind_id(self, kind):
+        """Returns the integer used to represent `kind` in the `kind`
+        array, or -1 if no nodes are of that kind.
+
+        """
+        return self._kind_ids.get(kind, -1)
+
+    def mask(self, kind):
+        """Returns a boolean array which is True for the nodes of `kind`."""
+        return self.kind == self.kind_id(kind)
+
+    def descendants(self, index):
+        """Returns a slice selecting the descendants of node `index` from
+        any of the arrays.
+
+        """
+        return slice(index + 1, int(self.subtree_end[index]))
+
+    def find(self, kind, within=None):
+        """Returns an array of the indices of the nodes of `kind`. If
+        `within` is given, only descendants of the node with that index
+        are included.
+
+        """
+        kind_id = self.kind_id(kind)
+        if within is None:
+            return np.flatnonzero(self.kind == kind_id)
+        region = self.descendants(within)
+        return np.flatnonzero(self.kind[region] == kind_id) + region.start
+
+    def children(self, index):
+        """Returns a list of the indices of the children of node `index`."""
+        result = []
+        child = int(self.first_child[index])
+        while child >= 0:
+            result.append(child)
+            child = int(self.next_sibling[child])
+        return result
+
+
+def _children(item):
+    """Returns the children of a Lark Tree or fortify node, or None if
+    `item` is a token.
+
+    """
+    return getattr(item, "children", None)
+
+
+def _kind(item):
+    kind = getattr(item, "kind", None)
+    return item.data if kind is None else kind
+
+
+def _span(item):
+    if hasattr(item, "start_pos"):
+        return item.start_pos, item.end_pos
+    meta = getattr(item, "_meta", None)
+    return getattr(meta, "start_pos", None), getattr(meta, "end_pos", None)
+
+
+class NodeView(object):
+    """A view of the node numbered `index` in a FlatTree, providing
+    object-like access to its data.
+
+    """
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, NodeView) and self.tree is other.tree and \
+            self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        if self.is_token:
+            return "NodeView({}, {!r}, {!r})".format(self.index, self.kind,
+                                                     self.value)
+        return "NodeView({}, {!r})".format(self.index, self.kind)
+
+    @property
+    def kind(self):
+        return self.tree.kinds[self.tree.kind[self.index]]
+
+    @property
+    def is_token(self):
+        return self.tree.string[self.index] >= 0
+
+    @property
+    def value(self):
+        """The text of a token, or None for other nodes."""
+        string = self.tree.string[self.index]
+        return self.tree.strings[string] if string >= 0 else None
+
+    @property
+    def start(self):
+        start = int(self.tree.start[self.index])
+        return None if start < 0 else start
+
+    @property
+    def end(self):
+        end = int(self.tree.end[self.index])
+        return None if end < 0 else end
+
+    @property
+    def parent(self):
+        parent = int(self.tree.parent[self.index])
+        return None if parent < 0 else NodeView(self.tree, parent)
+
+    @property
+    def children(self):
+        return [NodeView(self.tree, child)
+                for child in self.tree.children(self.index)]
+
+    def find(self, kind):
+        """Returns views of the descendants of this node of `kind`."""
+        return [NodeView(self.tree, int(index))
+                for index in self.tree.find(kind, self.index)]
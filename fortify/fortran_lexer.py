@@ -0,0 +1,285 @@
+"""Provides a contextual lexer for Lark's LALR parser which is tuned
+for Fortran's many keywords. It is kept apart from `fortify.lexers`
+because it builds on Lark's own lexer, and so must import Lark.
+
+"""
+
+import copy
+import re
+
+from lark.exceptions import UnexpectedCharacters, UnexpectedToken
+from lark.lexer import BasicLexer, Lexer, Token
+
+
+# A generic identifier, matched in place of any keywords which look like
+# one; the name of its group can not clash with those of terminals,
+# which are upper case.
+_IDENTIFIER = re.compile(r"[A-Za-z][A-Za-z0-9_]*")
+_KEYWORD_GROUP = "keyword"
+
+
+def _terminal_order(terminal):
+    # The order in which Lark's lexer tries to match terminals
+    return (-terminal.priority, -terminal.pattern.max_width,
+            -len(terminal.pattern.value), terminal.name)
+
+
+def _has_newline(regexp):
+    # Whether a regular expression might match a newline (as in Lark)
+    return "\n" in regexp or "\\n" in regexp or "\\s" in regexp or \
+        "[^" in regexp or ("(?s" in regexp and "." in regexp)
+
+
+class _Keywords(object):
+    """A set of string terminals, looked up by the text of a token.
+    Where several would match, the one which Lark would try first is
+    returned.
+
+    """
+
+    def __init__(self, terminals, rank, ignore_case):
+        self.rank = rank
+        self.exact = {}
+        self.folded = {}
+        for terminal in terminals:
+            if ignore_case or "i" in terminal.pattern.flags:
+                self.folded.setdefault(terminal.pattern.value.lower(),
+                                       terminal.name)
+            else:
+                self.exact.setdefault(terminal.pattern.value, terminal.name)
+
+    def get(self, text):
+        exact = self.exact.get(text)
+        folded = self.folded.get(text.lower()) if self.folded else None
+        if exact is None:
+            return folded
+        if folded is None or self.rank[exact] < self.rank[folded]:
+            return exact
+        return folded
+
+
+class _StateScanner(object):
+    """Matches the terminals named in `accepts` with a single regular
+    expression. String terminals which look like identifiers (i.e.,
+    keywords) are replaced by one generic identifier, which is then
+    looked up in a dictionary. The result is the same as that of Lark's
+    lexer; in the rare cases where that can not be guaranteed,
+    `keyword` returns None and Lark's lexer must be used instead.
+
+    """
+
+    def __init__(self, lexer, accepts):
+        terminals = sorted((lexer.terminals_by_name[name] for name in accepts
+                            if name in lexer.terminals_by_name),
+                           key=_terminal_order)
+        self.terminals = terminals
+        flags = lexer.g_regex_flags
+        ignore_case = bool(flags & re.IGNORECASE)
+        rank = {terminal.name: i for i, terminal in enumerate(terminals)}
+        strings = [t for t in terminals if t.pattern.type == "str"]
+
+        # As in Lark, a token matching a regular expression is retyped if
+        # its text is that of a string terminal of the same priority,
+        # and such string terminals need not be matched themselves.
+        self.unless = {}
+        embedded = set()
+        for terminal in terminals:
+            if terminal.pattern.type != "re":
+                continue
+            pattern = re.compile(terminal.pattern.to_regexp(), flags)
+            unless = []
+            for string in strings:
+                value = string.pattern.value
+                match = pattern.match(value)
+                if string.priority == terminal.priority and match and \
+                   match.group() == value:
+                    unless.append(string)
+                    if string.pattern.flags <= terminal.pattern.flags:
+                        embedded.add(string.name)
+            if unless:
+                self.unless[terminal.name] = _Keywords(unless, rank,
+                                                       ignore_case)
+
+        # Keywords of the same priority as the first one Lark would try
+        # are matched as a generic identifier
+        keywords = [t for t in strings if t.name not in embedded and
+                    _IDENTIFIER.fullmatch(t.pattern.value)]
+        if keywords:
+            keywords = [t for t in keywords
+                        if t.priority == keywords[0].priority]
+        self.keywords = _Keywords(keywords, rank, ignore_case)
+        keyword_names = {t.name for t in keywords}
+
+        # Alternatives which Lark would try after the first keyword, but
+        # which might match before a later one
+        self.later = []
+        alternatives = []
+        for terminal in terminals:
+            if terminal.name in embedded or terminal.name in keyword_names:
+                if keywords and terminal is keywords[0]:
+                    alternatives.append("(?P<{}>{})".format(
+                        _KEYWORD_GROUP, _IDENTIFIER.pattern))
+                continue
+            regexp = terminal.pattern.to_regexp()
+            alternatives.append("(?P<{}>{})".format(terminal.name, regexp))
+            if keywords and rank[terminal.name] > rank[keywords[0].name]:
+                self.later.append((rank[terminal.name],
+                                   re.compile(regexp, flags)))
+        self.regex = re.compile("|".join(alternatives), flags)
+        self._fallback = None
+
+    def keyword(self, value, text, pos, end):
+        """Returns the type of the keyword `value`, matched as a generic
+        identifier at `pos`, or None if the token must be found by
+        Lark's lexer.
+
+        """
+        type_ = self.keywords.get(value)
+        if type_ is not None:
+            keyword_rank = self.keywords.rank[type_]
+            for rank, regex in self.later:
+                if rank > keyword_rank:
+                    break
+                if regex.match(text, pos, end):
+                    return None
+        return type_
+
+    def fallback(self, conf):
+        """Returns a Lark lexer for the same terminals."""
+        if self._fallback is None:
+            conf = copy.copy(conf)
+            conf.terminals = self.terminals
+            conf.skip_validation = True
+            self._fallback = BasicLexer(conf)
+        return self._fallback
+
+
+class FortranLexer(Lexer):
+    """A contextual lexer for use with Lark's LALR parser, selected with
+    `get_parser(lexer=FortranLexer)`. Like Lark's contextual lexer, it
+    only matches the terminals which the parser can accept in its
+    current state, but it is tuned for grammars with many
+    (case-insensitive) keywords, such as Fortran's:
+
+    - the terminals for each state are combined into a single regular
+      expression, compiled the first time the state is reached;
+    - keywords are not matched individually, but by matching an
+      identifier and looking it up in a dictionary;
+    - ignored tokens which have no callbacks are skipped without
+      creating Token objects.
+
+    The tokens produced, and any errors raised, are the same as with
+    Lark's lexer.
+
+    """
+
+    __future_interface__ = 2
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.terminals_by_name = conf.terminals_by_name
+        self.g_regex_flags = conf.g_regex_flags
+        self.ignore_types = frozenset(conf.ignore)
+        self.newline_types = frozenset(
+            t.name for t in conf.terminals
+            if _has_newline(t.pattern.to_regexp()))
+        self.callbacks = conf.callbacks
+        always_accept = conf.postlex.always_accept if conf.postlex else ()
+        self._extra = self.ignore_types | frozenset(always_accept)
+        self._scanners = {}
+        self._scanners_by_accepts = {}
+        self._root = None
+
+    def _scanner(self, parser_state):
+        if parser_state is None:
+            accepts = frozenset(self.terminals_by_name)
+        else:
+            accepts = frozenset(parser_state.parse_conf.parse_table.states[
+                parser_state.position])
+        try:
+            scanner = self._scanners_by_accepts[accepts]
+        except KeyError:
+            scanner = self._scanners_by_accepts[accepts] = \
+                _StateScanner(self, accepts | self._extra)
+        if parser_state is not None:
+            self._scanners[parser_state.position] = scanner
+        return scanner
+
+    def _root_lexer(self):
+        if self._root is None:
+            conf = copy.copy(self.conf)
+            conf.skip_validation = True
+            self._root = BasicLexer(conf)
+        return self._root
+
+    @staticmethod
+    def _token(type_, value, pos, line, column, line_ctr):
+        return Token(type_, value, pos, line, column, line_ctr.line,
+                     line_ctr.column, line_ctr.char_pos)
+
+    def lex(self, lexer_state, parser_state):
+        text = lexer_state.text.text
+        end = lexer_state.text.end
+        line_ctr = lexer_state.line_ctr
+        scanners = self._scanners
+        ignore_types = self.ignore_types
+        newline_types = self.newline_types
+        callbacks = self.callbacks
+        newline = line_ctr.newline_char
+        try:
+            while line_ctr.char_pos < end:
+                try:
+                    scanner = scanners[parser_state.position]
+                except (KeyError, AttributeError):
+                    scanner = self._scanner(parser_state)
+                pos = line_ctr.char_pos
+                match = scanner.regex.match(text, pos, end)
+                type_ = None
+                if match is not None:
+                    value = match.group()
+                    type_ = match.lastgroup
+                    if type_ == _KEYWORD_GROUP:
+                        type_ = scanner.keyword(value, text, pos, end)
+                    elif type_ in scanner.unless:
+                        type_ = scanner.unless[type_].get(value) or type_
+                if type_ is None:
+                    yield scanner.fallback(self.conf).next_token(
+                        lexer_state, parser_state)
+                    continue
+
+                line = line_ctr.line
+                column = line_ctr.column
+                if type_ in newline_types:
+                    newlines = value.count(newline)
+                    if newlines:
+                        line_ctr.line += newlines
+                        line_ctr.line_start_pos = \
+                            pos + value.rindex(newline) + 1
+                line_ctr.char_pos = pos + len(value)
+                line_ctr.column = line_ctr.char_pos - \
+                    line_ctr.line_start_pos + 1
+                if type_ in ignore_types:
+                    if type_ in callbacks:
+                        callbacks[type_](self._token(type_, value, pos, line,
+                                                     column, line_ctr))
+                    continue
+                token = self._token(type_, value, pos, line, column,
+                                    line_ctr)
+                if type_ in callbacks:
+                    token = callbacks[type_](token)
+                lexer_state.last_token = token
+                yield token
+        except EOFError:
+            pass
+        except UnexpectedCharacters as error:
+            # As in Lark's contextual lexer, report an unexpected token
+            # if the text is valid in some other context
+            last_token = lexer_state.last_token
+            try:
+                token = self._root_lexer().next_token(lexer_state,
+                                                      parser_state)
+            except UnexpectedCharacters:
+                raise error
+            raise UnexpectedToken(token, error.allowed, state=parser_state,
+                                  token_history=[last_token],
+                                  terminals_by_name=self.terminals_by_name)
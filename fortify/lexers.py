@@ -0,0 +1,925 @@
+"""Provides classes for scanning and tokenising Fortran source code
+outside of (or in cooperation with) the Lark parser. Nothing here
+imports Lark, so that parsers generated as standalone modules can be
+used without it; the contextual lexer which builds on Lark's is in
+`fortify.fortran_lexer`.
+
+"""
+
+from array import array
+import bisect
+from itertools import accumulate
+import re
+import sys
+
+
+# Pieces of a free-form line which matter when splitting it into
+# statements: character literals (possibly unterminated, when continued
+# onto the next line), comments, statement separators, continuation
+# markers, and runs of anything else.
+_LINE_PIECES = re.compile(r"""[^'"!;&]+|'(?:[^']|'')*'?|"(?:[^"]|"")*"?|"""
+                          r"""![^\r\n]*|;|&""")
+_CONTINUED_STRING = {"'": re.compile(r"[ \t]*&?(?:[^']|'')*'?"),
+                     '"': re.compile(r'[ \t]*&?(?:[^"]|"")*"?')}
+_LEADING_AMPERSAND = re.compile(r"[ \t]*&")
+_LABEL = re.compile(r"^\d{1,5}\s+")
+
+_TYPE_PREFIX = (r"(?:integer|real|complex|logical|character|double\s*precision"
+                r"|double\s*complex|type|class)\s*(?:\*\s*\d+|\*\s*\([^)]*\)|"
+                r"\((?:[^()]|\([^()]*\))*\))?")
+_PREFIX = r"(?:(?:recursive|pure|elemental|impure|non_recursive|module)\b|{})"\
+    .format(_TYPE_PREFIX)
+_PROGRAM_STMT = re.compile(r"program\s+(\w+)\s*$")
+_MODULE_STMT = re.compile(r"module\s+(?!procedure\b)(\w+)\s*$")
+_SUBMODULE_STMT = re.compile(r"submodule\s*\([^)]*\)\s*(\w+)\s*$")
+_BLOCK_DATA_STMT = re.compile(r"block\s*data(?:\s+(\w+))?\s*$")
+_SUBPROGRAM_STMT = re.compile(r"(?:{}\s*)*(function|subroutine)\s+(\w+)"
+                              .format(_PREFIX))
+_SEPARATE_MODULE_STMT = re.compile(r"module\s+procedure\s+(\w+)\s*$")
+_CONTAINS_STMT = re.compile(r"contains\s*$")
+# Derived-type definitions and interface blocks, which may hold CONTAINS
+# and MODULE PROCEDURE statements of their own
+_TYPE_DEF_STMT = re.compile(r"type\s*(?:,[^:]*)?::\s*\w+\s*$|"
+                            r"type\s+(?!is\b)\w+\s*$")
+_INTERFACE_STMT = re.compile(r"(?:abstract\s+)?interface\b")
+_END_BLOCK_STMT = re.compile(r"end\s*(type|interface)\b")
+_END_UNIT_STMT = re.compile(r"end(?:\s*(?:program|submodule|module|"
+                            r"block\s*data|function|subroutine|procedure)"
+                            r"(?:\s+\w+)?)?\s*$")
+_END_PROGRAM_STMT = re.compile(r"end(?:\s*program(?:\s+(\w+))?)?\s*$")
+
+_OPENERS = ((_PROGRAM_STMT, "main_program"), (_MODULE_STMT, "module"),
+            (_SUBMODULE_STMT, "submodule"), (_BLOCK_DATA_STMT, "block_data"))
+
+
+# Terminals in the Fortran grammar whose values are names
+NAME_TERMINALS = ("NAME", "LHS_NAME")
+
+
+class NameTable(object):
+    """Interns Fortran names, which are case-insensitive. Each distinct
+    name is represented by a single canonical (lower-case) string, so
+    that names can be compared by identity and their hashes are only
+    computed once.
+
+    An instance can be used as a Lark post-lexer, in which case the
+    `value` of each name token is replaced by the canonical name; the
+    original spelling remains available as `str(token)`.
+
+    """
+
+    always_accept = ()
+
+    def __init__(self, terminals=NAME_TERMINALS):
+        self.terminals = frozenset(terminals)
+        self._canonical = {}
+
+    def __len__(self):
+        return len(set(self._canonical.values()))
+
+    def __bool__(self):
+        # Lark only applies a post-lexer which is true
+        return True
+
+    def canonical(self, spelling):
+        """Returns the canonical string for the name `spelling`."""
+        try:
+            return self._canonical[spelling]
+        except KeyError:
+            name = self._canonical[spelling] = \
+                sys.intern(spelling.strip().lower())
+            return name
+
+    def process(self, stream):
+        """Replaces the values of name tokens in the stream of tokens
+        with their canonical names.
+
+        """
+        terminals = self.terminals
+        canonical = self._canonical
+        for token in stream:
+            if token.type in terminals:
+                try:
+                    token.value = canonical[token.value]
+                except KeyError:
+                    token.value = self.canonical(token.value)
+            yield token
+
+
+# The table used by the parser unless another is given
+NAME_TABLE = NameTable()
+
+
+class ProgramUnitSpan(object):
+    """The location of a top-level program unit within some free-form
+    Fortran source. The unit occupies the characters from offset
+    `start` up to (but not including) `end`, beginning at the given
+    (1-based) `line` and `column`. `kind` is the name of the grammar
+    rule for the unit (e.g., "module" or "subroutine_subprogram") and
+    `name` is the unit's name, if it has one. Any comments or blank
+    lines preceding a unit are included in its span. The kind of a span
+    holding no program unit (e.g., only comments, or a stray END
+    statement) is None.
+
+    """
+
+    def __init__(self, kind, name, start, end, line, column):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+        self.line = line
+        self.column = column
+
+    def __eq__(self, other):
+        return isinstance(other, ProgramUnitSpan) and \
+            self.__dict__ == other.__dict__
+
+    def __repr__(self):
+        return "ProgramUnitSpan({!r}, {!r}, {}, {}, {}, {})".format(
+            self.kind, self.name, self.start, self.end, self.line,
+            self.column)
+
+
+# The kinds of scope closed by END TYPE and END INTERFACE
+_BLOCKS = {"type": "derived_type_def", "interface": "interface_block"}
+
+
+class _Scope(object):
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.contains = False
+
+
+class ProgramUnitScanner(object):
+    """Finds the boundaries of the top-level program units in free-form
+    Fortran source without parsing it. Lines of source (including their
+    line endings) are passed to `feed` one at a time, which returns the
+    spans of any program units completed by that line; `close` must be
+    called once all lines have been fed. Character literals, comments,
+    statement separators, and line continuations are all respected, so
+    only genuine statements are examined.
+
+    """
+
+    def __init__(self):
+        self._offset = 0
+        self._line = 1
+        self._pieces = []
+        self._quote = None
+        self._continued = False
+        self._scopes = []
+        self._unit_start = (0, 1, 1)
+        self._unit_kind = None
+        self._unit_name = None
+
+    def feed(self, line):
+        """Scans one line of source, returning a list of the spans of
+        program units which it completes.
+
+        """
+        completed = []
+        pos = 0
+        end = len(line.rstrip("\r\n"))
+        if self._quote:
+            # Continue a character literal from the previous line
+            match = _CONTINUED_STRING[self._quote].match(line, 0, end)
+            text = match.group().lstrip(" \t&")
+            if text.count(self._quote) % 2 == 0 and \
+               line[:end].rstrip().endswith("&"):
+                self._advance(line)
+                return completed
+            self._pieces.append(self._quote * 2)
+            self._quote = None
+            pos = match.end()
+        elif self._continued:
+            match = _LEADING_AMPERSAND.match(line, 0, end)
+            if match:
+                pos = match.end()
+            else:
+                self._pieces.append(" ")
+        self._continued = False
+        for match in _LINE_PIECES.finditer(line, pos, end):
+            piece = match.group()
+            first = piece[0]
+            if first == "'" or first == '"':
+                if piece.count(first) % 2 == 1 and \
+                   piece.rstrip().endswith("&"):
+                    self._quote = first
+                    break
+                self._pieces.append(first * 2)
+            elif first == "!":
+                break
+            elif first == ";":
+                self._end_statement(self._offset + match.end(), line,
+                                    match.end(), completed)
+            elif first == "&":
+                self._continued = True
+                break
+            else:
+                self._pieces.append(piece)
+        if not (self._continued or self._quote):
+            self._end_statement(self._offset + len(line), line, len(line),
+                                completed)
+        self._advance(line)
+        return completed
+
+    def close(self):
+        """Indicates that all of the source has been fed to the scanner,
+        returning the span of any text remaining after the last complete
+        program unit, or None if there is no such text. The span's kind
+        is None if the remaining text contains no statements.
+
+        """
+        start, line, column = self._unit_start
+        if self._offset == start:
+            return None
+        span = ProgramUnitSpan(self._unit_kind, self._unit_name, start,
+                               self._offset, line, column)
+        self._unit_start = (self._offset, self._line, 1)
+        return span
+
+    def _advance(self, line):
+        self._offset += len(line)
+        if line.endswith(("\n", "\r")):
+            self._line += 1
+
+    def _end_statement(self, end, line, line_end, completed):
+        statement = "".join(self._pieces).strip().lower()
+        self._pieces = []
+        if not statement:
+            return
+        statement = _LABEL.sub("", statement)
+        if self._classify(statement):
+            if line_end == len(line):
+                next_start = (end, self._line + 1, 1)
+            else:
+                next_start = (end, self._line, line_end + 1)
+            start, start_line, start_column = self._unit_start
+            completed.append(ProgramUnitSpan(self._unit_kind,
+                                             self._unit_name, start, end,
+                                             start_line, start_column))
+            self._unit_start = next_start
+            self._unit_kind = None
+            self._unit_name = None
+
+    def _classify(self, statement):
+        """Updates the nesting of scopes for a statement, returning True if
+        it ends a top-level program unit.
+
+        """
+        scopes = self._scopes
+        match = _END_BLOCK_STMT.match(statement)
+        if match:
+            if scopes and scopes[-1].kind == _BLOCKS[match.group(1)]:
+                scopes.pop()
+            return False
+        if _END_UNIT_STMT.match(statement):
+            if scopes:
+                scopes.pop()
+            else:
+                # An END statement alone is an empty main program; any
+                # other END statement outside of a unit leaves the kind
+                # of its span as None
+                match = _END_PROGRAM_STMT.match(statement)
+                if match:
+                    self._unit_kind = "main_program"
+                    self._unit_name = match.group(1)
+            return not scopes
+        if _CONTAINS_STMT.match(statement):
+            if scopes:
+                scopes[-1].contains = True
+            return False
+        for regex, kind in _OPENERS:
+            match = regex.match(statement)
+            if match:
+                self._push(kind, match.group(1))
+                return False
+        match = _SUBPROGRAM_STMT.match(statement)
+        if match:
+            self._push(match.group(1) + "_subprogram", match.group(2))
+            return False
+        for regex, kind in ((_TYPE_DEF_STMT, "derived_type_def"),
+                            (_INTERFACE_STMT, "interface_block")):
+            if regex.match(statement):
+                if not scopes:
+                    self._push("main_program", None)
+                self._push(kind, None)
+                return False
+        if scopes and scopes[-1].contains:
+            match = _SEPARATE_MODULE_STMT.match(statement)
+            if match:
+                self._push("separate_module_subprogram", match.group(1))
+                return False
+        if not scopes:
+            # Executable or specification statements outside of any
+            # unit begin a main program without a PROGRAM statement.
+            self._push("main_program", None)
+        return False
+
+    def _push(self, kind, name):
+        if not self._scopes:
+            self._unit_kind = kind
+            self._unit_name = name
+        self._scopes.append(_Scope(kind, name))
+
+
+def split_program_units(source):
+    """Returns a list of ProgramUnitSpan objects giving the locations of
+    the top-level program units in the free-form Fortran `source`. Any
+    text after the final complete unit is returned as a final span.
+
+    """
+    scanner = ProgramUnitScanner()
+    spans = []
+    for line in source.splitlines(True):
+        spans.extend(scanner.feed(line))
+    trailing = scanner.close()
+    if trailing is not None:
+        spans.append(trailing)
+    return spans
+
+
+class OffsetMap(object):
+    """Maps character offsets in text derived from some original source
+    (e.g., by joining continuation lines) back to positions in the
+    original. The derived text is made up of runs of characters, each
+    copied contiguously from the original; the offsets at which each
+    run starts in the derived text and in the original are held in
+    arrays, as are the offsets at which the original's lines start, so
+    that positions are found by bisection.
+
+    """
+
+    def __init__(self, line_starts=(0,)):
+        self.offsets = array("q")
+        self.original_offsets = array("q")
+        self.line_starts = array("q", line_starts)
+
+    def add(self, offset, original_offset):
+        """Records that the characters from `offset` in the derived text
+        onwards were copied from `original_offset` in the original.
+        Runs must be added in order of `offset`.
+
+        """
+        offsets = self.offsets
+        if offsets and offset - offsets[-1] == \
+           original_offset - self.original_offsets[-1]:
+            return
+        if offsets and offsets[-1] == offset:
+            self.original_offsets[-1] = original_offset
+            return
+        offsets.append(offset)
+        self.original_offsets.append(original_offset)
+
+    def original_offset(self, offset):
+        """Returns the offset in the original corresponding to `offset`
+        in the derived text.
+
+        """
+        run = bisect.bisect_right(self.offsets, offset) - 1
+        if run < 0:
+            return offset
+        return self.original_offsets[run] + offset - self.offsets[run]
+
+    def position(self, original_offset):
+        """Returns the (1-based) line and column of `original_offset`."""
+        line = bisect.bisect_right(self.line_starts, original_offset)
+        return line, original_offset - self.line_starts[line - 1] + 1
+
+    def locate(self, offset):
+        """Returns the original offset, line, and column of the character
+        at `offset` in the derived text.
+
+        """
+        original = self.original_offset(offset)
+        return (original,) + self.position(original)
+
+    def locate_end(self, start, end):
+        """Returns the original offset, line, and column just after the
+        end of the text spanning from `start` up to (but not including)
+        `end` in the derived text.
+
+        """
+        if end <= start:
+            return self.locate(start)
+        original = self.original_offset(end - 1) + 1
+        return (original,) + self.position(original)
+
+
+# The kinds of line in fixed-form source
+BLANK_LINE = 0
+COMMENT_LINE = 1
+INITIAL_LINE = 2
+LABELLED_LINE = 3
+CONTINUATION_LINE = 4
+
+_FIXED_FORM_COMMENTS = frozenset("cC*!")
+# Comment markers which are replaced by "!" in free form
+_FIXED_FORM_MARKS = [ord(char) for char in "cC*"]
+_QUOTES_AND_COMMENTS = re.compile(r"['\"!]")
+
+
+def _find_comment(text, quote):
+    """Returns the index of the comment in a piece of a fixed-form
+    statement (or -1 if there is none) and the quote character of any
+    character literal left open at the end of the piece. `quote` is
+    that of any literal open at its start.
+
+    """
+    for match in _QUOTES_AND_COMMENTS.finditer(text):
+        char = match.group()
+        if quote:
+            if char == quote:
+                quote = None
+        elif char == "!":
+            return match.start(), None
+        else:
+            quote = char
+    return -1, quote
+
+
+class FixedFormLines(object):
+    """The classification of each line of some fixed-form source, as
+    NumPy arrays indexed by line number (from 0):
+
+    - `starts`, `ends`: the offsets at which each line starts and ends,
+      excluding its line ending
+    - `kinds`: the kind of each line (BLANK_LINE, COMMENT_LINE,
+      INITIAL_LINE, LABELLED_LINE, or CONTINUATION_LINE)
+    - `fields`: the index within each line at which its statement field
+      begins, or 0 for blank and comment lines
+
+    `codes` holds the code point of each character of the source.
+
+    """
+
+    def __init__(self, codes, starts, ends, kinds, fields):
+        self.codes = codes
+        self.starts = starts
+        self.ends = ends
+        self.kinds = kinds
+        self.fields = fields
+
+
+def _code_points(source):
+    import numpy as np
+    if source.isascii():
+        return np.frombuffer(source.encode("ascii"), dtype=np.uint8)
+    return np.frombuffer(source.encode("utf-32-le", "surrogatepass"),
+                         dtype=np.uint32)
+
+
+def _decode_code_points(codes):
+    if codes.itemsize == 1:
+        return codes.tobytes().decode("ascii")
+    return codes.tobytes().decode("utf-32-le", "surrogatepass")
+
+
+def classify_fixed_form(source, line_length=72):
+    """Classifies every line of the fixed-form `source` at once, using
+    array operations on its characters rather than a loop over its
+    lines, and returns the result as FixedFormLines. Lines are
+    classified as by `FixedFormLexer.classify`.
+
+    """
+    import numpy as np
+    codes = _code_points(source)
+    size = len(codes)
+    newlines = np.flatnonzero(codes == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [size]))
+    if starts[-1] == size:
+        starts = starts[:-1]
+        ends = ends[:-1]
+    count = len(starts)
+    if not count:
+        empty = np.zeros(0, dtype=np.int64)
+        return FixedFormLines(codes, empty, empty,
+                              np.zeros(0, dtype=np.int8), empty)
+    carriage_returns = (ends > starts) & \
+        (codes[np.maximum(ends - 1, 0)] == ord("\r"))
+    ends = ends - carriage_returns
+    limits = np.minimum(ends - starts, line_length)
+
+    # The first seven columns of each line, padded with blanks
+    columns = np.arange(7)
+    cells = np.where(columns < limits[:, None],
+                     codes[np.minimum(starts[:, None] + columns, size - 1)],
+                     ord(" "))
+    blank_cells = (cells == ord(" ")) | (cells == ord("\t"))
+
+    # The first character which is not a blank or tab
+    non_blanks = np.flatnonzero((codes != ord(" ")) & (codes != ord("\t")) &
+                                (codes != ord("\n")))
+    found = np.searchsorted(non_blanks, starts)
+    first = np.append(non_blanks, size)[found]
+    blank = first >= starts + limits
+    comment = np.isin(cells[:, 0], [ord(c) for c in _FIXED_FORM_COMMENTS])
+    comment |= (np.append(codes, 0)[first] == ord("!")) & \
+        (first - starts != 5)
+
+    tabs = cells[:, :6] == ord("\t")
+    has_tab = tabs.any(axis=1)
+    tab = tabs.argmax(axis=1)
+    tab_marker = cells[np.arange(count), tab + 1]
+    continuation = np.where(has_tab,
+                            (tab_marker >= ord("1")) &
+                            (tab_marker <= ord("9")),
+                            ~blank_cells[:, 5] & (cells[:, 5] != ord("0")))
+    fields = np.where(has_tab, tab + 1 + continuation, 6)
+    label_length = np.where(has_tab, tab, 5)
+    unlabelled = (blank_cells[:, :6] |
+                  (columns[:6] >= label_length[:, None])).all(axis=1)
+
+    kinds = np.select([blank, comment, continuation, unlabelled],
+                      [BLANK_LINE, COMMENT_LINE, CONTINUATION_LINE,
+                       INITIAL_LINE], LABELLED_LINE).astype(np.int8)
+    fields = np.where(kinds >= INITIAL_LINE, fields, 0)
+    return FixedFormLines(codes, starts, ends, kinds, fields)
+
+
+class FixedFormLexer(object):
+    """Converts fixed-form Fortran source into free-form text which can
+    be tokenised by the free-form grammar, along with an OffsetMap
+    from that text back to the original source. Lines are truncated
+    at `line_length` (usually 72 or 132) and examined by column, with
+    no regular expressions:
+
+    - lines with `c`, `C`, `*`, or `!` in column 1 (or `!` as the first
+      non-blank character outside column 6) are comments, which become
+      free-form (`!`) comments;
+    - columns 1-5 hold an optional statement label;
+    - a character other than blank or zero in column 6 marks a
+      continuation line, which is joined onto the preceding statement,
+      so that tokens may be split across lines;
+    - a tab within the first six columns ends the label field, and is
+      followed by a non-zero digit on continuation lines.
+
+    Each statement occupies a single line of the free-form text.
+    Comments found within a continued statement (on lines of their own
+    or after a `!`) are placed after it. Blanks remain significant, as
+    in free-form source.
+
+    """
+
+    # Sources at least this long are classified with NumPy
+    vectorize_threshold = 2**16
+
+    def __init__(self, line_length=72):
+        self.line_length = line_length
+
+    def classify(self, line):
+        """Returns the kind of `line` (without its line ending) and the
+        index at which the statement field begins (0 for blank and
+        comment lines).
+
+        """
+        text = line[:self.line_length]
+        stripped = text.lstrip(" \t")
+        if not stripped:
+            return BLANK_LINE, 0
+        if text[0] in _FIXED_FORM_COMMENTS or \
+           (stripped[0] == "!" and len(text) - len(stripped) != 5):
+            return COMMENT_LINE, 0
+        tab = text.find("\t", 0, 6)
+        if tab >= 0:
+            label = text[:tab]
+            marker = text[tab + 1:tab + 2]
+            if marker and marker in "123456789":
+                return CONTINUATION_LINE, tab + 2
+            start = tab + 1
+        else:
+            label = text[:5]
+            marker = text[5:6]
+            if marker and marker not in " 0":
+                return CONTINUATION_LINE, 6
+            start = 6
+        if label.strip(" \t"):
+            return LABELLED_LINE, start
+        return INITIAL_LINE, start
+
+    def free_form(self, source):
+        """Returns free-form text equivalent to the fixed-form `source`,
+        and an OffsetMap from offsets in that text to those in
+        `source`. Lines end at line feeds, optionally preceded by a
+        carriage return. Sources of at least `vectorize_threshold`
+        characters are classified with NumPy (see
+        `classify_fixed_form`), and only the lines needing it are
+        examined individually.
+
+        """
+        if len(source) >= self.vectorize_threshold:
+            return self._free_form_vectorized(source)
+        lines = source.split("\n")
+        if not lines[-1]:
+            lines.pop()
+        line_starts = []
+        start = 0
+        for i, line in enumerate(lines):
+            line_starts.append(start)
+            start += len(line) + 1
+            if line.endswith("\r"):
+                lines[i] = line[:-1]
+        offsets = OffsetMap(line_starts or [0])
+        pieces = []
+        self._join(lines, line_starts,
+                   [self.classify(line) for line in lines], offsets, pieces,
+                   0)
+        return "".join(pieces), offsets
+
+    def _free_form_vectorized(self, source):
+        import numpy as np
+        lines = classify_fixed_form(source, self.line_length)
+        starts = lines.starts
+        ends = lines.ends
+        kinds = lines.kinds
+        fields = lines.fields
+        codes = lines.codes.copy()
+        count = len(kinds)
+        offsets = OffsetMap(starts.tolist() if count else [0])
+        if not count:
+            return "", offsets
+
+        # Convert comment markers, and blank out continuation fields
+        # (which may hold "0") and tabs, in place
+        comments = starts[(kinds == COMMENT_LINE) &
+                          np.isin(codes[starts], _FIXED_FORM_MARKS)]
+        codes[comments] = ord("!")
+        code = kinds >= INITIAL_LINE
+        lengths = ends - starts
+        blanked = code & (kinds != CONTINUATION_LINE) & (fields <= lengths)
+        codes[starts[blanked] + fields[blanked] - 1] = ord(" ")
+        text = _decode_code_points(codes)
+
+        # Continued statements are joined with array operations, unless
+        # one of their lines might hold a trailing comment, is separated
+        # from the previous one by comment or blank lines, or would have
+        # its length changed. Such statements are examined line by line.
+        lengths = ends - starts
+        limits = starts + np.minimum(lengths, self.line_length)
+        bangs = np.flatnonzero(lines.codes == ord("!"))
+        has_bang = np.searchsorted(bangs, limits) > \
+            np.searchsorted(bangs, starts)
+        code_lines = np.flatnonzero(code)
+        joined = kinds[code_lines] == CONTINUATION_LINE
+        awkward = has_bang[code_lines] | \
+            (lengths[code_lines] < fields[code_lines])
+        if len(code_lines) and joined[0]:
+            # A continuation line with nothing to continue begins a
+            # statement
+            joined[0] = False
+            awkward[0] = True
+        awkward[1:] |= joined[1:] & (np.diff(code_lines) > 1)
+        # The index (in code_lines) of the first line of each statement
+        statements = np.maximum.accumulate(
+            np.where(joined, 0, np.arange(len(code_lines))))
+        awkward = np.bincount(statements, awkward,
+                              len(code_lines))[statements] > 0
+        ranges = np.zeros(count + 1, dtype=np.int64)
+        np.add.at(ranges, code_lines[statements[awkward]], 1)
+        np.add.at(ranges, code_lines[awkward] + 1, -1)
+        examine = np.cumsum(ranges[:count]) > 0
+
+        # Every other line becomes a segment of the free-form text,
+        # followed by a line feed unless the statement is continued
+        segment_starts = starts + np.where(kinds == CONTINUATION_LINE,
+                                           fields, 0)
+        segment_ends = np.where(code, limits, ends)
+        newline = np.ones(count, dtype=bool)
+        newline[code_lines[:-1][joined[1:]]] = False
+        # Segments are copied in groups which are contiguous in the
+        # original, each of which is a single slice of the text
+        group_starts = np.ones(count, dtype=bool)
+        group_starts[1:] = (examine[1:] != examine[:-1]) | ~examine[1:] & (
+            ~newline[:-1] | (segment_starts[1:] != segment_ends[:-1] + 1))
+        bounds = np.append(np.flatnonzero(group_starts), count).tolist()
+        examine = examine.tolist()
+        segment_starts = segment_starts.tolist()
+        segment_ends = segment_ends.tolist()
+        newline = newline.tolist()
+
+        pieces = []
+        length = 0
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if examine[first]:
+                run = range(first, last)
+                length = self._join(
+                    [text[starts[i]:ends[i]] for i in run],
+                    starts[first:last].tolist(),
+                    list(zip(kinds[first:last].tolist(),
+                             fields[first:last].tolist())),
+                    offsets, pieces, length)
+                continue
+            start = segment_starts[first]
+            piece = text[start:segment_ends[last - 1]]
+            if newline[last - 1]:
+                piece += "\n"
+            offsets.add(length, start)
+            pieces.append(piece)
+            length += len(piece)
+        return "".join(pieces), offsets
+
+    def _join(self, lines, line_starts, kinds, offsets, pieces, length):
+        """Appends the free-form text for some complete fixed-form
+        statements (and any comment or blank lines among them) to
+        `pieces`, with its offsets recorded in `offsets` starting from
+        `length`. Returns the length of the text after this.
+
+        """
+        line_length = self.line_length
+        # Comment and blank lines (as (text, original offset) pairs)
+        # waiting for the current statement to end
+        pending = []
+        # The original offset of the end of the current statement, if any
+        statement_end = None
+        quote = None
+
+        for line, line_start, (kind, start) in zip(lines, line_starts, kinds):
+            if kind == BLANK_LINE or kind == COMMENT_LINE:
+                if kind == COMMENT_LINE and line[0] in "cC*":
+                    text = "!" + line[1:]
+                else:
+                    text = line
+                if statement_end is None:
+                    offsets.add(length, line_start)
+                    pieces.append(text + "\n")
+                    length += len(text) + 1
+                else:
+                    pending.append((text, line_start))
+                continue
+
+            if kind == CONTINUATION_LINE and statement_end is not None:
+                text = line[start:line_length]
+                text_start = line_start + start
+            else:
+                if statement_end is not None:
+                    length = self._end_statement(pieces, length, offsets,
+                                                 statement_end, pending)
+                quote = None
+                text = line[:line_length]
+                # Blank out the continuation field (which may hold "0")
+                # and any tab
+                text = text[:start - 1] + " " + text[start:]
+                text_start = line_start
+            if quote or "!" in text or "'" in text or '"' in text:
+                comment, quote = _find_comment(text, quote)
+                if comment >= 0:
+                    pending.append(("!" + text[comment + 1:],
+                                    text_start + comment))
+                    text = text[:comment]
+            offsets.add(length, text_start)
+            pieces.append(text)
+            length += len(text)
+            statement_end = text_start + len(text)
+
+        if statement_end is not None:
+            length = self._end_statement(pieces, length, offsets,
+                                         statement_end, pending)
+        return length
+
+    @staticmethod
+    def _end_statement(pieces, length, offsets, statement_end, pending):
+        offsets.add(length, statement_end)
+        pieces.append("\n")
+        length += 1
+        for text, original in pending:
+            offsets.add(length, original)
+            pieces.append(text + "\n")
+            length += len(text) + 1
+        del pending[:]
+        return length
+
+
+# Pieces of a free-form line which matter when joining continuation
+# lines: character literals (possibly unterminated), comments,
+# ampersands, and runs of anything else.
+_JOIN_PIECES = re.compile(r"""[^'"!&]+|'(?:[^']|'')*'?|"(?:[^"]|"")*"?|"""
+                          r"""![^\n]*|&""")
+# The remainder of a character literal continued from a previous line
+_STRING_REST = {"'": re.compile(r"(?:[^']|'')*(')?"),
+                '"': re.compile(r'(?:[^"]|"")*(")?')}
+
+
+def _scan_continued(line, pos, quote):
+    """Examines free-form `line` from index `pos` onwards, where `quote`
+    is the delimiter of a character literal continued onto it from the
+    previous line (or None). Returns a tuple holding:
+
+    - whether the line is continued onto the next one;
+    - the index of the `&` marking the continuation;
+    - the index of the comment following that `&`, or -1;
+    - the delimiter of any character literal left open.
+
+    """
+    if quote:
+        match = _STRING_REST[quote].match(line, pos)
+        if match.group(1) is None:
+            text = line.rstrip(" \t\r")
+            if text.endswith("&"):
+                return True, len(text) - 1, -1, quote
+            return False, -1, -1, None
+        pos = match.end()
+    for match in _JOIN_PIECES.finditer(line, pos):
+        piece = match.group()
+        first = piece[0]
+        if first == "&":
+            rest = line[match.end():].lstrip(" \t\r")
+            if not rest:
+                return True, match.start(), -1, None
+            if rest[0] == "!":
+                return True, match.start(), len(line) - len(rest), None
+        elif first == "!":
+            break
+        elif first == "'" or first == '"':
+            if piece.count(first) % 2 == 1:
+                text = piece.rstrip(" \t\r")
+                if text.endswith("&") and match.end() == len(line):
+                    return True, match.start() + len(text) - 1, -1, first
+                break
+    return False, -1, -1, None
+
+
+def join_continuations(source):
+    """Joins the continued lines of the free-form Fortran `source` in a
+    single pass, so that each statement occupies one line and tokens
+    (including character literals) split across lines by `&` are made
+    whole. Comments found within a continued statement are placed on
+    lines of their own after it. Returns the joined text and an
+    OffsetMap from it back to `source`, or `source` itself and None if
+    no lines are continued.
+
+    """
+    if "&" not in source:
+        return source, None
+    lines = source.split("\n")
+    line_starts = [0]
+    line_starts.extend(accumulate(len(line) + 1 for line in lines[:-1]))
+    offsets = OffsetMap(line_starts)
+    pieces = []
+    length = 0
+    # Start of the text which has yet to be copied from the source
+    copied = 0
+    number = 0
+    count = len(lines)
+    while number < count:
+        line = lines[number]
+        number += 1
+        if "&" not in line:
+            continue
+        continued, marker, comment, quote = _scan_continued(line, 0, None)
+        if not continued:
+            continue
+        line_start = line_starts[number - 1]
+        offsets.add(length, copied)
+        pieces.append(source[copied:line_start + marker])
+        length += line_start + marker - copied
+        pending = []
+        if comment >= 0:
+            pending.append((line[comment:], line_start + comment))
+        statement_end = line_start + marker
+        while continued and number < count:
+            line = lines[number]
+            line_start = line_starts[number]
+            number += 1
+            text = line.lstrip(" \t\r")
+            if not text or text[0] == "!":
+                pending.append((line, line_start))
+                continue
+            pos = len(line) - len(text) + 1 if text[0] == "&" else 0
+            continued, marker, comment, quote = _scan_continued(line, pos,
+                                                                quote)
+            if continued:
+                offsets.add(length, line_start + pos)
+                pieces.append(line[pos:marker])
+                length += marker - pos
+                if comment >= 0:
+                    pending.append((line[comment:], line_start + comment))
+                statement_end = line_start + marker
+            else:
+                # The last line of the statement, with its line ending
+                copied = line_start + pos
+                statement_end = min(line_start + len(line) + 1, len(source))
+                offsets.add(length, copied)
+                pieces.append(source[copied:statement_end])
+                length += statement_end - copied
+        if continued:
+            # The source ended with a continued line
+            offsets.add(length, statement_end)
+            pieces.append("\n")
+            length += 1
+            statement_end = len(source)
+        for text, original in pending:
+            # Each comment runs to the end of a line, and is copied
+            # along with its line ending
+            offsets.add(length, original)
+            pieces.append(source[original:original + len(text) + 1])
+            length += len(pieces[-1])
+        copied = statement_end
+    if not pieces:
+        return source, None
+    offsets.add(length, copied)
+    pieces.append(source[copied:])
+    return "".join(pieces), offsets
+
@@ -3,7 +3,11 @@ of preprocessed source code and the original source file(s).
 
 """
 
+from array import array
+from itertools import accumulate
+import bisect
 import copy
+import os
 import re
 
 
@@ -52,86 +56,630 @@ class LineDirective(object):
         return self.source_line != source_line
 
 
-class PivotNode(object):
-    """Nodes in a tree representing the mapping between lines in an
-    original file and line numbers after running some sort of
-    preprocessor.
+class LineMap(object):
+    """A mapping from lines in preprocessed source code to positions in
+    the original source file(s), built from a sequence of line
+    directives added in order of `source_line`. Each applies to the
+    lines following it, up to and including the `source_line` of the
+    next.
+
+    Rather than holding a LineDirective for each, the directives are
+    stored in flat arrays, indexed by directive: the sorted
+    `source_lines`, the `file_ids` (indices into `files`) and
+    `original_lines` of the positions following them, and the
+    `stack_ids` of the include stacks enclosing those. File names are
+    interned, so each distinct one is stored once. Lines are found by
+    bisection.
+
+    Include stacks are interned in a table of parent pointers, also
+    held in flat arrays indexed by stack id: `stack_parents`, and the
+    `stack_file_ids` and `stack_lines` of the include line each adds
+    to its parent. Stack 0 is the empty stack, which has no parent
+    (-1). Stacks sharing enclosing include lines thus share their
+    entries, and are only expanded into lists of positions by `stack`
+    (or the lookups returning position stacks).
+
+    As directives are added, the run of lines each covers is also
+    recorded against its file, so that `generated_lines` can go the
+    other way without scanning every directive. If `markers` is True,
+    the `source_line` of each directive holds a line marker, which
+    comes from no original line. The last run is taken to extend to
+    `line_count`, if that has been set, and otherwise without end.
 
     """
 
-    def __init__(self, pivot, start_line, end_line, left_nodes, right_nodes):
-        self.pivot = pivot
-        self.start_line = start_line  # These variables (and the
-                                      # assertions) are for debugging
-                                      # and can be removed once I'm
-                                      # confident this works properly
-        self.end_line = end_line
-        assert self.start_line < self.pivot
-        assert self.pivot <= self.end_line
-        self.left = None
-        self.right = None
-
-        if len(left_nodes) > 1:
-            left_divide = len(left_nodes) // 2
-            left_pivot = left_nodes[left_divide].source_line
-            self.left = PivotNode(left_pivot, self.start_line, self.pivot,
-                                  left_nodes[:left_divide],
-                                  left_nodes[left_divide:])
-        elif len(left_nodes) == 1:
-            assert self.start_line == left_nodes[0].source_line
-            self.left = left_nodes[0]
-
-        if len(right_nodes) > 1:
-            right_divide = len(right_nodes) // 2
-            right_pivot = right_nodes[right_divide].source_line
-            self.right = PivotNode(right_pivot, self.pivot, self.end_line,
-                                   right_nodes[:right_divide],
-                                   right_nodes[right_divide:])
-        elif len(right_nodes) == 1:
-            assert self.pivot == right_nodes[0].source_line
-            self.right = right_nodes[0]
+    def __init__(self, markers=True):
+        self.source_lines = array("q")
+        self.file_ids = array("q")
+        self.original_lines = array("q")
+        self.stack_ids = array("q")
+        self.stack_parents = array("q", [-1])
+        self.stack_file_ids = array("q", [-1])
+        self.stack_lines = array("q", [0])
+        self.files = []
+        self.markers = markers
+        self.line_count = None
+        self._file_ids = {}
+        self._stack_ids = {}
+        # For each file id, the original first lines, original ends and
+        # first generated lines of the closed runs from that file, in
+        # the order added, and the same sorted by first line
+        self._runs = {}
+        self._sorted_runs = {}
+
+    @classmethod
+    def from_directives(cls, directives):
+        """Returns a LineMap holding the LineDirectives `directives`,
+        which must be in order of `source_line`.
+
+        """
+        line_map = cls()
+        for directive in directives:
+            line_map.add(directive.source_line, directive.position_stack)
+        return line_map
+
+    def __len__(self):
+        return len(self.source_lines)
+
+    def add(self, source_line, position_stack):
+        """Records that the line following `source_line` in the
+        preprocessed source code came from the position at the end of
+        `position_stack`, a sequence of (file_name, line_number) tuples
+        (as for LineDirective). Lines must be added in order.
+
+        """
+        stack_id = 0
+        for filename, line in position_stack[:-1]:
+            stack_id = self._push(stack_id, self._file_id(filename), line)
+        filename, line = position_stack[-1]
+        self._add(source_line, self._file_id(filename), line, stack_id)
+
+    def _file_id(self, filename):
+        file_id = self._file_ids.get(filename)
+        if file_id is None:
+            file_id = self._file_ids[filename] = len(self.files)
+            self.files.append(filename)
+        return file_id
+
+    def _push(self, stack_id, file_id, line):
+        """Returns the id of the stack made by adding the include line
+        `line` of the file `file_id` to the stack `stack_id`.
+
+        """
+        key = (stack_id, file_id, line)
+        result = self._stack_ids.get(key)
+        if result is None:
+            result = self._stack_ids[key] = len(self.stack_parents)
+            self.stack_parents.append(stack_id)
+            self.stack_file_ids.append(file_id)
+            self.stack_lines.append(line)
+        return result
+
+    def _add(self, source_line, file_id, line, stack_id):
+        if self.source_lines and source_line < self.source_lines[-1]:
+            raise ValueError("line directives must be added in order")
+        if self.source_lines:
+            self._close_run(source_line)
+        self.source_lines.append(source_line)
+        self.file_ids.append(file_id)
+        self.original_lines.append(line)
+        self.stack_ids.append(stack_id)
+
+    def _close_run(self, end):
+        """Records the run of lines from the last directive added, which
+        ends before line `end` (or at it, if there are no markers).
+
+        """
+        start = self.source_lines[-1]
+        length = end - start - (1 if self.markers else 0)
+        if length <= 0:
+            return
+        file_id = self.file_ids[-1]
+        runs = self._runs.get(file_id)
+        if runs is None:
+            runs = self._runs[file_id] = (array("q"), array("q"),
+                                          array("q"))
+        first = self.original_lines[-1]
+        runs[0].append(first)
+        runs[1].append(first + length)
+        runs[2].append(start + 1)
+        self._sorted_runs.pop(file_id, None)
+
+    def _sorted(self, file_id):
+        """Returns the runs from `file_id` sorted by first line, as lists
+        of their first lines, ends, first generated lines, and the
+        greatest end of any run up to each.
+
+        """
+        result = self._sorted_runs.get(file_id)
+        if result is None:
+            firsts, ends, generated = self._runs.get(file_id, ((), (), ()))
+            order = sorted(range(len(firsts)), key=firsts.__getitem__)
+            firsts = [firsts[i] for i in order]
+            ends = [ends[i] for i in order]
+            reach = list(accumulate(ends, max))
+            result = self._sorted_runs[file_id] = (
+                firsts, ends, [generated[i] for i in order], reach)
+        return result
+
+    def generated_lines(self, filename, line):
+        """Returns a sorted list of the lines in the preprocessed source
+        code which came from line `line` of the file `filename`. There
+        may be several, if the file was included more than once, or
+        none.
+
+        """
+        file_id = self._file_ids.get(filename)
+        if file_id is None:
+            return []
+        firsts, ends, generated, reach = self._sorted(file_id)
+        result = []
+        # Only runs starting at or before `line` can hold it; walk back
+        # from the last of those until none earlier can reach it
+        i = bisect.bisect_right(firsts, line) - 1
+        while i >= 0 and reach[i] > line:
+            if ends[i] > line:
+                result.append(generated[i] + line - firsts[i])
+            i -= 1
+        if self.source_lines and self.file_ids[-1] == file_id:
+            offset = line - self.original_lines[-1]
+            source_line = self.source_lines[-1] + 1 + offset
+            if offset >= 0 and (self.line_count is None or
+                                source_line <= self.line_count):
+                result.append(source_line)
+        result.sort()
+        return result
+
+    def _index(self, source_line):
+        index = bisect.bisect_left(self.source_lines, source_line) - 1
+        if index < 0:
+            raise ValueError("line {} precedes the first line directive"
+                             .format(source_line))
+        return index
+
+    def locate(self, source_line):
+        """Returns the id of the file which `source_line` in the
+        preprocessed source code came from, its line number in that
+        file, and the id of the include stack enclosing it.
+
+        """
+        index = self._index(source_line)
+        return (self.file_ids[index], self.original_lines[index] +
+                source_line - self.source_lines[index] - 1,
+                self.stack_ids[index])
 
     def map_line(self, source_line):
-        """A function which takes a position in the final, amalgamated and
-        precompiled source code, and returns a position_stack
-        indicating its position in the original source file(s).
+        """Returns the position_stack (a list of (file_name, line_number)
+        tuples) indicating where `source_line` in the preprocessed
+        source code came from.
+
+        """
+        index = self._index(source_line)
+        result = self.stack(self.stack_ids[index])
+        result.append((self.files[self.file_ids[index]],
+                       self.original_lines[index] + source_line -
+                       self.source_lines[index] - 1))
+        return result
+
+    def stack(self, stack_id):
+        """Returns the include stack `stack_id` as a list of the
+        (file_name, line_number) positions of its include lines,
+        outermost first.
+
+        """
+        result = []
+        while stack_id > 0:
+            result.append((self.files[self.stack_file_ids[stack_id]],
+                           self.stack_lines[stack_id]))
+            stack_id = self.stack_parents[stack_id]
+        result.reverse()
+        return result
+
+    @property
+    def stacks(self):
+        """A list of every include stack, indexed by id, each expanded
+        into a tuple of positions.
 
         """
-        assert source_line >= self.start_line
-        assert source_line < self.end_line
-        return (self.left.map_line(source_line) if source_line < self.pivot
-                else self.right.map_line(source_line))
+        return [tuple(self.stack(stack_id))
+                for stack_id in range(len(self.stack_parents))]
 
+    def map_lines(self, source_lines):
+        """Maps many lines in the preprocessed source code at once,
+        returning three NumPy arrays holding, for each of the
+        `source_lines`, the index in `files` of the file it came from,
+        its line number in that file, and the id of the include stack
+        enclosing it.
+
+        """
+        import numpy as np
+        lines = np.asarray(source_lines, dtype=np.int64)
+        starts = np.array(self.source_lines, dtype=np.int64)
+        index = np.searchsorted(starts, lines, side="left") - 1
+        if index.size and index.min() < 0:
+            raise ValueError("line {} precedes the first line directive"
+                             .format(lines.min()))
+        original_lines = np.array(self.original_lines, dtype=np.int64)
+        return (np.array(self.file_ids, dtype=np.int64)[index],
+                original_lines[index] + lines - starts[index] - 1,
+                np.array(self.stack_ids, dtype=np.int64)[index])
+
+    def position_stack(self, file_id, line, stack_id):
+        """Returns the position_stack for a line mapped by `map_lines` to
+        `file_id`, `line`, and `stack_id`.
+
+        """
+        result = self.stack(int(stack_id))
+        result.append((self.files[file_id], int(line)))
+        return result
+
+    @property
+    def directives(self):
+        """A list of the LineDirectives making up this map."""
+        return [LineDirective(self.source_lines[i], self.map_line(
+            self.source_lines[i] + 1)) for i in range(len(self))]
+
+
+# Line directives, as written by the C preprocessor (`# 12 "file" 1`)
+# or in source code (`#line 12 "file"`)
+LINE_DIRECTIVE = r'[ \t]*#[ \t]*(?:line[ \t]+)?(\d+)(?:[ \t]+"([^"\n]*)"' \
+    r'((?:[ \t]+\d+)*))?[ \t]*\r?$'
+
+# The size of the pieces of a buffer in which newlines are counted
+_CHUNK_SIZE = 1 << 20
+
+
+def create_line_map(source, filename="<anonymous>", regex=LINE_DIRECTIVE):
+    """Analyse the provided preprocessed source code for line directives,
+    creating a LineMap which can be used to map between line numbers
+    in the source code and the original source file(s) from which it
+    was generated. `source` may be a string, a bytes-like object (such
+    as an mmap of a file), or an iterable of lines (such as an open
+    file); only the directives found are kept, so memory use does not
+    grow with its length. `regex` matches a directive, with groups
+    holding its line number, file name (if any), and flags (if any). As
+    with GNU line markers, a flag of 1 marks the start of an included
+    file and 2 the return to the including file, while a directive
+    without flags (such as `#line`) only changes the line number and
+    name of the current file.
 
-def create_line_map(source, filename="<anonymous>",
-                    regex=r'#(?=\s*line)?\s+(\d+)\s+("[^"]+")?\s*$'):
-    """Analyse the provided preprocessed source code for line directive,
-    creating a tree structure which can be used to map between line
-    numbers in the source code and the original source file(s) from which
-    it was generated.
     """
-    position_stack = []
-    line_directives = []
-    ex = re.compile(regex)
-    lines = source.splitlines()
-    if not ex.match(lines[0]):
-        position_stack.push((filename, -1))
-        line_directives.append(0, copy.copy(position_stack))
-    for i, line in enumerate(lines):
-        match = ex.match(line)
-        if match:
-            lineno = match.group(1)
-            fname = match.group(2)
-            if not fname:
-                fname = position_stack[-1][0]
-            for j, position in reversed(enumerate(position_stack)):
-                if (fname == position[0]):
-                    del position_stack[j:]
-                    break
-            position_stack.append((fname, lineno))
-            line_directives.append(0, copy.copy(position_stack))
-    pivot_index = len(line_directives)//2
-    pivot = line_directives[pivot_index].source_line
-    return PivotNode(pivot, line_directives[0].source_line, i,
-                     line_directives[:pivot_index],
-                     line_directives[pivot_index:])
+    line_map = LineMap()
+    line_map.add(0, [(filename, 1)])
+    for number, match in _find_directives(source, regex):
+        if match is None:
+            line_map.line_count = number
+            break
+        lineno = int(match.group(1))
+        fname = _group_text(match, 2)
+        flags = (_group_text(match, 3) or "").split()
+        # Positions of enclosing files are those of their include lines
+        file_id, line, stack_id = line_map.locate(number)
+        new_file_id = file_id if fname is None else line_map._file_id(fname)
+        if "1" in flags:
+            stack_id = line_map._push(stack_id, file_id, line)
+        elif "2" in flags:
+            # Return to the innermost enclosing file of that name, if any
+            enclosing = stack_id
+            while enclosing > 0 and \
+                    line_map.stack_file_ids[enclosing] != new_file_id:
+                enclosing = line_map.stack_parents[enclosing]
+            if enclosing > 0:
+                stack_id = line_map.stack_parents[enclosing]
+        line_map._add(number, new_file_id, lineno, stack_id)
+    return line_map
+
+
+def _find_directives(source, regex):
+    """Yields the line number and match of each line directive in
+    `source` (as for `create_line_map`), followed by the number of
+    lines and None.
+
+    """
+    if isinstance(source, str):
+        view = source
+        newline = "\n"
+    else:
+        try:
+            view = memoryview(source).cast("B")
+        except TypeError:
+            # An iterable of lines, matched one at a time
+            number = 0
+            ex = None
+            for number, line in enumerate(source, 1):
+                if ex is None:
+                    ex = _compile(regex, isinstance(line, str))
+                match = ex.match(line)
+                if match:
+                    yield number, match
+            yield number, None
+            return
+        newline = b"\n"
+    ex = _compile("^(?:" + regex + ")", isinstance(source, str), re.M)
+    number = 1
+    position = 0
+    for match in ex.finditer(source):
+        number += _count(view, newline, position, match.start())
+        position = match.start()
+        yield number, match
+    number += _count(view, newline, position, len(view))
+    if not len(view) or view[-1:] == newline:
+        number -= 1
+    yield number, None
+
+
+def _compile(regex, text, flags=0):
+    return re.compile(regex if text else regex.encode(), flags)
+
+
+def _count(view, newline, start, end):
+    """Returns the number of newlines in `view[start:end]`, copying at
+    most `_CHUNK_SIZE` bytes of it at a time.
+
+    """
+    if isinstance(view, str):
+        return view.count(newline, start, end)
+    return sum(view[i:min(i + _CHUNK_SIZE, end)].tobytes().count(newline)
+               for i in range(start, end, _CHUNK_SIZE))
+
+
+def _group_text(match, group):
+    value = match.group(group)
+    if isinstance(value, bytes):
+        return os.fsdecode(value)
+    return value
+
+
+_BASE64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+_BASE64_VALUES = {char: value for value, char in enumerate(_BASE64)}
+
+
+def _encode_vlq(value, pieces):
+    """Appends the base64 VLQ encoding of the integer `value` (as used in
+    source maps) to the list `pieces`.
+
+    """
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            pieces.append(_BASE64[digit | 32])
+        else:
+            pieces.append(_BASE64[digit])
+            return
+
+
+def _decode_vlq(text):
+    """Returns a list of the integers encoded as base64 VLQs in `text`."""
+    values = []
+    value = shift = 0
+    for char in text:
+        digit = _BASE64_VALUES[char]
+        value |= (digit & 31) << shift
+        if digit & 32:
+            shift += 5
+        else:
+            values.append(-(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    return values
+
+
+class SourceMap(object):
+    """A column-accurate mapping between positions (1-based lines and
+    columns) in generated text, such as the output of the preprocessor
+    or of `fortify.lexers.join_continuations`, and positions in the
+    source files from which it was produced. It is made up of segments,
+    each mapping the position at which it starts in the generated text
+    to a position in one of the `files`. The text from there up to the
+    start of the next segment is taken to have been copied unchanged,
+    so that later columns (and lines) correspond to later columns (and
+    lines) of the file.
+
+    Segments are held in flat arrays sorted by generated position, in
+    which they are found by bisection; an index sorted by original
+    position, for lookups in the other direction, is built when first
+    needed. `encode` serialises the map as a source map (version 3),
+    whose mappings are delta-encoded as base64 VLQs.
+
+    """
+
+    def __init__(self):
+        self.files = []
+        # Generated positions, as line << 32 | column
+        self.generated = array("q")
+        self.file_ids = array("q")
+        self.original_lines = array("q")
+        self.original_columns = array("q")
+        self._file_ids = {}
+        self._reverse = None
+
+    def __len__(self):
+        return len(self.generated)
+
+    def add(self, line, column, filename, original_line, original_column):
+        """Adds a segment starting at `line` and `column` of the generated
+        text, which came from `original_line` and `original_column` of
+        `filename`. Segments must be added in order of their generated
+        positions; one added at the same position as the last replaces
+        it.
+
+        """
+        key = line << 32 | column
+        file_id = self._file_ids.get(filename)
+        if file_id is None:
+            file_id = self._file_ids[filename] = len(self.files)
+            self.files.append(filename)
+        generated = self.generated
+        if generated and key <= generated[-1]:
+            if key < generated[-1]:
+                raise ValueError("segments must be added in order")
+            self.file_ids[-1] = file_id
+            self.original_lines[-1] = original_line
+            self.original_columns[-1] = original_column
+        else:
+            generated.append(key)
+            self.file_ids.append(file_id)
+            self.original_lines.append(original_line)
+            self.original_columns.append(original_column)
+        self._reverse = None
+
+    def original_position(self, line, column):
+        """Returns the (file name, line, column) from which `line` and
+        `column` of the generated text came.
+
+        """
+        index = bisect.bisect_right(self.generated, line << 32 | column) - 1
+        if index < 0:
+            raise ValueError("line {}, column {} precedes the first segment"
+                             .format(line, column))
+        start_line = self.generated[index] >> 32
+        original_line = self.original_lines[index]
+        if start_line == line:
+            original_column = self.original_columns[index] + column - \
+                (self.generated[index] & 0xFFFFFFFF)
+        else:
+            original_line += line - start_line
+            original_column = column
+        return (self.files[self.file_ids[index]], original_line,
+                original_column)
+
+    def generated_position(self, filename, line, column):
+        """Returns the (line, column) in the generated text to which
+        `line` and `column` of `filename` were copied, or None if they
+        were not. If they were copied more than once, the position of
+        one of the copies is returned.
+
+        """
+        file_id = self._file_ids.get(filename)
+        if file_id is None:
+            return None
+        if self._reverse is None:
+            self._reverse = self._reverse_index()
+        keys, furthest = self._reverse
+        key = file_id << 64 | line << 32 | column
+        position = bisect.bisect_right(keys, key) - 1
+        if position < 0:
+            return None
+        # Of the segments starting at or before this position, the one
+        # reaching furthest covers it if any does (those from earlier
+        # files end before it)
+        index, end = furthest[position]
+        if end <= key:
+            return None
+        start = self.generated[index]
+        original_line = self.original_lines[index]
+        if original_line == line:
+            return (start >> 32, (start & 0xFFFFFFFF) + column -
+                    self.original_columns[index])
+        return ((start >> 32) + line - original_line, column)
+
+    def _reverse_index(self):
+        """Returns the keys (file id << 64 | line << 32 | column) of the
+        original positions at which segments start, in sorted order,
+        and for each, the index and end key of the segment reaching
+        furthest among it and those before it. A segment ends where the
+        text copied up to the start of the next segment ends; the last
+        has no end, so is given the first key of the next file.
+
+        """
+        generated = self.generated
+        count = len(generated)
+        keys = []
+        ends = []
+        for index in range(count):
+            file_id = self.file_ids[index]
+            original_line = self.original_lines[index]
+            original_column = self.original_columns[index]
+            keys.append(file_id << 64 | original_line << 32 |
+                        original_column)
+            if index + 1 == count:
+                ends.append((file_id + 1) << 64)
+                continue
+            start = generated[index]
+            following = generated[index + 1]
+            if following >> 32 == start >> 32:
+                end_line = original_line
+                end_column = original_column + (following - start)
+            else:
+                end_line = original_line + (following >> 32) - (start >> 32)
+                end_column = following & 0xFFFFFFFF
+            ends.append(file_id << 64 | end_line << 32 | end_column)
+        order = sorted(range(count), key=keys.__getitem__)
+        furthest = []
+        best = None
+        for index in order:
+            if best is None or ends[index] > best[1]:
+                best = (index, ends[index])
+            furthest.append(best)
+        return [keys[i] for i in order], furthest
+
+    def encode(self):
+        """Returns this map serialised as a (UTF-8 encoded, JSON) source
+        map, with 0-based lines and columns as that format requires.
+
+        """
+        import json
+        pieces = []
+        line = 1
+        previous = [0, 0, 0, 0]
+        for key, file_id, original_line, original_column in zip(
+                self.generated, self.file_ids, self.original_lines,
+                self.original_columns):
+            generated_line = key >> 32
+            if generated_line != line:
+                pieces.append(";" * (generated_line - line))
+                line = generated_line
+                previous[0] = 0
+            elif pieces:
+                pieces.append(",")
+            segment = [(key & 0xFFFFFFFF) - 1, file_id, original_line - 1,
+                       original_column - 1]
+            for value, last in zip(segment, previous):
+                _encode_vlq(value - last, pieces)
+            previous = segment
+        return json.dumps({"version": 3, "sources": self.files, "names": [],
+                           "mappings": "".join(pieces)},
+                          separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def decode(cls, blob):
+        """Returns the SourceMap serialised as `blob` by `encode`."""
+        import json
+        data = json.loads(blob.decode("utf-8"))
+        files = data["sources"]
+        source_map = cls()
+        previous = [0, 0, 0, 0]
+        for line, segments in enumerate(data["mappings"].split(";"), 1):
+            previous[0] = 0
+            for segment in segments.split(","):
+                if not segment:
+                    continue
+                values = _decode_vlq(segment)
+                previous = [value + last for value, last in
+                            zip(values, previous)]
+                source_map.add(line, previous[0] + 1, files[previous[1]],
+                               previous[2] + 1, previous[3] + 1)
+        return source_map
+
+    @classmethod
+    def from_offset_map(cls, offset_map, text, filename):
+        """Returns a SourceMap equivalent to the `fortify.lexers.OffsetMap`
+        `offset_map`, from the derived `text` back to the file
+        `filename`.
+
+        """
+        line_starts = [0]
+        position = text.find("\n")
+        while position >= 0:
+            line_starts.append(position + 1)
+            position = text.find("\n", position + 1)
+        source_map = cls()
+        if not offset_map.offsets or offset_map.offsets[0] > 0:
+            source_map.add(1, 1, filename, 1, 1)
+        for offset, original in zip(offset_map.offsets,
+                                    offset_map.original_offsets):
+            line = bisect.bisect_right(line_starts, offset)
+            source_map.add(line, offset - line_starts[line - 1] + 1,
+                           filename, *offset_map.position(original))
+        return source_map
@@ -0,0 +1,879 @@
+"""Provides functions to construct a parser for Fortran source code
+from the grammar distributed with fortify. Constructing the LALR
+tables for the grammar is expensive, so the analysed grammar is
+serialised to an on-disk cache which subsequent processes can load
+almost instantly. Alternatively, a standalone parser module can be
+generated ahead of time; this is done when the package is built (see
+setup.py), or can be done by running ``python -m fortify.parser``.
+When it matches the grammar, it is used without importing Lark at
+all. For this reason Lark is only imported within the functions
+needing it.
+
+"""
+
+import argparse
+import concurrent.futures
+import copyreg
+import hashlib
+import importlib
+import os
+import pickle
+import sys
+
+from ._files import atomic_write
+
+
+GRAMMAR_FILE = os.path.join(os.path.dirname(__file__), "f2018-grammar.lark")
+STANDALONE_MODULE = "fortify._standalone_parser"
+STANDALONE_FILE = os.path.join(os.path.dirname(__file__),
+                               "_standalone_parser.py")
+
+# Increment whenever the layout of cache files changes, so that
+# existing caches are ignored rather than misread.
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_OPTIONS = {"parser": "lalr", "start": "fortran_file"}
+
+# Options which do not affect the analysed grammar or parse tables
+# and which Lark allows to be supplied when loading a saved parser.
+RUNTIME_OPTIONS = frozenset(("postlex", "transformer", "lexer_callbacks",
+                             "use_bytes", "debug", "g_regex_flags", "regex",
+                             "propagate_positions", "tree_class"))
+
+
+def default_cache_dir():
+    """Returns the directory in which compiled parsers are cached. This
+    is taken from the `FORTIFY_CACHE_DIR` environment variable if it
+    is set, otherwise it is a `fortify` directory within the user's
+    cache directory.
+
+    """
+    cache_dir = os.environ.get("FORTIFY_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "fortify")
+
+
+def read_grammar(grammar_file=GRAMMAR_FILE):
+    """Returns the text of the grammar stored in `grammar_file`."""
+    with open(grammar_file, "r") as f:
+        return f.read()
+
+
+def grammar_hash(grammar):
+    """Returns a hex digest identifying the content of a grammar."""
+    return hashlib.sha256(grammar.encode("utf-8")).hexdigest()
+
+
+def _split_options(options):
+    """Separates the options which determine the parse tables from those
+    which can be applied when a parser is loaded.
+
+    """
+    table_options = dict(DEFAULT_OPTIONS)
+    runtime_options = {}
+    for name, value in options.items():
+        if name in RUNTIME_OPTIONS:
+            runtime_options[name] = value
+        else:
+            table_options[name] = value
+    return table_options, runtime_options
+
+
+def _options_repr(table_options):
+    return repr(sorted(table_options.items()))
+
+
+def cache_key(grammar, table_options):
+    """Returns a key identifying the parser which would be built from
+    `grammar` with `table_options`, using the current version of
+    Lark.
+
+    """
+    import lark
+    key = hashlib.sha256()
+    key.update(grammar_hash(grammar).encode("utf-8"))
+    key.update(lark.__version__.encode("utf-8"))
+    key.update(str(CACHE_FORMAT_VERSION).encode("utf-8"))
+    key.update(_options_repr(table_options).encode("utf-8"))
+    return key.hexdigest()
+
+
+def _cache_header(grammar, table_options):
+    import lark
+    return {"format": CACHE_FORMAT_VERSION,
+            "grammar_hash": grammar_hash(grammar),
+            "lark_version": lark.__version__,
+            "options": _options_repr(table_options)}
+
+
+def _load_cached_parser(cache_file, header, runtime_options):
+    """Attempts to load a parser from `cache_file`, returning None if the
+    file is missing, corrupt, or was not built from the expected
+    grammar.
+
+    """
+    import lark
+    try:
+        with open(cache_file, "rb") as f:
+            if pickle.load(f) != header:
+                return None
+            data = pickle.load(f)
+        return lark.Lark.__new__(lark.Lark)._load(data, **runtime_options)
+    except Exception:
+        return None
+
+
+def _save_cached_parser(parser, cache_file, header):
+    """Writes `parser` to `cache_file` (see `atomic_write`). Failure to
+    write the cache is not an error.
+
+    """
+    def write(f):
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        parser.save(f, RUNTIME_OPTIONS)
+
+    try:
+        atomic_write(cache_file, write)
+    except OSError:
+        pass
+
+
+def _load_standalone(module_name, grammar, table_options, runtime_options):
+    """Attempts to create a parser from the generated standalone module
+    `module_name`, returning None if the module does not exist or was
+    generated from a different grammar or with different options.
+
+    """
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        return None
+    if getattr(module, "GRAMMAR_HASH", None) != grammar_hash(grammar) or \
+       getattr(module, "TABLE_OPTIONS", None) != \
+       _options_repr(table_options):
+        return None
+    return module.Lark_StandAlone(**runtime_options)
+
+
+def generate_standalone(grammar_file=GRAMMAR_FILE, output_file=STANDALONE_FILE,
+                        **options):
+    """Writes a standalone Python module to `output_file` containing the
+    analysed grammar and parse tables for the grammar in
+    `grammar_file`, along with the parts of Lark needed to use them.
+    Importing the module requires neither Lark nor any analysis of the
+    grammar. The options are interpreted as by `get_parser`; the
+    grammar hash and table options are recorded in the module so that
+    `get_parser` can tell whether it is up to date.
+
+    """
+    import lark
+    from lark.tools.standalone import gen_standalone
+    grammar = read_grammar(grammar_file)
+    table_options, runtime_options = _split_options(options)
+    parser = lark.Lark(grammar, **table_options, **runtime_options)
+
+    def write(f):
+        f.write("# Generated by fortify.parser.generate_standalone from "
+                "{}; do not edit.\n".format(os.path.basename(grammar_file)))
+        f.write("GRAMMAR_HASH = {!r}\n".format(grammar_hash(grammar)))
+        f.write("TABLE_OPTIONS = {!r}\n".format(
+            _options_repr(table_options)))
+        gen_standalone(parser, out=f, compress=True)
+
+    atomic_write(output_file, write, "w")
+
+
+def get_parser(grammar_file=GRAMMAR_FILE, cache_dir=None, use_cache=True,
+               standalone=STANDALONE_MODULE, intern_names=True, **options):
+    """Returns a Lark parser for the grammar in `grammar_file`. By default
+    a LALR parser starting at the `fortran_file` rule is produced;
+    any keyword arguments are passed on to Lark and override these
+    defaults.
+
+    If the module named by `standalone` was generated (see
+    `generate_standalone`) from the same grammar with the same options,
+    the parser is taken from it. Set `standalone` to None to disable
+    this.
+
+    Otherwise, unless `use_cache` is False, the analysed grammar and
+    parse tables are stored in `cache_dir` (by default, the directory
+    returned by `default_cache_dir`). The cache is keyed on the content
+    of the grammar, the version of Lark, and the options affecting the
+    tables, so it is rebuilt automatically whenever any of these
+    change.
+
+    If the `transformer` option has a `register_rules` method (as does
+    `fortify.ast.ASTBuilder`), it is called with the parser's rules.
+    Passing `lexer=fortify.fortran_lexer.FortranLexer` replaces Lark's
+    contextual lexer with a faster one producing the same tokens.
+
+    Unless `intern_names` is False, the values of name tokens are
+    replaced by canonical, interned, lower-case strings from
+    `fortify.lexers.NAME_TABLE` as they are lexed (see
+    `fortify.lexers.NameTable`). This uses the `postlex` option, so
+    names are not interned if another post-lexer is given.
+
+    """
+    grammar = read_grammar(grammar_file)
+    table_options, runtime_options = _split_options(options)
+    if intern_names and runtime_options.get("postlex") is None:
+        from .lexers import NAME_TABLE
+        runtime_options["postlex"] = NAME_TABLE
+    parser = _get_parser(grammar, cache_dir, use_cache, standalone,
+                         table_options, runtime_options)
+    register_rules = getattr(runtime_options.get("transformer"),
+                             "register_rules", None)
+    if register_rules is not None:
+        register_rules(parser.rules)
+    return parser
+
+
+def _get_parser(grammar, cache_dir, use_cache, standalone, table_options,
+                runtime_options):
+    if standalone:
+        parser = _load_standalone(standalone, grammar, table_options,
+                                  runtime_options)
+        if parser is not None:
+            return parser
+
+    import lark
+    if not use_cache:
+        return lark.Lark(grammar, **table_options, **runtime_options)
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    cache_file = os.path.join(cache_dir, "parser-{}.pickle".format(
+        cache_key(grammar, table_options)))
+    header = _cache_header(grammar, table_options)
+    parser = _load_cached_parser(cache_file, header, runtime_options)
+    if parser is None:
+        parser = lark.Lark(grammar, **table_options, **runtime_options)
+        _save_cached_parser(parser, cache_file, header)
+    return parser
+
+
+_default_parser = None
+
+
+def default_parser():
+    """Returns a parser built by `get_parser` with its default
+    arguments. It is only constructed (or loaded) the first time this
+    function is called.
+
+    """
+    global _default_parser
+    if _default_parser is None:
+        _default_parser = get_parser()
+    return _default_parser
+
+
+def parse(source, parser=None, fixed_form=False, line_length=72):
+    """Parses the Fortran code in the string `source`, returning the
+    resulting tree. If `parser` is not provided then the one returned
+    by `default_parser` is used.
+
+    Continued lines are first joined by
+    `fortify.lexers.join_continuations`, so that tokens may be split
+    across lines. If `fixed_form` is True, the source is instead
+    converted to free form by `fortify.lexers.FixedFormLexer`, with
+    lines truncated at `line_length`. Either way, positions in the tree
+    (and in any error raised) are mapped back to the original source.
+
+    """
+    if parser is None:
+        parser = default_parser()
+    from .lexers import FixedFormLexer, join_continuations
+    if fixed_form:
+        text, offsets = FixedFormLexer(line_length).free_form(source)
+    else:
+        text, offsets = join_continuations(source)
+        if offsets is None:
+            return parser.parse(source)
+    try:
+        tree = parser.parse(text)
+    except Exception as e:
+        raise _map_error(e, offsets)
+    return map_positions(tree, offsets)
+
+
+# Extensions of files assumed to hold fixed-form source
+FIXED_FORM_EXTENSIONS = (".f", ".for", ".fpp", ".ftn", ".f77")
+
+
+def is_fixed_form(path):
+    """Returns whether the file at `path` is assumed, from its
+    extension, to hold fixed-form source.
+
+    """
+    return os.path.splitext(path)[1].lower() in FIXED_FORM_EXTENSIONS
+
+
+class ParseResult(object):
+    """The outcome of parsing the file at `path`. On success `tree` holds
+    the parse tree and `error` is None; on failure `tree` is None and
+    `error` holds the exception which was raised.
+
+    """
+
+    def __init__(self, path, tree=None, error=None):
+        self.path = path
+        self.tree = tree
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "ParseResult({!r}, tree={!r}, error={!r})".format(
+            self.path, self.tree, self.error)
+
+
+def _picklable_error(error):
+    """Returns `error` if it can be sent back from a worker process,
+    otherwise an equivalent RuntimeError.
+
+    """
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError("{}: {}".format(type(error).__name__, error))
+
+
+class ParseCache(object):
+    """An on-disk cache of parse results, stored in `directory` (by
+    default, a `results` directory within `default_cache_dir()`).
+    Entries are keyed on a hash of the source code, the version of
+    fortify, and the grammar and options of the parser producing them,
+    so a result is only reused if the same parser would produce it
+    again. The remaining arguments are those passed to `get_parser` to
+    obtain that parser.
+
+    Once the entries exceed `max_size` bytes, the least recently used
+    are deleted. Entries are written with `atomic_write`, so a cache
+    directory may be shared between concurrent processes.
+
+    """
+
+    def __init__(self, directory=None, max_size=2**30,
+                 grammar_file=GRAMMAR_FILE, cache_dir=None, use_cache=True,
+                 standalone=STANDALONE_MODULE, intern_names=True, **options):
+        import fortify
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), "results")
+        self.directory = directory
+        self.max_size = max_size
+        table_options, runtime_options = _split_options(options)
+        namespace = hashlib.sha256()
+        namespace.update(fortify.__version__.encode("utf-8"))
+        namespace.update(cache_key(read_grammar(grammar_file),
+                                   table_options).encode("utf-8"))
+        namespace.update(_runtime_signature(runtime_options).encode("utf-8"))
+        namespace.update(repr(bool(intern_names)).encode("utf-8"))
+        self.namespace = namespace.hexdigest()
+        self._size = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_size"] = None
+        return state
+
+    def key(self, source, fixed_form=False):
+        """Returns the key for the parse result of `source`, which is in
+        fixed form if `fixed_form` is True.
+
+        """
+        key = hashlib.sha256(self.namespace.encode("utf-8"))
+        if fixed_form:
+            key.update(b"fixed-form\0")
+        key.update(source.encode("utf-8", "surrogatepass"))
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pickle")
+
+    def get(self, source, fixed_form=False):
+        """Returns the cached parse result for `source`, or None if there
+        is none.
+
+        """
+        path = self._path(self.key(source, fixed_form))
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            os.utime(path)
+        except Exception:
+            return None
+        return result
+
+    def put(self, source, result, fixed_form=False):
+        """Stores `result` as the parse result for `source`, evicting the
+        least recently used entries if the cache grows too large. The
+        cache is best-effort, so results which cannot be written (e.g.,
+        which cannot be pickled) are not stored.
+
+        """
+        register_pickling(_standalone_module(result))
+        path = self._path(self.key(source, fixed_form))
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        try:
+            size = atomic_write(path, lambda f: pickle.dump(
+                result, f, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return
+        if self._size is None:
+            self._size = sum(entry[2] for entry in self._entries())
+        else:
+            self._size += size - replaced
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        """Returns a list of (mtime, path, size) tuples for every entry in
+        the cache.
+
+        """
+        entries = []
+        try:
+            subdirs = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for subdir in subdirs:
+            try:
+                names = os.listdir(os.path.join(self.directory, subdir))
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith(".pickle"):
+                    continue
+                path = os.path.join(self.directory, subdir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def evict(self, target=None):
+        """Deletes the least recently used entries until the cache holds at
+        most `target` bytes (by default, 90% of `max_size`).
+
+        """
+        if target is None:
+            target = int(self.max_size * 0.9)
+        entries = self._entries()
+        entries.sort()
+        size = sum(entry[2] for entry in entries)
+        for _, path, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            size -= entry_size
+        self._size = size
+
+
+def _runtime_signature(runtime_options):
+    """Returns a string describing the runtime options passed to a
+    parser, for distinguishing results built with, e.g., different
+    transformers.
+
+    """
+    def describe(value):
+        if value is None or isinstance(value, (bool, int, str)):
+            return repr(value)
+        if isinstance(value, dict):
+            return repr(sorted((key, describe(item))
+                               for key, item in value.items()))
+        cls = type(value) if not isinstance(value, type) else value
+        return cls.__module__ + "." + cls.__qualname__
+
+    return repr(sorted((name, describe(value))
+                       for name, value in runtime_options.items()))
+
+
+def parse_file(path, parser=None, cache=None, fixed_form=None):
+    """Parses the Fortran file at `path`, returning a ParseResult. Errors
+    are recorded in the result rather than raised. If `parser` is not
+    provided then the one returned by `default_parser` is used. If a
+    ParseCache is given as `cache` then results are taken from it
+    where possible and new results are added to it. Unless
+    `fixed_form` is given, the file is parsed as fixed-form source if
+    `is_fixed_form` is true for its path.
+
+    """
+    if fixed_form is None:
+        fixed_form = is_fixed_form(path)
+    try:
+        with open(path, "r") as f:
+            source = f.read()
+        tree = None if cache is None else cache.get(source, fixed_form)
+        if tree is None:
+            tree = parse(source, parser, fixed_form)
+            if cache is not None:
+                cache.put(source, tree, fixed_form)
+        return ParseResult(path, tree)
+    except Exception as e:
+        return ParseResult(path, error=e)
+
+
+_POSITION_ATTRIBUTES = ("line", "column", "end_line", "end_column",
+                        "start_pos", "end_pos")
+
+
+def _make_token(token_class, type_, text, positions, value=None):
+    token = token_class(type_, text, *positions)
+    if value is not None:
+        token.value = sys.intern(value)
+    return token
+
+
+def _reduce_token(token):
+    # The value may differ from the text (e.g., for interned names)
+    text = str.__str__(token)
+    value = token.value if token.value != text else None
+    return _make_token, (type(token), token.type, text,
+                         (token.start_pos, token.line, token.column,
+                          token.end_line, token.end_column, token.end_pos),
+                         value)
+
+
+def _make_tree(tree_class, data, children, positions):
+    tree = tree_class(data, children)
+    for name, value in positions.items():
+        setattr(tree.meta, name, value)
+    if positions:
+        tree.meta.empty = False
+    return tree
+
+
+def _reduce_tree(tree):
+    positions = {}
+    if tree._meta is not None:
+        for name in _POSITION_ATTRIBUTES:
+            value = getattr(tree._meta, name, None)
+            if value is not None:
+                positions[name] = value
+    return _make_tree, (type(tree), tree.data, tree.children, positions)
+
+
+def register_pickling(module=None):
+    """Registers functions to pickle Lark tokens and trees along with all
+    of their position information, which Lark's own pickling discards.
+    The Token and Tree classes registered are those of `module`, which
+    may be a standalone parser module (see `generate_standalone`), or
+    by default those of Lark.
+
+    """
+    if module is None:
+        import lark as module
+    copyreg.pickle(module.Token, _reduce_token)
+    copyreg.pickle(module.Tree, _reduce_tree)
+
+
+def _standalone_module(item):
+    """Returns the standalone parser module defining the class of `item`
+    (a parser or tree), or None if it comes from elsewhere (e.g., Lark).
+
+    """
+    module = sys.modules.get(type(item).__module__)
+    if hasattr(module, "Lark_StandAlone"):
+        return module
+    return None
+
+
+# The parser and result cache used by each worker process in
+# parse_project; they are created once, when the worker starts.
+_worker_parser = None
+_worker_cache = None
+
+
+def _init_worker(parser_kwargs, cache=None):
+    global _worker_parser, _worker_cache
+    _worker_parser = get_parser(**parser_kwargs)
+    register_pickling(_standalone_module(_worker_parser))
+    _worker_cache = cache
+
+
+def _parse_in_worker(path):
+    result = parse_file(path, _worker_parser, _worker_cache)
+    if result.error is not None:
+        result.error = _picklable_error(result.error)
+    return result
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def schedule_files(paths):
+    """Returns `paths` ordered from the largest file to the smallest, so
+    that the longest jobs start first and do not delay the end of a
+    parallel run.
+
+    """
+    return sorted(paths, key=_file_size, reverse=True)
+
+
+def parse_project(paths, jobs=None, cache=None, **parser_kwargs):
+    """Parses each of the Fortran files in `paths` using a pool of `jobs`
+    worker processes (by default, one per CPU), yielding a ParseResult
+    for each file in the order in which they complete. The largest
+    files are scheduled first. Failure to parse a file is reported in
+    its result and does not stop the remaining files being parsed.
+
+    Each worker obtains its parser once, by calling `get_parser` with
+    `parser_kwargs`. These must therefore be picklable. If a ParseCache
+    is provided as `cache` then it is shared by all of the workers; it
+    should have been created with the same `parser_kwargs`. If `jobs`
+    is 1 the files are parsed in the current process instead. Closing
+    the generator early cancels the files which have not yet been
+    started.
+
+    """
+    paths = schedule_files(paths)
+    if jobs == 1:
+        parser = get_parser(**parser_kwargs)
+        for path in paths:
+            yield parse_file(path, parser, cache)
+        return
+
+    if parser_kwargs.get("use_cache", True):
+        # Ensure the cache is populated before the workers start, so
+        # that they load the tables rather than each building them.
+        get_parser(**parser_kwargs)
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker,
+        initargs=(parser_kwargs, cache))
+    try:
+        futures = {executor.submit(_parse_in_worker, path): path
+                   for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            # Drop each future once it is done, so that its tree is not
+            # kept alive for the rest of the project
+            path = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = ParseResult(path, error=e)
+            yield result
+    finally:
+        # If the caller stops early, don't parse the files still queued
+        executor.shutdown(cancel_futures=True)
+
+
+def _positioned(tree):
+    """Yields the objects holding positions in `tree`: its tokens, and
+    the metadata of its nodes (or, for fortify AST nodes, the nodes
+    themselves). Items are recognised by their attributes, so that the
+    tree may come from Lark or from a standalone parser module.
+
+    """
+    stack = [tree]
+    while stack:
+        item = stack.pop()
+        children = getattr(item, "children", None)
+        if children is None:
+            if hasattr(item, "start_pos"):
+                yield item
+            continue
+        meta = getattr(item, "_meta", item)
+        if meta is not None:
+            yield meta
+        stack.extend(children)
+
+
+def rebase_positions(tree, line_offset, column_offset, pos_offset):
+    """Adjusts, in place, the positions of the tokens (and of the nodes,
+    if positions were propagated) in a tree parsed from a fragment of a
+    larger piece of source code. The fragment began at character
+    `pos_offset` of the larger source, `line_offset` lines and
+    `column_offset` columns from its start.
+
+    """
+    for item in _positioned(tree):
+        if getattr(item, "line", None) is not None:
+            if item.line == 1:
+                item.column += column_offset
+            item.line += line_offset
+            item.start_pos += pos_offset
+        if getattr(item, "end_line", None) is not None:
+            if item.end_line == 1:
+                item.end_column += column_offset
+            item.end_line += line_offset
+            item.end_pos += pos_offset
+    return tree
+
+
+def _rebase_error(error, line_offset, column_offset):
+    line = getattr(error, "line", None)
+    if isinstance(line, int) and line > 0:
+        if line == 1:
+            error.column += column_offset
+        error.line += line_offset
+    return error
+
+
+def map_positions(tree, offsets):
+    """Replaces, in place, the positions of the tokens (and of the nodes,
+    if positions were propagated) in a tree parsed from text derived
+    from some original source with the corresponding positions in the
+    original. `offsets` is a `fortify.lexers.OffsetMap` from the
+    derived text to the original.
+
+    """
+    for item in _positioned(tree):
+        start = getattr(item, "start_pos", None)
+        if start is None:
+            continue
+        end = getattr(item, "end_pos", None)
+        item.start_pos, item.line, item.column = offsets.locate(start)
+        if end is not None:
+            item.end_pos, item.end_line, item.end_column = \
+                offsets.locate_end(start, end)
+    return tree
+
+
+def _map_error(error, offsets):
+    pos = getattr(error, "pos_in_stream", None)
+    if isinstance(pos, int) and pos >= 0:
+        error.pos_in_stream, error.line, error.column = offsets.locate(pos)
+    return error
+
+
+def _parse_fragment(parser, text, span):
+    """Parses `text`, the part of some larger source described by `span`
+    (a ProgramUnitSpan), and adjusts the positions in the resulting
+    tree to refer to the larger source.
+
+    """
+    line_offset = span.line - 1
+    column_offset = span.column - 1
+    try:
+        tree = parse(text, parser)
+    except Exception as e:
+        raise _rebase_error(e, line_offset, column_offset)
+    return rebase_positions(tree, line_offset, column_offset, span.start)
+
+
+def _parse_fragment_in_worker(text, span):
+    try:
+        return _parse_fragment(_worker_parser, text, span)
+    except Exception as e:
+        raise _picklable_error(e)
+
+
+def parse_units(source, jobs=None, **parser_kwargs):
+    """Parses the free-form Fortran `source` by splitting it into its
+    top-level program units (see `fortify.lexers.split_program_units`)
+    and parsing each of these separately, using a pool of `jobs` worker
+    processes (by default, one per CPU). The positions in the resulting
+    trees are adjusted to refer to `source` and their program units are
+    combined under a single `fortran_file` node. If `jobs` is 1, or
+    there is only one unit, the units are parsed in the current
+    process. The parser is obtained by calling `get_parser` with
+    `parser_kwargs`.
+
+    """
+    from .lexers import split_program_units
+    spans = [span for span in split_program_units(source)
+             if span.kind is not None]
+    texts = [source[span.start:span.end] for span in spans]
+    if jobs == 1 or len(spans) < 2:
+        parser = get_parser(**parser_kwargs)
+        trees = [_parse_fragment(parser, text, span)
+                 for text, span in zip(texts, spans)]
+    else:
+        if parser_kwargs.get("use_cache", True):
+            get_parser(**parser_kwargs)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_worker,
+                initargs=(parser_kwargs,)) as executor:
+            trees = list(executor.map(_parse_fragment_in_worker, texts,
+                                      spans))
+    children = []
+    for tree in trees:
+        children.extend(tree.children)
+    if trees and getattr(trees[0], "kind", None) is not None:
+        # Nodes built by fortify.ast.ASTBuilder
+        from .ast import spanning_node
+        return spanning_node("fortran_file", children)
+    if trees:
+        tree_class = type(trees[0])
+    else:
+        from lark import Tree as tree_class
+    return tree_class("fortran_file", children)
+
+
+def iter_program_units(stream, parser=None):
+    """A generator which parses the free-form Fortran source read from
+    `stream` (a file object, or any other iterable of lines) and yields
+    the node for each top-level program unit (`main_program`, `module`,
+    `submodule`, `function_subprogram`, `subroutine_subprogram`, or
+    `block_data`) as soon as it has been read, with positions relative
+    to the whole stream. Only the text of the current unit is held in
+    memory, so arbitrarily large sources can be processed one unit at a
+    time. Spans holding no program unit (see `ProgramUnitSpan`) are
+    skipped. If `parser` is not provided then the one returned by
+    `default_parser` is used.
+
+    """
+    from .lexers import ProgramUnitScanner
+    if parser is None:
+        parser = default_parser()
+    scanner = ProgramUnitScanner()
+    lines = []
+    lines_start = 0
+    for line in stream:
+        lines.append(line)
+        spans = scanner.feed(line)
+        if not spans:
+            continue
+        text = "".join(lines)
+        for span in spans:
+            if span.kind is None:
+                continue
+            tree = _parse_fragment(parser, text[span.start - lines_start:
+                                                span.end - lines_start],
+                                   span)
+            for unit in tree.children:
+                yield unit
+        remainder = text[spans[-1].end - lines_start:]
+        lines = [remainder] if remainder else []
+        lines_start = spans[-1].end
+    span = scanner.close()
+    if span is not None and span.kind is not None:
+        tree = _parse_fragment(parser, "".join(lines), span)
+        for unit in tree.children:
+            yield unit
+
+
+def main():
+    """Command-line entry point which generates the standalone parser
+    module from the grammar.
+
+    """
+    arg_parser = argparse.ArgumentParser(
+        description="Generate a standalone parser for the Fortran grammar.")
+    arg_parser.add_argument("--grammar", default=GRAMMAR_FILE,
+                            help="Grammar file to generate the parser from")
+    arg_parser.add_argument("--output", default=STANDALONE_FILE,
+                            help="Python file to write the parser to")
+    args = arg_parser.parse_args()
+    generate_standalone(args.grammar, args.output)
+
+
+if __name__ == "__main__":
+    main()
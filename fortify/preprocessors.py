@@ -0,0 +1,1075 @@
+"""Provides a preprocessor for Fortran source code, understanding the
+C-preprocessor directives commonly used with Fortran (as by `cpp -P
+-traditional` or `fpp`), so that files can be preprocessed without
+running an external program for each of them.
+
+"""
+
+import hashlib
+import operator
+import os
+import pickle
+import re
+
+from ._files import atomic_write
+from .line_map import LineMap
+
+
+# A directive line, with any continuation lines following it
+_DIRECTIVE = re.compile(r"^[ \t]*#[ \t]*([A-Za-z_]\w*|\d+)?(.*)$", re.M)
+_C_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+_NAME = re.compile(r"[A-Za-z_]\w*")
+# The macros whose values depend on where they are used
+_DYNAMIC_MACROS = frozenset(("__FILE__", "__LINE__"))
+_DEFINE = re.compile(r"([A-Za-z_]\w*)(?:\(([^)]*)\))?(.*)", re.S)
+_DEFINED = re.compile(r"\bdefined\b\s*(?:\(\s*([A-Za-z_]\w*)\s*\)|"
+                      r"([A-Za-z_]\w*))")
+_LINE = re.compile(r"(\d+)(?:\s+\"([^\"]*)\")?")
+_INCLUDE = re.compile(r"\"([^\"]+)\"|<([^>]+)>")
+_FORTRAN_INCLUDE = re.compile(r"""^[ \t]*include[ \t]*(?:'([^'\n]+)'|"""
+                              r'''"([^"\n]+)")[ \t]*(?:![^\n]*)?\r?$''',
+                              re.M | re.I)
+_NOT_DEFINED = re.compile(r"!\s*defined\s*(?:\(\s*([A-Za-z_]\w*)\s*\)|"
+                          r"([A-Za-z_]\w*))$")
+# Pieces of (Fortran) text which matter when expanding macros: names,
+# numbers (so that names are not found within them), character
+# literals, and comments.
+_TEXT_PIECES = re.compile(r"""[A-Za-z_]\w*|\d\w*|'(?:[^'\n]|'')*'?|"""
+                          r'''"(?:[^"\n]|"")*"?|![^\n]*''')
+# Pieces of #if expressions which may be macro names
+_EXPRESSION_PIECES = re.compile(r"[A-Za-z_]\w*|\d\w*")
+_OPEN_PARENTHESIS = re.compile(r"[ \t]*\(")
+# Pieces of the arguments to a function-like macro
+_ARGUMENT_PIECES = re.compile(r"""[^'"(),!\n]+|'(?:[^'\n]|'')*'?|"""
+                              r'''"(?:[^"\n]|"")*"?|![^\n]*|[(),\n]''')
+# Tokens in the body of a macro
+_BODY_TOKENS = re.compile(r"""##|#|[A-Za-z_]\w*|\d\w*|'(?:[^']|'')*'?|"""
+                          r'''"(?:[^"]|"")*"?|\s+|.''', re.S)
+_TRAILING_NAME = re.compile(r"[A-Za-z_]\w*$")
+_EXPRESSION_TOKENS = re.compile(r"\s*(?:(0[xX][0-9a-fA-F]+|\d+)[uUlL]*|"
+                                r"([A-Za-z_]\w*)|(\|\||&&|==|!=|<=|>=|<<|"
+                                r">>|[-+*/%<>!~&|^?:()]))")
+
+# The precedence of each binary operator in #if expressions
+_BINARY_PRECEDENCE = {"||": 1, "&&": 2, "|": 3, "^": 4, "&": 5, "==": 6,
+                      "!=": 6, "<": 7, ">": 7, "<=": 7, ">=": 7, "<<": 8,
+                      ">>": 8, "+": 9, "-": 9, "*": 10, "/": 10, "%": 10}
+
+# The binary operators in #if expressions other than the logical,
+# division and shift operators, which need special handling
+_BINARY_OPERATORS = {
+    "|": operator.or_, "^": operator.xor, "&": operator.and_,
+    "==": lambda a, b: int(a == b), "!=": lambda a, b: int(a != b),
+    "<": lambda a, b: int(a < b), ">": lambda a, b: int(a > b),
+    "<=": lambda a, b: int(a <= b), ">=": lambda a, b: int(a >= b),
+    "+": operator.add, "-": operator.sub, "*": operator.mul}
+
+# #if expressions are evaluated in this many bits, as in intmax_t
+_INT_BITS = 64
+
+# Include files may be nested at most this deeply, so that files which
+# include themselves are reported rather than recursing forever
+MAX_INCLUDE_DEPTH = 200
+
+# Increment whenever the layout of SourceFile changes, so that entries
+# stored on disk by other versions are ignored rather than misread.
+INCLUDE_CACHE_VERSION = 1
+
+
+class PreprocessorError(Exception):
+    """An error found while preprocessing line `line` of the file
+    `filename`.
+
+    """
+
+    def __init__(self, message, filename=None, line=None):
+        if filename is not None:
+            message = "{}:{}: {}".format(filename, line, message)
+        super(PreprocessorError, self).__init__(message)
+        self.filename = filename
+        self.line = line
+
+
+class Macro(object):
+    """A macro called `name`, which expands to `body`. Function-like
+    macros have a list of `parameters` (the last of which is
+    `__VA_ARGS__` for variadic macros); for object-like macros it is
+    None.
+
+    """
+
+    def __init__(self, name, body, parameters=None):
+        self.name = name
+        self.body = body
+        self.parameters = parameters
+        self.tokens = _BODY_TOKENS.findall(body)
+
+    @property
+    def variadic(self):
+        return bool(self.parameters) and self.parameters[-1] == "__VA_ARGS__"
+
+    def __eq__(self, other):
+        return isinstance(other, Macro) and self.name == other.name and \
+            self.body == other.body and self.parameters == other.parameters
+
+    def __repr__(self):
+        if self.parameters is None:
+            return "Macro({!r}, {!r})".format(self.name, self.body)
+        return "Macro({!r}, {!r}, {!r})".format(self.name, self.body,
+                                                self.parameters)
+
+
+class _Condition(object):
+    """The state of an #if, #ifdef, or #ifndef group."""
+
+    __slots__ = ("enclosing_active", "taken", "seen_else", "line")
+
+    def __init__(self, enclosing_active, taken, line):
+        self.enclosing_active = enclosing_active
+        self.taken = taken
+        self.seen_else = False
+        self.line = line
+
+
+class _Frame(object):
+    """The state of preprocessing a single (possibly included) file."""
+
+    def __init__(self, filename, parent=None):
+        self.filename = filename
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        # The name and line number reported for a line (changed by
+        # #line) are `presumed` and `line + delta`
+        self.presumed = filename
+        self.delta = 0
+        self.line = 1
+        # Number of lines spanned by the current directive
+        self.directive_lines = 1
+        self.conditions = []
+        self.active = True
+
+    def error(self, message):
+        return PreprocessorError(message, self.presumed,
+                                 self.line + self.delta)
+
+    def position_stack(self, line):
+        """Returns the position_stack (see `fortify.line_map`) of line
+        `line` of the presumed file, given the lines of the enclosing
+        files which included it.
+
+        """
+        stack = [(self.presumed, line)]
+        frame = self.parent
+        while frame is not None:
+            stack.append((frame.presumed, frame.line + frame.delta))
+            frame = frame.parent
+        stack.reverse()
+        return stack
+
+
+def line_marker(line, filename, flag=None):
+    """Returns a line marker, in the form written by the C preprocessor,
+    indicating that the following line is line `line` of `filename`.
+    A `flag` of 1 indicates the start of an included file, and 2 the
+    return to the file which included it.
+
+    """
+    if flag is None:
+        return '# {} "{}"'.format(line, filename)
+    return '# {} "{}" {}'.format(line, filename, flag)
+
+
+def split_regions(source):
+    """Splits `source` into regions, each made up of some text followed
+    by a directive. Returns a list of (start, end, newlines, name, text,
+    lines) tuples, where the text spans from `start` up to `end` in
+    `source` and contains `newlines` line endings. `name` is the name
+    of the directive which follows (the empty string for a null
+    directive, and None after the last region), `text` is the rest of
+    it (with continuation lines joined and comments removed), and
+    `lines` is the number of lines it spans.
+
+    """
+    regions = []
+    search = _DIRECTIVE.search
+    count = source.count
+    length = len(source)
+    pos = 0
+    while True:
+        match = search(source, pos)
+        if match is None:
+            pos = min(pos, length)
+            regions.append((pos, length, count("\n", pos, length), None, "",
+                            0))
+            return regions
+        name = match.group(1) or ""
+        text = match.group(2).rstrip("\r")
+        end = match.end()
+        lines = 1
+        while text.endswith("\\") and end < length:
+            next_end = source.find("\n", end + 1)
+            if next_end < 0:
+                next_end = length
+            text = text[:-1] + source[end + 1:next_end].rstrip("\r")
+            end = next_end
+            lines += 1
+        text = _C_COMMENT.sub(" ", text).strip()
+        regions.append((pos, match.start(), count("\n", pos, match.start()),
+                        name, text, lines))
+        # Move past the line ending
+        pos = end + 1
+
+
+def find_guard(source, regions):
+    """Returns the name of the macro guarding the file with contents
+    `source`, split into `regions` by `split_regions`, or None if it
+    has none. The file is guarded by X if all of its text lies within a
+    single `#ifndef X` (or `#if !defined(X)`) group with no `#else` or
+    `#elif`, so that it has no effect when X is defined.
+
+    """
+    if len(regions) < 3 or regions[-2][3] != "endif":
+        return None
+    start, end, _, name, text, _ = regions[0]
+    if source[start:end].strip():
+        return None
+    start, end = regions[-1][:2]
+    if source[start:end].strip():
+        return None
+    if name == "ifndef":
+        match = _NAME.match(text)
+    elif name == "if":
+        match = _NOT_DEFINED.match(text)
+    else:
+        return None
+    if match is None:
+        return None
+    depth = 0
+    for region in regions[:-2]:
+        name = region[3]
+        if name in ("if", "ifdef", "ifndef"):
+            depth += 1
+        elif name == "endif":
+            depth -= 1
+            if depth == 0:
+                return None
+        elif name in ("elif", "else") and depth == 1:
+            return None
+    if depth != 1:
+        return None
+    return match.group(match.lastindex or 0)
+
+
+class SourceFile(object):
+    """The contents of the file at `path`, prepared for preprocessing:
+    its text (`source`), that text split into `regions` by
+    `split_regions`, and the name of the macro guarding it (see
+    `find_guard`), if any. `mtime` (in nanoseconds) and `size` identify
+    the version of the file which was read.
+
+    """
+
+    def __init__(self, path, source, mtime=None, size=None):
+        self.path = path
+        self.source = source
+        self.mtime = mtime
+        self.size = size
+        self.regions = split_regions(source)
+        self.guard = find_guard(source, self.regions)
+
+
+class IncludeCache(object):
+    """A cache of the SourceFiles of included files, keyed by real path
+    (so that a file reached through different spellings of its path is
+    cached once) and checked against the modification time and size of
+    each file, so that a header included many times is read and split
+    only once. If
+    `directory` is given, entries are also stored there, so that they
+    can be shared between processes (e.g., the workers of a process
+    pool, to which the cache may be pickled), written with
+    `atomic_write`.
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._files = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_files"] = {}
+        return state
+
+    def get(self, path):
+        """Returns the SourceFile for the current contents of the file at
+        `path`.
+
+        """
+        stat = os.stat(path)
+        key = os.path.realpath(path)
+        entry = self._files.get(key)
+        if entry is None or entry.mtime != stat.st_mtime_ns or \
+           entry.size != stat.st_size:
+            entry = self._load(path, stat)
+            if entry is None:
+                with open(path, "r") as f:
+                    source = f.read()
+                entry = SourceFile(path, source, stat.st_mtime_ns,
+                                   stat.st_size)
+                self._save(entry)
+            self._files[key] = entry
+        return entry
+
+    def clear(self):
+        """Discards the entries held in memory."""
+        self._files.clear()
+
+    def _path(self, path):
+        key = hashlib.sha256(os.path.realpath(path).encode(
+            "utf-8", "surrogateescape")).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".pickle")
+
+    def _load(self, path, stat):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(path), "rb") as f:
+                version, entry = pickle.load(f)
+        except Exception:
+            return None
+        if version != INCLUDE_CACHE_VERSION or \
+           entry.mtime != stat.st_mtime_ns or entry.size != stat.st_size:
+            return None
+        entry.path = path
+        return entry
+
+    def _save(self, entry):
+        if self.directory is None:
+            return
+        path = self._path(entry.path)
+        try:
+            atomic_write(path, lambda f: pickle.dump(
+                (INCLUDE_CACHE_VERSION, entry), f,
+                protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            pass
+
+
+# The cache of included files shared by all preprocessors which are
+# not given their own
+INCLUDE_CACHE = IncludeCache()
+
+
+class Preprocessor(object):
+    """Preprocesses Fortran source containing C-preprocessor directives:
+    `#define` and `#undef` of object-like and function-like (including
+    variadic) macros, with `#` and `##` operators; conditional groups
+    using `#if`, `#ifdef`, `#ifndef`, `#elif`, `#else`, and `#endif`;
+    `#include`; `#line`; and `#error`. Macros are expanded outside of
+    character literals and comments.
+
+    Directive and skipped lines are replaced by empty lines, so that
+    line numbers are unchanged, and line markers (`# 1 "file.inc"`)
+    are written where included files start and end, and for `#line`
+    directives. Regions containing no directives and no macro names are
+    copied through untouched. The mapping from lines of the output to
+    positions in the original files is recorded as the output is
+    produced, and left in `line_map` (a `fortify.line_map.LineMap`),
+    so the output need not be scanned for line markers; if
+    `line_markers` is False, they are omitted from the output.
+
+    `include_path` is a list of directories searched for included files
+    (after the directory of the including file, for `#include
+    "file"`). `defines` maps the names of macros defined before
+    preprocessing starts to their bodies. Included files are read
+    through `include_cache` (by default, the process-wide
+    `INCLUDE_CACHE`); those with guard macros which are already defined
+    are skipped without being processed again. If `fortran_includes`
+    is True, Fortran `include 'file'` lines are also replaced by the
+    (preprocessed) contents of the files they name.
+
+    """
+
+    def __init__(self, include_path=(), defines=None, include_cache=None,
+                 fortran_includes=False, line_markers=True):
+        self.include_path = list(include_path)
+        self.line_markers = line_markers
+        self.include_cache = INCLUDE_CACHE if include_cache is None \
+            else include_cache
+        self.fortran_includes = fortran_includes
+        self.defines = {}
+        for name, body in (defines or {}).items():
+            self.define(name, body)
+        self.macros = {}
+        self.line_map = None
+        self._output = None
+        # The number of the next line of output
+        self._line = 1
+        # Handlers for directives, by name. Those which open, switch, or
+        # close conditional groups are run even in skipped regions.
+        self._handlers = {"define": self._define, "undef": self._undef,
+                          "include": self._include,
+                          "line": self._line_directive,
+                          "error": self._error, "pragma": self._ignore,
+                          "warning": self._ignore, "ident": self._ignore}
+        self._conditionals = {"if": self._if, "ifdef": self._ifdef,
+                              "ifndef": self._ifndef, "elif": self._elif,
+                              "else": self._else, "endif": self._endif}
+
+    def define(self, name, body="1"):
+        """Defines a macro, available whenever source is preprocessed. A
+        function-like macro is defined by giving its parameters as part
+        of `name` (e.g., `"MAX(a, b)"`).
+
+        """
+        macro = _parse_define("{} {}".format(name, body))
+        self.defines[macro.name] = macro
+
+    def undefine(self, name):
+        """Removes a macro defined with `define`."""
+        self.defines.pop(name, None)
+
+    def preprocess(self, source, filename="<anonymous>"):
+        """Returns the result of preprocessing the string `source`,
+        which was read from the file `filename` (used to find included
+        files and in line markers).
+
+        """
+        self.macros = dict(self.defines)
+        self._output = []
+        self.line_map = LineMap(self.line_markers)
+        self._line = 1
+        frame = _Frame(filename)
+        self._mark(frame, 1)
+        self._process(SourceFile(filename, source), frame)
+        output = "".join(self._output)
+        self._output = None
+        # self._line is the number of the next line of output, so the
+        # last is only counted if it has no line ending
+        self.line_map.line_count = self._line - (
+            not output or output.endswith("\n"))
+        return output
+
+    def preprocess_file(self, path):
+        """Returns the result of preprocessing the file at `path`."""
+        with open(path, "r") as f:
+            source = f.read()
+        return self.preprocess(source, path)
+
+    def _mark(self, frame, line, flag=None):
+        """Records that the next line of output is line `line` of the
+        file being processed in `frame`, writing a line marker (with
+        `flag`) unless they are disabled.
+
+        """
+        stack = frame.position_stack(line)
+        if self.line_markers:
+            self._output.append(line_marker(line, frame.presumed, flag) +
+                                "\n")
+            self.line_map.add(self._line, stack)
+            self._line += 1
+        else:
+            self.line_map.add(self._line - 1, stack)
+
+    def _process(self, source_file, frame):
+        output = self._output
+        source = source_file.source
+        for start, end, newlines, name, text, lines in source_file.regions:
+            if end > start:
+                if frame.active:
+                    self._text(source, start, end, frame)
+                elif newlines:
+                    output.append("\n" * newlines)
+                frame.line += newlines
+                self._line += newlines
+            if name is None:
+                break
+            frame.directive_lines = lines
+            handler = self._conditionals.get(name)
+            if handler is not None:
+                handler(frame, text)
+                replaced = False
+            elif not frame.active:
+                replaced = False
+            elif name.isdigit():
+                replaced = self._line_directive(frame, name + " " + text)
+            elif not name:
+                if text:
+                    raise frame.error("invalid preprocessing directive")
+                replaced = False
+            else:
+                handler = self._handlers.get(name)
+                if handler is None:
+                    raise frame.error("invalid preprocessing directive #{}"
+                                      .format(name))
+                replaced = handler(frame, text)
+            # Handlers return whether they have replaced the first line
+            # of the directive
+            blank = lines - 1 if replaced else lines
+            if blank:
+                output.append("\n" * blank)
+                self._line += blank
+            frame.line += lines
+        if frame.conditions:
+            raise PreprocessorError("unterminated conditional directive",
+                                    frame.presumed, frame.conditions[-1].line)
+
+    def _text(self, source, start, end, frame):
+        """Copies the text between `start` and `end` in `source` to the
+        output, expanding macros and (if enabled) Fortran include
+        lines.
+
+        """
+        if self.fortran_includes:
+            line = frame.line
+            # Line endings already counted in self._line, which the
+            # caller counts again
+            counted = 0
+            for match in _FORTRAN_INCLUDE.finditer(source, start, end):
+                self._copy(source, start, match.start(), frame)
+                newlines = source.count("\n", start, match.start())
+                frame.line += newlines
+                self._line += newlines
+                counted += newlines
+                name = match.group(1) or match.group(2)
+                start = match.end()
+                if self._insert(self._find_include(name, frame, False),
+                                frame) and start < end:
+                    # The include line has been replaced, so its line
+                    # ending is removed
+                    start += 1
+                    counted += 1
+                    frame.line += 1
+            self._copy(source, start, end, frame)
+            self._line -= counted
+            frame.line = line
+        else:
+            self._copy(source, start, end, frame)
+
+    def _copy(self, source, start, end, frame):
+        """Copies the text between `start` and `end` in `source` to the
+        output, expanding any macros.
+
+        """
+        if end <= start:
+            return
+        names = set(_NAME.findall(source, start, end))
+        if names.isdisjoint(self.macros) and \
+           names.isdisjoint(_DYNAMIC_MACROS):
+            self._output.append(source[start:end])
+        else:
+            self._output.append(self._expand(source[start:end], frozenset(),
+                                             frame))
+
+    def _expand(self, text, disabled, frame, tokens=_TEXT_PIECES,
+                line=None):
+        """Returns `text` with the macros in it (other than those in
+        `disabled`) expanded. `tokens` matches the pieces of `text`
+        which may be macro names, along with those (such as character
+        literals) in which names are not expanded. `text` begins on line
+        `line` (by default, the current line of `frame`); this is the
+        line of the invocation when expanding the body or arguments of a
+        macro.
+
+        """
+        macros = self.macros
+        pieces = []
+        pos = 0
+        # The number of line endings in the calls of function-like
+        # macros spanning lines which are missing from their expansions,
+        # to be added after the end of the line so that later lines are
+        # not moved
+        deferred = 0
+        if line is None and frame is not None:
+            line = frame.line + frame.delta
+        # The offset in `text` up to which lines have been counted
+        counted = 0
+        for match in tokens.finditer(text):
+            start = match.start()
+            if start < pos:
+                # Consumed as the arguments of a macro
+                continue
+            name = match.group()
+            if name in disabled:
+                continue
+            macro = macros.get(name)
+            if line is not None:
+                line += text.count("\n", counted, start)
+                counted = start
+            if macro is None:
+                if name == "__LINE__" and line is not None:
+                    replacement = str(line)
+                elif name == "__FILE__" and frame is not None:
+                    replacement = '"{}"'.format(frame.presumed)
+                else:
+                    continue
+                end = match.end()
+            elif macro.parameters is None:
+                end = match.end()
+                replacement = self._expand(macro.body, disabled | {name},
+                                           frame, tokens, line)
+                # The expansion may end with the name of a function-like
+                # macro, whose arguments follow it
+                trailing = _TRAILING_NAME.search(replacement)
+                if trailing:
+                    inner = macros.get(trailing.group())
+                    if inner is not None and inner.parameters is not None \
+                       and inner.name not in disabled:
+                        arguments = _arguments(text, end, inner, frame, line)
+                        if arguments is not None:
+                            args, end = arguments
+                            replacement = replacement[:trailing.start()] + \
+                                self._substitute(inner, args, disabled,
+                                                 frame, tokens, line)
+            else:
+                arguments = _arguments(text, match.end(), macro, frame,
+                                       line)
+                if arguments is None:
+                    continue
+                args, end = arguments
+                replacement = self._substitute(macro, args, disabled, frame,
+                                               tokens, line)
+            newlines = text.count("\n", start, end)
+            if newlines:
+                if replacement.count("\n") > newlines:
+                    # An argument spanning lines was used more than once
+                    replacement = replacement.replace("\n", " ")
+                newlines -= replacement.count("\n")
+            before = text[pos:start]
+            pieces.append(_add_line_endings(before, deferred))
+            if "\n" in before:
+                deferred = 0
+            pieces.append(replacement)
+            deferred += newlines
+            pos = end
+        if not pieces:
+            return text
+        pieces.append(_add_line_endings(text[pos:], deferred, True))
+        return "".join(pieces)
+
+    def _substitute(self, macro, args, disabled, frame, tokens, line):
+        """Returns the expansion of the function-like `macro` called with
+        the (unexpanded) arguments `args` on line `line`.
+
+        """
+        parameters = macro.parameters
+        if macro.variadic and len(args) >= len(parameters):
+            args = args[:len(parameters) - 1] + \
+                [",".join(args[len(parameters) - 1:])]
+        elif macro.variadic and len(args) == len(parameters) - 1:
+            args = args + [""]
+        if args == [""] and not parameters:
+            args = []
+        if len(args) != len(parameters):
+            raise _preprocessor_error(
+                "macro {} takes {} arguments but {} were given".format(
+                    macro.name, len(parameters), len(args)), frame)
+        raw = dict(zip(parameters, (arg.strip() for arg in args)))
+        expanded = {}
+        body = macro.tokens
+        pieces = []
+        i = 0
+        count = len(body)
+        while i < count:
+            token = body[i]
+            following = _next_token(body, i)
+            if token == "#" and following is not None and \
+               body[following] in raw:
+                value = raw[body[following]]
+                pieces.append('"{}"'.format(value.replace("\\", "\\\\")
+                                            .replace('"', '\\"')))
+                i = following + 1
+                continue
+            if token == "##" and following is not None:
+                while pieces and pieces[-1].isspace():
+                    pieces.pop()
+                token = body[following]
+                pieces.append(raw.get(token, token))
+                i = following + 1
+                continue
+            if token in raw:
+                if following is not None and body[following] == "##":
+                    pieces.append(raw[token])
+                else:
+                    if token not in expanded:
+                        expanded[token] = self._expand(raw[token], disabled,
+                                                       frame, tokens, line)
+                    pieces.append(expanded[token])
+            else:
+                pieces.append(token)
+            i += 1
+        return self._expand("".join(pieces), disabled | {macro.name}, frame,
+                            tokens, line)
+
+    def _define(self, frame, text):
+        if not _NAME.match(text):
+            raise frame.error("macro names must be identifiers")
+        macro = _parse_define(text)
+        self.macros[macro.name] = macro
+
+    def _undef(self, frame, text):
+        match = _NAME.match(text)
+        if not match:
+            raise frame.error("macro names must be identifiers")
+        self.macros.pop(match.group(), None)
+
+    def _include(self, frame, text):
+        match = _INCLUDE.match(text)
+        if match is None:
+            match = _INCLUDE.match(self._expand(text, frozenset(),
+                                                frame).strip())
+        if match is None:
+            raise frame.error('#include expects "FILENAME" or <FILENAME>')
+        path = self._find_include(match.group(1) or match.group(2), frame,
+                                  match.group(1) is None)
+        return self._insert(path, frame)
+
+    def _insert(self, path, frame):
+        """Writes the contents of the file at `path`, included by the
+        current line of the file being processed in `frame`, to the
+        output. Returns whether that line has been replaced; it is not
+        if the file has already been included and its guard macro is
+        defined.
+
+        """
+        if frame.depth >= MAX_INCLUDE_DEPTH:
+            raise frame.error("#include nested too deeply")
+        included = self.include_cache.get(path)
+        if included.guard is not None and included.guard in self.macros:
+            return False
+        inner = _Frame(path, frame)
+        self._mark(inner, 1, 1)
+        self._process(included, inner)
+        source = included.source
+        start, end = included.regions[-1][:2]
+        if end > start and not source.endswith("\n"):
+            self._output.append("\n")
+            self._line += 1
+        self._mark(frame, frame.line + frame.delta + 1, 2)
+        return True
+
+    def _find_include(self, name, frame, system):
+        """Returns the path of the file included as `name` from the file
+        being processed in `frame`. Unless `system` is True (for
+        `#include <name>`), the directory of that file is searched first.
+
+        """
+        if os.path.isabs(name):
+            if os.path.isfile(name):
+                return name
+        else:
+            directories = self.include_path
+            if not system:
+                directories = [os.path.dirname(frame.filename)] + directories
+            for directory in directories:
+                path = os.path.join(directory, name)
+                if os.path.isfile(path):
+                    return path
+        raise frame.error("{}: No such file or directory".format(name))
+
+    def _line_directive(self, frame, text):
+        match = _LINE.match(text)
+        if match is None:
+            match = _LINE.match(self._expand(text, frozenset(),
+                                             frame).strip())
+        if match is None:
+            raise frame.error('#line expects a line number and optional '
+                              '"FILENAME"')
+        line = int(match.group(1))
+        if match.group(2) is not None:
+            frame.presumed = match.group(2)
+        lines = frame.directive_lines
+        frame.delta = line - frame.line - lines
+        self._mark(frame, line - lines + 1)
+        return True
+
+    def _error(self, frame, text):
+        raise frame.error("#error {}".format(text))
+
+    def _ignore(self, frame, text):
+        pass
+
+    def _if(self, frame, text):
+        taken = frame.active and bool(self.evaluate(text, frame))
+        frame.conditions.append(_Condition(frame.active, taken,
+                                           frame.line + frame.delta))
+        frame.active = taken
+
+    def _ifdef(self, frame, text):
+        self._if_defined(frame, text, True)
+
+    def _ifndef(self, frame, text):
+        self._if_defined(frame, text, False)
+
+    def _if_defined(self, frame, text, defined):
+        match = _NAME.match(text)
+        if frame.active and not match:
+            raise frame.error("macro names must be identifiers")
+        taken = frame.active and (match.group() in self.macros) == defined
+        frame.conditions.append(_Condition(frame.active, taken,
+                                           frame.line + frame.delta))
+        frame.active = taken
+
+    def _elif(self, frame, text):
+        condition = self._current_condition(frame, "#elif")
+        if condition.seen_else:
+            raise frame.error("#elif after #else")
+        if condition.taken or not condition.enclosing_active:
+            frame.active = False
+        else:
+            frame.active = condition.taken = bool(self.evaluate(text, frame))
+
+    def _else(self, frame, text):
+        condition = self._current_condition(frame, "#else")
+        if condition.seen_else:
+            raise frame.error("#else after #else")
+        condition.seen_else = True
+        frame.active = condition.enclosing_active and not condition.taken
+        condition.taken = True
+
+    def _endif(self, frame, text):
+        condition = self._current_condition(frame, "#endif")
+        frame.conditions.pop()
+        frame.active = condition.enclosing_active
+
+    def _current_condition(self, frame, directive):
+        if not frame.conditions:
+            raise frame.error("{} without #if".format(directive))
+        return frame.conditions[-1]
+
+    def evaluate(self, expression, frame=None):
+        """Returns the (integer) value of the controlling `expression` of
+        an #if or #elif directive, given the macros currently defined.
+
+        """
+        def defined(match):
+            name = match.group(1) or match.group(2)
+            return "1" if name in self.macros else "0"
+
+        text = self._expand(_DEFINED.sub(defined, expression), frozenset(),
+                            frame, _EXPRESSION_PIECES)
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = _EXPRESSION_TOKENS.match(text, pos)
+            if match is None:
+                raise _preprocessor_error(
+                    "invalid token in expression: {!r}".format(
+                        text[pos:].strip()), frame)
+            number, name, operator = match.groups()
+            if number is not None:
+                try:
+                    tokens.append(int(number, 0)
+                                  if number[:2] in ("0x", "0X")
+                                  else int(number, 8 if number[0] == "0"
+                                           else 10))
+                except ValueError:
+                    raise _preprocessor_error(
+                        "invalid integer constant {!r} in expression"
+                        .format(number), frame)
+            elif name is not None:
+                # Names which are not macros evaluate to zero
+                tokens.append(0)
+            else:
+                tokens.append(operator)
+            pos = match.end()
+        if not tokens:
+            raise _preprocessor_error("#if with no expression", frame)
+        return _Expression(tokens, frame).parse()
+
+
+def _parse_define(text):
+    """Returns the Macro defined by the text of a #define directive."""
+    name, parameters, body = _DEFINE.match(text).groups()
+    if parameters is not None:
+        parameters = [parameter.strip() for parameter in
+                      parameters.split(",")]
+        if parameters == [""]:
+            parameters = []
+        elif parameters[-1] == "...":
+            parameters[-1] = "__VA_ARGS__"
+    return Macro(name, body.strip(), parameters)
+
+
+def _add_line_endings(text, count, at_end=False):
+    """Returns `text` with `count` line endings added after its first
+    line, or (if `at_end` is set and it has only one line) at its end.
+
+    """
+    if not count:
+        return text
+    newline = text.find("\n")
+    if newline >= 0:
+        return text[:newline] + "\n" * count + text[newline:]
+    return text + "\n" * count if at_end else text
+
+
+def _arguments(text, pos, macro, frame, line):
+    """Returns the arguments of a call, on line `line` of the file being
+    processed in `frame`, of the function-like `macro` whose name ends
+    at `pos` in `text`, and the position following them, or None if the
+    name is not followed by an argument list. The arguments may span
+    lines (e.g., with Fortran continuations), whose endings are kept in
+    them; it is an error for them to run to the end of `text`.
+
+    """
+    match = _OPEN_PARENTHESIS.match(text, pos)
+    if match is None:
+        return None
+    args = []
+    current = []
+    depth = 0
+    for piece in _ARGUMENT_PIECES.finditer(text, match.end()):
+        value = piece.group()
+        if value == ")" and depth == 0:
+            args.append("".join(current))
+            return args, piece.end()
+        if value == "," and depth == 0:
+            args.append("".join(current))
+            current = []
+            continue
+        if value == "(":
+            depth += 1
+        elif value == ")":
+            depth -= 1
+        current.append(value)
+    message = "unterminated argument list invoking macro {}".format(
+        macro.name)
+    if frame is None:
+        raise PreprocessorError(message)
+    raise PreprocessorError(message, frame.presumed, line)
+
+
+def _next_token(tokens, index):
+    """Returns the index of the first token after `index` which is not
+    whitespace, or None.
+
+    """
+    for i in range(index + 1, len(tokens)):
+        if not tokens[i].isspace():
+            return i
+    return None
+
+
+def _preprocessor_error(message, frame):
+    if frame is None:
+        return PreprocessorError(message)
+    return frame.error(message)
+
+
+def _wrap(value):
+    """Returns `value` reduced to a signed integer of `_INT_BITS` bits."""
+    sign = 1 << (_INT_BITS - 1)
+    return ((value + sign) & ((1 << _INT_BITS) - 1)) - sign
+
+
+def _c_division(a, b):
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+class _Expression(object):
+    """Evaluates the tokens of an #if expression (integers and operator
+    strings) by precedence climbing, following the rules of C, with
+    64-bit signed arithmetic.
+
+    """
+
+    def __init__(self, tokens, frame):
+        self.tokens = tokens
+        self.pos = 0
+        self.frame = frame
+
+    def parse(self):
+        value = self.conditional(True)
+        if self.pos < len(self.tokens):
+            raise self.error("unexpected {!r} in expression".format(
+                self.tokens[self.pos]))
+        return value
+
+    def error(self, message):
+        return _preprocessor_error(message, self.frame)
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise self.error("expected {!r} in expression".format(token))
+        self.pos += 1
+
+    def conditional(self, evaluate):
+        condition = self.binary(1, evaluate)
+        if self.peek() != "?":
+            return condition
+        self.pos += 1
+        true_value = self.conditional(evaluate and bool(condition))
+        self.expect(":")
+        false_value = self.conditional(evaluate and not condition)
+        return true_value if condition else false_value
+
+    def binary(self, precedence, evaluate):
+        left = self.unary(evaluate)
+        while True:
+            operator = self.peek()
+            operator_precedence = _BINARY_PRECEDENCE.get(operator) \
+                if isinstance(operator, str) else None
+            if operator_precedence is None or \
+               operator_precedence < precedence:
+                return left
+            self.pos += 1
+            if operator == "&&":
+                right = self.binary(operator_precedence + 1,
+                                    evaluate and bool(left))
+                left = int(bool(left) and bool(right))
+            elif operator == "||":
+                right = self.binary(operator_precedence + 1,
+                                    evaluate and not left)
+                left = int(bool(left) or bool(right))
+            else:
+                right = self.binary(operator_precedence + 1, evaluate)
+                left = self.apply(operator, left, right, evaluate)
+
+    def apply(self, operator, left, right, evaluate):
+        if operator in ("/", "%") and right == 0:
+            if evaluate:
+                raise self.error("division by zero in #if")
+            return 0
+        if operator == "/":
+            return _wrap(_c_division(left, right))
+        if operator == "%":
+            return left - right * _c_division(left, right)
+        if operator in ("<<", ">>"):
+            if not 0 <= right < _INT_BITS:
+                if evaluate:
+                    raise self.error("shift count {} out of range in #if"
+                                     .format(right))
+                return 0
+            if operator == "<<":
+                return _wrap(left << right)
+            return left >> right
+        return _wrap(_BINARY_OPERATORS[operator](left, right))
+
+    def unary(self, evaluate):
+        token = self.peek()
+        if token is None:
+            raise self.error("unexpected end of expression")
+        self.pos += 1
+        if isinstance(token, int):
+            return _wrap(token)
+        if token == "(":
+            value = self.conditional(evaluate)
+            self.expect(")")
+            return value
+        if token == "!":
+            return int(not self.unary(evaluate))
+        if token == "~":
+            return ~self.unary(evaluate)
+        if token == "-":
+            return _wrap(-self.unary(evaluate))
+        if token == "+":
+            return self.unary(evaluate)
+        raise self.error("unexpected {!r} in expression".format(token))
@@ -1,3 +1,41 @@
+import os
+import sys
+
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+
+
+class BuildPy(build_py):
+    """Builds the package, generating the standalone parser module (see
+    `fortify.parser.generate_standalone`) within it so that installed
+    copies of fortify need not build or load the parse tables (if the
+    installed version of Lark can analyse the grammar).
+
+    """
+
+    def run(self):
+        build_py.run(self)
+        if self.dry_run:
+            return
+        sys.path.insert(0, os.path.abspath(self.build_lib))
+        try:
+            from fortify import parser
+        finally:
+            del sys.path[0]
+        package_dir = os.path.join(self.build_lib, "fortify")
+        output = os.path.join(package_dir, "_standalone_parser.py")
+        try:
+            parser.generate_standalone(
+                os.path.join(package_dir,
+                             os.path.basename(parser.GRAMMAR_FILE)),
+                output)
+        except Exception as e:
+            # fortify still works without the module, building or
+            # loading the tables when first needed
+            self.warn("not generating the standalone parser: {}".format(e))
+            return
+        self.announce("generated {}".format(output), 2)
+
 
-setup(name="fortify", packages=find_packages())
+setup(name="fortify", packages=find_packages(),
+      package_data={"fortify": ["*.lark"]}, cmdclass={"build_py": BuildPy})
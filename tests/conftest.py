@@ -0,0 +1,31 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from toy_fortran import TOY_GRAMMAR
+
+
+@pytest.fixture(scope="session")
+def toy_grammar_file(tmp_path_factory):
+    """Fixture writing the toy grammar to a file and returning its path."""
+    path = tmp_path_factory.mktemp("grammar") / "toy.lark"
+    path.write_text(TOY_GRAMMAR)
+    return str(path)
@@ -0,0 +1,108 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Tests for the AST nodes in fortify.ast.
+
+"""
+
+import pickle
+
+from fortify import ast
+from fortify import parser as fparser
+
+from toy_fortran import TOY_SOURCE
+
+
+def test_inline_builder_matches_transform(toy_grammar_file, tmp_path):
+    tree = fparser.get_parser(toy_grammar_file,
+                              use_cache=False).parse(TOY_SOURCE)
+    expected = ast.ASTBuilder().transform(tree)
+    inline = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path),
+                                transformer=ast.ASTBuilder())
+    result = inline.parse(TOY_SOURCE)
+    assert isinstance(result, ast.Node)
+    assert result == expected
+    assert [node.kind for node in result.children] == ["module",
+                                                       "main_program"]
+
+
+def test_node_positions(toy_grammar_file):
+    inline = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                transformer=ast.ASTBuilder())
+    module = inline.parse(TOY_SOURCE).children[0]
+    assignment = [node for node in module.iter_subtrees()
+                  if node.kind == "assignment_stmt"][0]
+    assert (assignment.line, assignment.column) == (3, 3)
+    assert (assignment.end_line, assignment.end_column) == (3, 8)
+    assert TOY_SOURCE[assignment.start_pos:assignment.end_pos] == "a = 1"
+
+
+def test_node_classes_have_slots_and_fields(toy_grammar_file):
+    inline = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                transformer=ast.ASTBuilder())
+    module = inline.parse(TOY_SOURCE).children[0]
+    assert type(module).__name__ == "Module"
+    assert not hasattr(module, "__dict__")
+    assert set(type(module).fields) >= {"module_stmt", "contains_stmt",
+                                        "subroutine_subprogram",
+                                        "assignment_stmt", "call_stmt",
+                                        "end_module_stmt"}
+    assert module.module_stmt.children == ["toy"]
+    assert module.function_subprogram is None
+    subroutine = module.subroutine_subprogram
+    assert subroutine.kind == "subroutine_subprogram"
+    assert len(module.children_of_kind("subroutine_subprogram")) == 1
+
+
+def test_parse_units_builds_nodes(toy_grammar_file, tmp_path):
+    source = TOY_SOURCE + "subroutine t; call u; end\n"
+    whole = fparser.get_parser(toy_grammar_file, use_cache=False,
+                               transformer=ast.ASTBuilder()).parse(source)
+    for jobs in (1, 2):
+        tree = fparser.parse_units(source, jobs=jobs,
+                                   grammar_file=toy_grammar_file,
+                                   cache_dir=str(tmp_path),
+                                   transformer=ast.ASTBuilder())
+        assert type(tree) is type(whole)
+        assert tree == whole
+        assert (tree.line, tree.column, tree.start_pos, tree.end_line,
+                tree.end_column, tree.end_pos) == \
+            (whole.line, whole.column, whole.start_pos, whole.end_line,
+             whole.end_column, whole.end_pos)
+
+
+def test_nodes_are_hashable(toy_grammar_file):
+    inline = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                transformer=ast.ASTBuilder())
+    tree = inline.parse(TOY_SOURCE)
+    kinds = {node: node.kind for node in tree.iter_subtrees()}
+    assert kinds[tree.children[0]] == "module"
+    assert hash(tree) == hash(inline.parse(TOY_SOURCE))
+
+
+def test_nodes_pickle(toy_grammar_file):
+    inline = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                transformer=ast.ASTBuilder())
+    tree = inline.parse(TOY_SOURCE)
+    copy = pickle.loads(pickle.dumps(tree))
+    assert copy == tree
+    assert type(copy.children[0]) is type(tree.children[0])
+    assert copy.children[0].start_pos == tree.children[0].start_pos
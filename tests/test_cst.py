@@ -0,0 +1,136 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+"""Tests for the lossless concrete syntax trees in fortify.cst.
+
+"""
+
+import pytest
+
+from fortify import cst
+from fortify import parser as fparser
+from fortify.cst import build_cst, parse_cst
+
+from toy_fortran import TOY_FIXED_SOURCE, TOY_SOURCE
+
+CONTINUED_SOURCE = """program p
+  x = a + & ! first
+      ! own line
+
+      b
+  call fo&
+    &o(1, 'st&
+    &r')  ! trailing
+end
+"""
+
+
+@pytest.fixture
+def toy_parser(toy_grammar_file):
+    return fparser.get_parser(toy_grammar_file, use_cache=False,
+                              keep_all_tokens=True)
+
+
+@pytest.mark.parametrize("source, fixed_form", [
+    (TOY_SOURCE, False), (CONTINUED_SOURCE, False),
+    (TOY_FIXED_SOURCE, True), ("\n  ! nothing\n", False)])
+def test_round_trip(toy_parser, source, fixed_form):
+    root = parse_cst(source, toy_parser, fixed_form)
+    assert str(root) == source
+    pieces = [node.source[node.leading:node.trailing]
+              for node in root.iter_subtrees() if node.is_token]
+    assert "".join(pieces) == source or not pieces
+    for node in root.iter_subtrees():
+        assert node.source is source
+        if node.leading is not None:
+            assert str(node) == source[node.leading:node.trailing]
+            assert node.text == source[node.start:node.end]
+
+
+def test_trivia(toy_parser):
+    root = parse_cst(TOY_SOURCE, toy_parser)
+    newline = root.children[0]
+    assert newline.kind == "_NL"
+    assert newline.leading_trivia == "! A small program"
+    module = root.find("module")[0]
+    assert module.leading_trivia == ""
+    assert module.text.startswith("module toy\n")
+    assert module.text.endswith("end module toy")
+    call = module.find("call_stmt")[0]
+    assert call.text == "call f(x + 1)"
+    assert call.leading_trivia == "    "
+    assert [str(token) for token in call.find("add")[0].children] == \
+        ["x ", "+ ", "1"]
+    root = parse_cst(CONTINUED_SOURCE, toy_parser)
+    add = root.find("add")[0]
+    assert add.children[1].trailing_trivia == " & ! first\n"
+    assert add.children[2].leading_trivia == "      ! own line\n\n      "
+    assert root.find("call_stmt")[0].text == "call fo&\n    &o(1, 'st&\n" \
+        "    &r')"
+
+
+def test_replace(toy_parser):
+    source = "program main\n  a = b + 1  ! keep\n  call s(2)\nend\n"
+    root = parse_cst(source, toy_parser)
+    add = root.find("add")[0]
+    new = add.replace("c")
+    assert new.parent is root.find("assignment_stmt")[0]
+    assert add.parent is None
+    assert str(root) == \
+        "program main\n  a = c  ! keep\n  call s(2)\nend\n"
+
+    # Replace a statement by a subtree parsed from other code, which
+    # keeps the trivia of the statement replaced
+    other = parse_cst("program q\n\n   call t(x, y) ! lost\nend\n",
+                      toy_parser)
+    call = root.find("call_stmt")[0]
+    new = call.replace(other.find("call_stmt")[0])
+    assert [node.kind for node in new.iter_subtrees()] == \
+        [node.kind for node in other.find("call_stmt")[0].iter_subtrees()]
+    assert new.text == "call t(x, y)"
+    assert str(root) == \
+        "program main\n  a = c  ! keep\n  call t(x, y)\nend\n"
+    # Untouched nodes are still printed from the original source
+    assert root.find("end_program_stmt")[0].source is source
+    with pytest.raises(ValueError):
+        new.replace(root)
+
+
+def test_default_parser_is_reused(toy_parser, monkeypatch):
+    calls = []
+
+    def get_parser(**kwargs):
+        calls.append(kwargs)
+        return toy_parser
+
+    monkeypatch.setattr(cst, "get_parser", get_parser)
+    monkeypatch.setattr(cst, "_default_parser", None)
+    for _ in range(3):
+        assert str(parse_cst(TOY_SOURCE)) == TOY_SOURCE
+    assert calls == [{"keep_all_tokens": True}]
+
+
+def test_build_cst_with_dropped_tokens(toy_grammar_file):
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False)
+    source = "program p\n  call s( 1 )\nend program\n"
+    root = build_cst(fparser.parse(source, parser), source)
+    call = root.find("call_stmt")[0]
+    assert [token.text for token in call.children] == ["s", "1"]
+    assert call.leading_trivia == "  call "
+    assert str(root) == source
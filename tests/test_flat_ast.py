@@ -0,0 +1,79 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Tests for the array-based trees in fortify.flat_ast.
+
+"""
+
+import numpy as np
+
+from fortify import ast
+from fortify import parser as fparser
+from fortify.flat_ast import FlatTree
+
+from toy_fortran import TOY_SOURCE
+
+
+def test_structure_matches_lark_tree(toy_grammar_file):
+    tree = fparser.get_parser(toy_grammar_file,
+                              use_cache=False).parse(TOY_SOURCE)
+    flat = FlatTree.from_tree(tree)
+    assert len(flat) == sum(1 for _ in tree.iter_subtrees()) + \
+        sum(1 for _ in tree.scan_values(lambda v: True))
+
+    def compare(item, view):
+        if hasattr(item, "children"):
+            assert view.kind == item.data
+            assert not view.is_token
+            assert len(view.children) == len(item.children)
+            for child, child_view in zip(item.children, view.children):
+                assert child_view.parent == view
+                compare(child, child_view)
+        else:
+            assert view.kind == item.type
+            assert view.value == item
+            assert (view.start, view.end) == (item.start_pos, item.end_pos)
+
+    compare(tree, flat.root)
+    assert flat.root.parent is None
+    assert np.all(flat.subtree_end[1:] <= flat.subtree_end[0])
+
+
+def test_find_within_node(toy_grammar_file):
+    builder = ast.ASTBuilder()
+    first = fparser.get_parser(toy_grammar_file, use_cache=False,
+                               transformer=builder).parse(TOY_SOURCE)
+    second = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                transformer=builder).parse(
+                                    "program p\ncall a; call b\nend\n")
+    flat = FlatTree.from_trees([first, second])
+    assert flat.root.kind == "project"
+    assert [child.kind for child in flat.root.children] == ["fortran_file",
+                                                            "fortran_file"]
+    assert len(flat.find("call_stmt")) == 4
+    module = flat[int(flat.find("module")[0])]
+    calls = module.find("call_stmt")
+    assert len(calls) == 1
+    assert calls[0].children[0].value == "f"
+    assert TOY_SOURCE[calls[0].start:calls[0].end] == "f(x + 1"
+    assert flat.mask("module").sum() == 1
+    assert len(flat.find("no_such_kind")) == 0
+    assert flat.strings.count("x") == 1
@@ -0,0 +1,79 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Benchmarks the cost of importing fortify, enforcing a budget so that
+light-weight users (e.g., of line mapping) are not slowed down by the
+parser.
+
+"""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+# Maximum time, in seconds, which importing the lightweight parts of
+# fortify may take. This is generous, to avoid spurious failures on
+# slow machines; the actual cost should be a few milliseconds.
+IMPORT_BUDGET = 0.1
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+{}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "modules": list(sys.modules)}}))
+"""
+
+
+def time_import(statement, repeats=5):
+    """Returns the fastest time taken to execute `statement` in a fresh
+    interpreter, along with the modules loaded in that interpreter.
+
+    """
+    best = None
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c",
+                                 SCRIPT.format(statement)],
+                                check=True, stdout=subprocess.PIPE).stdout
+        result = json.loads(output)
+        if best is None or result["elapsed"] < best["elapsed"]:
+            best = result
+    return best["elapsed"], best["modules"]
+
+
+@pytest.mark.parametrize("statement", ["import fortify",
+                                       "import fortify.line_map",
+                                       "from fortify import line_map"])
+def test_import_budget(statement):
+    elapsed, modules = time_import(statement)
+    assert "lark" not in modules
+    assert "fortify.parser" not in modules
+    assert elapsed < IMPORT_BUDGET
+
+
+def test_lazy_submodule_access():
+    import fortify
+    assert fortify.parser.__name__ == "fortify.parser"
+    assert "line_map" in dir(fortify)
+    with pytest.raises(AttributeError):
+        fortify.not_a_module
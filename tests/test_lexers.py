@@ -0,0 +1,311 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Tests for the scanners and lexers in fortify.lexers.
+
+"""
+
+import pickle
+
+import lark
+import pytest
+
+from fortify import lexers
+from fortify.fortran_lexer import FortranLexer
+from fortify import parser as fparser
+
+from toy_fortran import TOY_FIXED_SOURCE, TOY_SOURCE
+
+TRICKY_SOURCE = """module a
+  character(len=*), parameter :: s = 'end module a; &
+  &program x'
+  x = "!end"; y = 1 ! end
+contains
+  pure integer(kind=8) function f(x) result(y)
+  end function
+  module procedure foo
+  end procedure
+end &
+  & module a; subroutine b
+  call c('it''s')
+end
+ integer i
+ end
+function g()
+endfunction g
+! Trailing comment
+"""
+
+
+def test_split_toy_source():
+    spans = lexers.split_program_units(TOY_SOURCE)
+    assert [(span.kind, span.name) for span in spans] == \
+        [("module", "toy"), ("main_program", "main")]
+    assert spans[0].start == 0
+    assert spans[1].start == spans[0].end
+    assert spans[1].end == len(TOY_SOURCE)
+    assert TOY_SOURCE[spans[1].start:].lstrip().startswith("program main")
+    assert spans[1].line == 9
+
+
+def test_split_respects_strings_comments_and_continuations():
+    spans = lexers.split_program_units(TRICKY_SOURCE)
+    assert [(span.kind, span.name) for span in spans] == \
+        [("module", "a"), ("subroutine_subprogram", "b"),
+         ("main_program", None), ("function_subprogram", "g"),
+         (None, None)]
+    assert TRICKY_SOURCE[spans[0].start:spans[0].end].endswith("module a;")
+    assert (spans[1].line, spans[1].column) == (11, 14)
+    assert TRICKY_SOURCE[spans[1].start:spans[1].end] == \
+        " subroutine b\n  call c('it''s')\nend\n"
+    assert TRICKY_SOURCE[spans[-1].start:] == "! Trailing comment\n"
+
+
+def test_split_with_type_bound_procedures_and_interfaces():
+    source = """module m
+  type, extends(base) :: t
+    integer :: i
+  contains
+    procedure :: a
+  end type t
+  type u
+  end type
+  type(t) :: x
+  interface gen
+    module procedure a
+  end interface gen
+  abstract interface
+    subroutine s()
+    end subroutine
+  end interface
+contains
+  subroutine a(self)
+    select type (self)
+    type is (t)
+    end select
+  end subroutine
+end module m
+program main
+end program main
+"""
+    spans = lexers.split_program_units(source)
+    assert [(span.kind, span.name) for span in spans] == \
+        [("module", "m"), ("main_program", "main")]
+    assert source[spans[1].start:] == "program main\nend program main\n"
+
+
+def test_split_with_stray_end_statements():
+    source = "! comment\nend subroutine s\nend\nend program p\n"
+    spans = lexers.split_program_units(source)
+    assert [(span.kind, span.name, span.line) for span in spans] == \
+        [(None, None, 1), ("main_program", None, 3),
+         ("main_program", "p", 4)]
+
+
+def test_scanner_feeds_incrementally():
+    scanner = lexers.ProgramUnitScanner()
+    completed = []
+    for line in TOY_SOURCE.splitlines(True):
+        completed.append([span.kind for span in scanner.feed(line)])
+    assert completed[7] == ["module"]
+    assert completed[-1] == ["main_program"]
+    assert scanner.close() is None
+
+
+def test_name_table_canonicalises():
+    table = lexers.NameTable()
+    first = table.canonical("Foo")
+    assert first == "foo"
+    assert table.canonical("FOO") is first
+    assert table.canonical("foo") is first
+    assert table.canonical("bar") == "bar"
+    assert len(table) == 2
+
+
+def test_parser_interns_names(toy_grammar_file, tmp_path):
+    source = "program Main\n  X = x + MAIN\nend program MAIN\n"
+    parser = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    tree = parser.parse(source)
+    names = list(tree.scan_values(lambda v: getattr(v, "type", None) ==
+                                  "NAME"))
+    assert [str(name) for name in names] == ["Main", "X", "x", "MAIN",
+                                             "MAIN"]
+    assert names[0].value is names[3].value is names[4].value
+    assert names[1].value is names[2].value == "x"
+    fparser.register_pickling()
+    copy = pickle.loads(pickle.dumps(tree))
+    copied = list(copy.scan_values(lambda v: getattr(v, "type", None) ==
+                                   "NAME"))
+    assert [str(name) for name in copied] == ["Main", "X", "x", "MAIN",
+                                              "MAIN"]
+    assert copied[0].value is names[0].value
+
+    plain = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path),
+                               intern_names=False)
+    name = next(plain.parse(source).scan_values(
+        lambda v: getattr(v, "type", None) == "NAME"))
+    assert name.value == "Main"
+
+
+LEXER_SOURCES = [TOY_SOURCE,
+                 "program endx\n  endx = END + 'x' &\n  & + 3\nend\n",
+                 "PROGRAM Main\n  Call s(1); x = 2\nEND PROGRAM main\n",
+                 # Lark splits a keyword from a following name when no
+                 # name is allowed
+                 "program p\nend programp\n"]
+
+
+def lexed_tokens(tree):
+    return [(token.type, str(token), token.value, token.line, token.column,
+             token.end_line, token.end_column, token.start_pos, token.end_pos)
+            for token in tree.scan_values(lambda v: v is not None)]
+
+
+def test_fortran_lexer_matches_lark(toy_grammar_file, tmp_path):
+    lark_parser = fparser.get_parser(toy_grammar_file,
+                                     cache_dir=str(tmp_path))
+    for _ in range(2):
+        # The second parser is loaded from the cache
+        parser = fparser.get_parser(toy_grammar_file,
+                                    cache_dir=str(tmp_path),
+                                    lexer=FortranLexer)
+        for source in LEXER_SOURCES:
+            tree = parser.parse(source)
+            assert tree == lark_parser.parse(source)
+            assert lexed_tokens(tree) == lexed_tokens(
+                lark_parser.parse(source))
+
+
+@pytest.mark.parametrize("source,error", [
+    ("program main\n  x = = 1\nend\n", lark.exceptions.UnexpectedToken),
+    ("program main\n  x = $ 1\nend\n", lark.exceptions.UnexpectedCharacters),
+])
+def test_fortran_lexer_errors(toy_grammar_file, tmp_path, source, error):
+    parser = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path),
+                                lexer=FortranLexer)
+    with pytest.raises(error) as info:
+        parser.parse(source)
+    assert (info.value.line, info.value.column) == (2, 7)
+
+
+def test_fixed_form_classify():
+    lexer = lexers.FixedFormLexer()
+    assert lexer.classify("") == (lexers.BLANK_LINE, 0)
+    assert lexer.classify("C comment") == (lexers.COMMENT_LINE, 0)
+    assert lexer.classify("*") == (lexers.COMMENT_LINE, 0)
+    assert lexer.classify("   ! comment") == (lexers.COMMENT_LINE, 0)
+    assert lexer.classify("      x = 1") == (lexers.INITIAL_LINE, 6)
+    assert lexer.classify("     0x = 1") == (lexers.INITIAL_LINE, 6)
+    assert lexer.classify("  100 x = 1") == (lexers.LABELLED_LINE, 6)
+    assert lexer.classify("     &+ 1") == (lexers.CONTINUATION_LINE, 6)
+    assert lexer.classify("10\tx = 1") == (lexers.LABELLED_LINE, 3)
+    assert lexer.classify("\t1+ 1") == (lexers.CONTINUATION_LINE, 2)
+    assert lexer.classify(" " * 72 + "x") == (lexers.BLANK_LINE, 0)
+
+
+def test_fixed_form_free_form():
+    text, offsets = lexers.FixedFormLexer().free_form(TOY_FIXED_SOURCE)
+    assert [line.rstrip() for line in text.splitlines()] == [
+        "!     A small program",
+        "      PROGRAM MAIN",
+        "      X = 'abc!def' + Y   + 1  + ZZ",
+        "! trailing",
+        "!     inside",
+        "      CALL S(1)",
+        "      END"]
+    for offset, char in enumerate(text):
+        original, line, column = offsets.locate(offset)
+        lines = TOY_FIXED_SOURCE.splitlines(True)
+        assert lines[line - 1][column - 1] == TOY_FIXED_SOURCE[original]
+        if char not in "!\n":
+            assert TOY_FIXED_SOURCE[original] == char
+    start = text.index("ZZ")
+    assert offsets.locate(start)[1:] == (6, 11)
+    assert offsets.locate_end(start, start + 2)[1:] == (7, 8)
+
+
+FIXED_FORM_LINES = ["", "   ", "C comment", "*", "   ! comment", "      x = 1",
+                    "     0x = 1", "  100 x = 1", "     &+ 1", "10\tx = 1",
+                    "\t1+ 1", " " * 72 + "x", "      s = 'a!b' ! c",
+                    "    1", "      x = 1\r", "      y = 'é'"]
+
+
+def test_classify_fixed_form():
+    lexer = lexers.FixedFormLexer()
+    source = "\n".join(FIXED_FORM_LINES) + "\n"
+    lines = lexers.classify_fixed_form(source)
+    assert list(zip(lines.kinds.tolist(), lines.fields.tolist())) == \
+        [lexer.classify(line.rstrip("\r")) for line in FIXED_FORM_LINES]
+    assert [source[start:end] for start, end in
+            zip(lines.starts.tolist(), lines.ends.tolist())] == \
+        [line.rstrip("\r") for line in FIXED_FORM_LINES]
+
+
+@pytest.mark.parametrize("source", [
+    TOY_FIXED_SOURCE, TOY_FIXED_SOURCE.rstrip("\n"),
+    TOY_FIXED_SOURCE.replace("\n", "\r\n"),
+    "\n".join(FIXED_FORM_LINES), "     1 x\n     2 y\n      z\n", ""])
+def test_vectorised_fixed_form(source):
+    by_line = lexers.FixedFormLexer()
+    by_line.vectorize_threshold = float("inf")
+    vectorised = lexers.FixedFormLexer()
+    vectorised.vectorize_threshold = 0
+    text, offsets = by_line.free_form(source)
+    vector_text, vector_offsets = vectorised.free_form(source)
+    assert vector_text == text
+    assert vector_offsets.offsets == offsets.offsets
+    assert vector_offsets.original_offsets == offsets.original_offsets
+    assert vector_offsets.line_starts == offsets.line_starts
+
+
+CONTINUED_SOURCE = """program p
+  x = 1 + & ! first
+     ! own line
+
+      2
+  call fo&
+    &o(a, 'str&
+    &ing & ''q''', "x!y")  ! trailing
+  y = 'no & here'
+end
+"""
+
+
+def test_join_continuations():
+    text, offsets = lexers.join_continuations(CONTINUED_SOURCE)
+    assert text.splitlines() == [
+        "program p",
+        "  x = 1 +       2",
+        "! first",
+        "     ! own line",
+        "",
+        "  call foo(a, 'string & ''q''', \"x!y\")  ! trailing",
+        "  y = 'no & here'",
+        "end"]
+    for offset, char in enumerate(text):
+        assert CONTINUED_SOURCE[offsets.original_offset(offset)] == char
+    start = text.index("foo")
+    assert offsets.locate(start)[1:] == (6, 8)
+    assert offsets.locate_end(start, start + 3)[1:] == (7, 7)
+    assert lexers.join_continuations(TOY_SOURCE) == (TOY_SOURCE, None)
+    assert lexers.join_continuations("x = 'a & b'\n")[1] is None
+    text, offsets = lexers.join_continuations("x = a &\n! end")
+    assert text == "x = a \n! end"
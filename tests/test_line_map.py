@@ -0,0 +1,274 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+
+"""Tests for the mapping of preprocessed lines in fortify.line_map.
+
+"""
+
+import mmap
+
+import pytest
+
+from fortify.lexers import join_continuations
+from fortify.line_map import (LineDirective, LineMap, SourceMap,
+                              _decode_vlq, _encode_vlq, create_line_map)
+from fortify.preprocessors import Preprocessor
+
+from test_lexers import CONTINUED_SOURCE
+
+
+CPP_OUTPUT = """# 1 "main.F90"
+program p
+# 1 "a.h" 1
+a1
+
+# 4 "a.h"
+a4
+# 1 "b.h" 1
+b1
+# 5 "a.h" 2
+a5
+# 3 "main.F90" 2
+m3
+#line 40 "gen.F90"
+g40
+g41
+"""
+
+
+def test_create_line_map():
+    line_map = create_line_map(CPP_OUTPUT, "main.F90")
+    expected = {2: [("main.F90", 1)],
+                4: [("main.F90", 2), ("a.h", 1)],
+                7: [("main.F90", 2), ("a.h", 4)],
+                9: [("main.F90", 2), ("a.h", 5), ("b.h", 1)],
+                11: [("main.F90", 2), ("a.h", 5)],
+                13: [("main.F90", 3)],
+                15: [("gen.F90", 40)], 16: [("gen.F90", 41)]}
+    for line, stack in expected.items():
+        assert line_map.map_line(line) == stack
+    assert line_map.files == ["main.F90", "a.h", "b.h", "gen.F90"]
+    assert line_map.stacks == [(), (("main.F90", 2),),
+                               (("main.F90", 2), ("a.h", 5))]
+
+
+def test_create_line_map_without_directives():
+    line_map = create_line_map("a\nb\n", "x.f90")
+    assert line_map.map_line(2) == [("x.f90", 2)]
+    assert len(line_map) == 1
+
+
+def test_include_stack_table():
+    line_map = create_line_map(CPP_OUTPUT, "main.F90")
+    assert list(line_map.stack_parents) == [-1, 0, 1]
+    assert [line_map.files[i] for i in line_map.stack_file_ids[1:]] == \
+        ["main.F90", "a.h"]
+    assert list(line_map.stack_lines) == [0, 2, 5]
+    file_id, line, stack_id = line_map.locate(9)
+    assert (line_map.files[file_id], line, stack_id) == ("b.h", 1, 2)
+    assert line_map.stack(stack_id) == [("main.F90", 2), ("a.h", 5)]
+    assert line_map.stack(0) == []
+    # Deep include chains share the entries of their enclosing stacks
+    source = "".join('# 1 "h{}.h" 1\nx\n'.format(i) for i in range(50))
+    deep = create_line_map(source, "main.F90")
+    assert len(deep.stack_parents) == 51
+    assert deep.map_line(100) == [("main.F90", 1)] + [
+        ("h{}.h".format(i), 2) for i in range(49)] + [("h49.h", 1)]
+
+
+@pytest.mark.parametrize("kind", ["bytes", "mmap", "text file",
+                                  "binary file", "lines"])
+def test_create_line_map_streaming(tmp_path, kind):
+    path = tmp_path / "out.f90"
+    path.write_bytes(CPP_OUTPUT.encode())
+    expected = create_line_map(CPP_OUTPUT, "main.F90")
+    with open(str(path), "rb") as f:
+        if kind == "bytes":
+            line_map = create_line_map(f.read(), "main.F90")
+        elif kind == "mmap":
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                line_map = create_line_map(m, "main.F90")
+        elif kind == "text file":
+            with open(str(path)) as text:
+                line_map = create_line_map(text, "main.F90")
+        elif kind == "binary file":
+            line_map = create_line_map(f, "main.F90")
+        else:
+            line_map = create_line_map(CPP_OUTPUT.splitlines(), "main.F90")
+    assert line_map.directives == expected.directives
+    assert line_map.files == expected.files
+    assert line_map.line_count == expected.line_count == 16
+    assert create_line_map(b"a\n# 3 \"b.h\"\nb", "x.f90").line_count == 3
+
+
+@pytest.mark.parametrize("source", [
+    "m1\n#include \"a.h\"\n#line 10\nm10\n#include \"b.h\"\nm12\n",
+    "m1\n#line 7 \"z.f\"\nz7\n#include \"a.h\"\nz9\n#line 3 \"y.f\"\ny3\n"])
+def test_create_line_map_matches_preprocessor(tmp_path, source):
+    (tmp_path / "a.h").write_text("a1\n#include \"b.h\"\na3\n")
+    (tmp_path / "b.h").write_text("b1\nb2\n")
+    path = str(tmp_path / "main.F90")
+    preprocessor = Preprocessor()
+    output = preprocessor.preprocess(source, path)
+    scanned = create_line_map(output, path)
+    for line in range(2, output.count("\n") + 1):
+        assert scanned.map_line(line) == preprocessor.line_map.map_line(line)
+
+
+@pytest.mark.parametrize("line_markers", [True, False])
+def test_generated_lines(tmp_path, line_markers):
+    (tmp_path / "a.h").write_text("a1\na2\n")
+    path = str(tmp_path / "main.F90")
+    header = str(tmp_path / "a.h")
+    preprocessor = Preprocessor(line_markers=line_markers)
+    output = preprocessor.preprocess(
+        "m1\n#include \"a.h\"\nm3\n#include \"a.h\"\nm5\n", path)
+    line_map = preprocessor.line_map
+    lines = output.splitlines()
+    assert line_map.line_count == len(lines)
+    expected = {}
+    for number, text in enumerate(lines, 1):
+        if not text.startswith("#"):
+            position = line_map.map_line(number)[-1]
+            expected.setdefault(position, []).append(number)
+    for (filename, line), numbers in expected.items():
+        assert line_map.generated_lines(filename, line) == numbers
+    assert [lines[n - 1] for n in line_map.generated_lines(header, 2)] == \
+        ["a2", "a2"]
+    assert line_map.generated_lines(header, 3) == []
+    assert line_map.generated_lines(path, 6) == []
+    assert line_map.generated_lines("other.h", 1) == []
+    scanned = create_line_map(output, path)
+    if line_markers:
+        for (filename, line), numbers in expected.items():
+            assert scanned.generated_lines(filename, line) == numbers
+
+
+def test_line_map_from_directives():
+    directives = [LineDirective(0, [("a", 1)]),
+                  LineDirective(3, [("a", 3), ("b", 1)]),
+                  LineDirective(5, [("a", 3), ("b", 10)])]
+    line_map = LineMap.from_directives(directives)
+    assert line_map.map_line(1) == directives[0].map_line(1) == [("a", 1)]
+    assert line_map.map_line(5) == [("a", 3), ("b", 2)]
+    assert line_map.map_line(8) == [("a", 3), ("b", 12)]
+    assert line_map.stacks == [(), (("a", 3),)]
+    assert [(d.source_line, d.position_stack)
+            for d in line_map.directives] == \
+        [(d.source_line, d.position_stack) for d in directives]
+    with pytest.raises(ValueError):
+        line_map.map_line(0)
+    with pytest.raises(ValueError):
+        line_map.add(4, [("a", 1)])
+
+
+def test_map_lines():
+    line_map = create_line_map(CPP_OUTPUT, "main.F90")
+    lines = list(range(1, CPP_OUTPUT.count("\n") + 1))
+    file_ids, original_lines, stack_ids = line_map.map_lines(lines)
+    assert len(file_ids) == len(original_lines) == len(stack_ids) == \
+        len(lines)
+    for line, file_id, original, stack_id in zip(lines, file_ids,
+                                                 original_lines, stack_ids):
+        assert line_map.position_stack(file_id, original, stack_id) == \
+            line_map.map_line(line)
+    assert [len(result) for result in line_map.map_lines([])] == [0, 0, 0]
+    with pytest.raises(ValueError):
+        line_map.map_lines([3, 0])
+
+
+def test_vlq():
+    pieces = []
+    for value in (0, 1, -1, 15, 16, -1000):
+        _encode_vlq(value, pieces)
+    assert pieces == ["A", "C", "D", "e", "g", "B", "x", "+", "B"]
+    assert _decode_vlq("".join(pieces)) == [0, 1, -1, 15, 16, -1000]
+
+
+def test_source_map():
+    source_map = SourceMap()
+    source_map.add(1, 1, "main.F90", 1, 1)
+    # An expanded macro, then the rest of the line and following lines
+    source_map.add(1, 5, "defs.h", 3, 18)
+    source_map.add(1, 12, "main.F90", 1, 7)
+    # The same header line, included again
+    source_map.add(4, 1, "defs.h", 3, 18)
+    source_map.add(4, 8, "main.F90", 5, 1)
+    assert source_map.original_position(1, 3) == ("main.F90", 1, 3)
+    assert source_map.original_position(1, 6) == ("defs.h", 3, 19)
+    assert source_map.original_position(3, 9) == ("main.F90", 3, 9)
+    assert source_map.original_position(4, 2) == ("defs.h", 3, 19)
+    assert source_map.original_position(6, 1) == ("main.F90", 7, 1)
+    assert source_map.generated_position("main.F90", 1, 8) == (1, 13)
+    assert source_map.generated_position("main.F90", 3, 2) == (3, 2)
+    assert source_map.generated_position("main.F90", 5, 3) == (4, 10)
+    assert source_map.generated_position("main.F90", 4, 2) is None
+    assert source_map.generated_position("defs.h", 3, 20) in ((1, 7), (4, 3))
+    assert source_map.generated_position("defs.h", 1, 1) is None
+    assert source_map.generated_position("other.h", 1, 1) is None
+    with pytest.raises(ValueError):
+        source_map.add(4, 7, "main.F90", 1, 1)
+
+    decoded = SourceMap.decode(source_map.encode())
+    assert decoded.files == source_map.files
+    for name in ("generated", "file_ids", "original_lines",
+                 "original_columns"):
+        assert getattr(decoded, name) == getattr(source_map, name)
+
+
+def test_source_map_generated_positions():
+    # Lines of a header copied repeatedly among lines of the main file,
+    # with one segment of the main file long enough to span most others
+    source_map = SourceMap()
+    source_map.add(1, 1, "main.F90", 1, 1)
+    source_map.add(2, 1, "main.F90", 2, 1)
+    for i in range(200):
+        source_map.add(3 + 2 * i, 1, "defs.h", 1 + i % 7, 1)
+        source_map.add(4 + 2 * i, 1, "main.F90", 1 + i % 50, 3)
+        source_map.add(4 + 2 * i, 5, "main.F90", 100, 1)
+    copied = {source_map.original_position(line, column)
+              for line in range(1, 405) for column in range(1, 13)}
+    for filename, lines in (("main.F90", 110), ("defs.h", 10)):
+        for line in range(1, lines):
+            for column in range(1, 7):
+                position = (filename, line, column)
+                result = source_map.generated_position(*position)
+                if result is None:
+                    assert position not in copied
+                else:
+                    assert source_map.original_position(*result) == \
+                        position
+    assert source_map.generated_position("main.F90", 99, 1) is None
+
+
+def test_source_map_from_offset_map():
+    text, offsets = join_continuations(CONTINUED_SOURCE)
+    source_map = SourceMap.from_offset_map(offsets, text, "c.f90")
+    for line, line_text in enumerate(text.split("\n"), 1):
+        line_start = sum(len(previous) + 1
+                         for previous in text.split("\n")[:line - 1])
+        for column in range(1, len(line_text) + 1):
+            original = offsets.locate(line_start + column - 1)
+            assert source_map.original_position(line, column) == \
+                ("c.f90",) + original[1:]
+            assert source_map.generated_position("c.f90", *original[1:]) \
+                == (line, column)
@@ -0,0 +1,452 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""Tests for the construction and caching of parsers.
+
+"""
+
+import io
+import os
+import subprocess
+import sys
+
+import lark
+import pytest
+
+from fortify import parser as fparser
+
+from toy_fortran import TOY_FIXED_SOURCE, TOY_GRAMMAR, TOY_SOURCE
+
+
+def cache_files(cache_dir):
+    return [name for name in os.listdir(cache_dir)
+            if name.endswith(".pickle")]
+
+
+def test_uncached_parser(toy_grammar_file):
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False)
+    tree = parser.parse(TOY_SOURCE)
+    assert tree.data == "fortran_file"
+    assert [unit.data for unit in tree.children] == ["module",
+                                                     "main_program"]
+
+
+def test_cache_written_and_reused(toy_grammar_file, tmp_path):
+    first = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    assert len(cache_files(tmp_path)) == 1
+    second = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    assert len(cache_files(tmp_path)) == 1
+    assert second.source_path == "<deserialized>"
+    assert first.parse(TOY_SOURCE) == second.parse(TOY_SOURCE)
+
+
+def test_cache_rebuilt_when_grammar_changes(tmp_path):
+    grammar_file = tmp_path / "toy.lark"
+    grammar_file.write_text(TOY_GRAMMAR)
+    cache_dir = str(tmp_path / "cache")
+    fparser.get_parser(str(grammar_file), cache_dir=cache_dir)
+    grammar_file.write_text(TOY_GRAMMAR + "\n// A changed grammar\n")
+    parser = fparser.get_parser(str(grammar_file), cache_dir=cache_dir)
+    assert parser.source_path != "<deserialized>"
+    assert len(cache_files(cache_dir)) == 2
+
+
+def test_corrupt_cache_is_ignored(toy_grammar_file, tmp_path):
+    fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    cache_file = os.path.join(str(tmp_path), cache_files(tmp_path)[0])
+    with open(cache_file, "wb") as f:
+        f.write(b"not a pickle")
+    parser = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    assert parser.parse(TOY_SOURCE).data == "fortran_file"
+
+
+def test_runtime_options_applied_to_cached_parser(toy_grammar_file,
+                                                  tmp_path):
+    class Counter(lark.Transformer):
+        def call_stmt(self, children):
+            return "call"
+
+    fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    parser = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path),
+                                transformer=Counter())
+    assert parser.source_path == "<deserialized>"
+    tree = parser.parse(TOY_SOURCE)
+    assert tree.children[1].children[1] == "call"
+
+
+def test_standalone_parser_used_when_current(toy_grammar_file, tmp_path,
+                                             monkeypatch):
+    output = tmp_path / "toy_standalone.py"
+    fparser.generate_standalone(toy_grammar_file, str(output))
+    source = output.read_text()
+    assert "import lark" not in source and "from lark" not in source
+    monkeypatch.syspath_prepend(str(tmp_path))
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                standalone="toy_standalone")
+    assert type(parser).__module__ == "toy_standalone"
+    tree = parser.parse(TOY_SOURCE)
+    assert [unit.data for unit in tree.children] == ["module",
+                                                     "main_program"]
+
+
+@pytest.fixture
+def standalone_parser(toy_grammar_file, tmp_path, monkeypatch):
+    """Fixture returning a parser for the toy grammar from a generated
+    standalone module.
+
+    """
+    fparser.generate_standalone(toy_grammar_file,
+                                str(tmp_path / "toy_standalone.py"))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "toy_standalone", raising=False)
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                standalone="toy_standalone")
+    assert not isinstance(parser, lark.Lark)
+    return parser
+
+
+def token_positions(tree):
+    """Returns the text and positions of the tokens in `tree`, which may
+    come from Lark or a standalone parser.
+
+    """
+    positions = []
+    stack = [tree]
+    while stack:
+        item = stack.pop()
+        if hasattr(item, "children"):
+            stack.extend(reversed(item.children))
+        elif item is not None:
+            positions.append((str(item), item.line, item.column,
+                              item.end_line, item.end_column,
+                              item.start_pos, item.end_pos))
+    return positions
+
+
+def test_standalone_parser_does_not_import_lark(toy_grammar_file,
+                                                tmp_path):
+    fparser.generate_standalone(toy_grammar_file,
+                                str(tmp_path / "toy_standalone.py"))
+    script = "\n".join([
+        "import sys",
+        "from fortify import parser",
+        "p = parser.get_parser({!r}, use_cache=False,",
+        "                      standalone='toy_standalone')",
+        "tree = parser.parse({!r}, p)",
+        "assert type(p).__module__ == 'toy_standalone'",
+        "assert [unit.data for unit in tree.children] == ['main_program']",
+        "assert 'lark' not in sys.modules, 'lark imported'"]).format(
+            toy_grammar_file, "program main\n  x = 1\nend\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmp_path),
+                                                       root]))
+    subprocess.run([sys.executable, "-c", script], check=True, env=env)
+
+
+def test_stale_standalone_parser_ignored(tmp_path, monkeypatch):
+    grammar_file = tmp_path / "toy.lark"
+    grammar_file.write_text(TOY_GRAMMAR)
+    fparser.generate_standalone(str(grammar_file),
+                                str(tmp_path / "stale_standalone.py"))
+    grammar_file.write_text(TOY_GRAMMAR + "\n// A changed grammar\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    parser = fparser.get_parser(str(grammar_file), use_cache=False,
+                                standalone="stale_standalone")
+    assert isinstance(parser, lark.Lark)
+    assert parser.parse(TOY_SOURCE).data == "fortran_file"
+
+
+def write_project(directory):
+    """Writes some files to `directory`, returning their paths and the
+    path of a file which cannot be parsed.
+
+    """
+    paths = []
+    for i in range(4):
+        path = directory / "file{}.f90".format(i)
+        path.write_text("program p{}\n".format(i) + "  a = 1\n" * i +
+                        "end program\n")
+        paths.append(str(path))
+    bad = directory / "bad.f90"
+    bad.write_text("program bad\n  a = = 1\nend program\n")
+    paths.append(str(bad))
+    return paths, str(bad)
+
+
+def test_parse_project(toy_grammar_file, tmp_path):
+    paths, bad = write_project(tmp_path)
+    results = list(fparser.parse_project(
+        paths, jobs=2, grammar_file=toy_grammar_file,
+        cache_dir=str(tmp_path / "cache")))
+    assert sorted(result.path for result in results) == sorted(paths)
+    for result in results:
+        if result.path == bad:
+            assert not result.ok
+            assert result.tree is None
+        else:
+            assert result.ok
+            assert result.tree.children[0].data == "main_program"
+
+
+def test_parse_project_largest_first(toy_grammar_file, tmp_path):
+    paths, bad = write_project(tmp_path)
+    results = list(fparser.parse_project(
+        paths, jobs=1, grammar_file=toy_grammar_file, use_cache=False))
+    sizes = [os.path.getsize(result.path) for result in results]
+    assert sizes == sorted(sizes, reverse=True)
+
+
+def test_parse_project_missing_file(toy_grammar_file, tmp_path):
+    results = list(fparser.parse_project(
+        [str(tmp_path / "missing.f90")], jobs=2,
+        grammar_file=toy_grammar_file, cache_dir=str(tmp_path)))
+    assert len(results) == 1
+    assert isinstance(results[0].error, OSError)
+
+
+def test_parse_project_stopped_early(toy_grammar_file, tmp_path):
+    paths = []
+    for i in range(40):
+        path = tmp_path / "file{}.f90".format(i)
+        path.write_text("program p{}\n".format(i) + "  a = 1\n" * 2000 +
+                        "end program\n")
+        paths.append(str(path))
+    kwargs = {"grammar_file": toy_grammar_file,
+              "cache_dir": str(tmp_path / "cache")}
+    cache = fparser.ParseCache(str(tmp_path / "results"), **kwargs)
+    results = fparser.parse_project(paths, jobs=2, cache=cache, **kwargs)
+    assert next(results).ok
+    results.close()
+    parsed = sum(len(files) for _, _, files in
+                 os.walk(str(tmp_path / "results")))
+    assert parsed < len(paths)
+
+
+def test_parse_units_matches_whole_file(toy_grammar_file, tmp_path):
+    source = TOY_SOURCE + "subroutine t; call u; end; program q\nend\n"
+    whole = fparser.get_parser(toy_grammar_file,
+                               use_cache=False).parse(source)
+    for jobs in (1, 2):
+        split = fparser.parse_units(source, jobs=jobs,
+                                    grammar_file=toy_grammar_file,
+                                    cache_dir=str(tmp_path))
+        assert split == whole
+        assert token_positions(split) == token_positions(whole)
+
+
+def test_iter_program_units(toy_grammar_file):
+    source = TOY_SOURCE + "subroutine t; call u; end; program q\nend\n"
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False)
+    whole = parser.parse(source)
+    lines_read = []
+
+    def lines():
+        for line in io.StringIO(source):
+            lines_read.append(line)
+            yield line
+
+    units = fparser.iter_program_units(lines(), parser)
+    first = next(units)
+    assert first == whole.children[0]
+    assert len(lines_read) == 8
+    rest = list(units)
+    assert [unit.data for unit in rest] == ["main_program",
+                                            "subroutine_subprogram",
+                                            "main_program"]
+    assert token_positions(lark.Tree("fortran_file", [first] + rest)) == \
+        token_positions(whole)
+
+
+def test_iter_program_units_skips_stray_end(toy_grammar_file):
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False)
+    source = "end subroutine s\n" + TOY_SOURCE + "end module\n"
+    units = list(fparser.iter_program_units(io.StringIO(source), parser))
+    whole = parser.parse(TOY_SOURCE)
+    assert [unit.data for unit in units] == ["module", "main_program"]
+    assert [(text, line - 1, column) for unit in units
+            for text, line, column in
+            (position[:3] for position in token_positions(unit))] == \
+        [position[:3] for position in token_positions(whole)]
+
+
+def test_program_units_with_standalone_parser(toy_grammar_file,
+                                              standalone_parser):
+    source = TOY_SOURCE + "subroutine t; call u; end; program q\nend\n"
+    whole = token_positions(fparser.get_parser(
+        toy_grammar_file, use_cache=False).parse(source))
+    units = list(fparser.iter_program_units(io.StringIO(source),
+                                            standalone_parser))
+    main = units[1].children[0].children[0]
+    assert (str(main), main.line, main.column) == ("main", 10, 9)
+    assert [position for unit in units
+            for position in token_positions(unit)] == whole
+    for jobs in (1, 2):
+        tree = fparser.parse_units(source, jobs=jobs,
+                                   grammar_file=toy_grammar_file,
+                                   use_cache=False,
+                                   standalone="toy_standalone")
+        assert type(tree) is type(units[0])
+        assert token_positions(tree) == whole
+
+
+def test_parse_cache_round_trip(toy_grammar_file, tmp_path):
+    cache = fparser.ParseCache(str(tmp_path), grammar_file=toy_grammar_file)
+    tree = fparser.get_parser(toy_grammar_file,
+                              use_cache=False).parse(TOY_SOURCE)
+    assert cache.get(TOY_SOURCE) is None
+    cache.put(TOY_SOURCE, tree)
+    cached = cache.get(TOY_SOURCE)
+    assert cached == tree
+    assert token_positions(cached) == token_positions(tree)
+    assert cache.get(TOY_SOURCE + "\n") is None
+
+
+def test_parse_cache_put_is_best_effort(toy_grammar_file, tmp_path):
+    class Unpicklable(lark.Transformer):
+        def call_stmt(self, children):
+            return lambda: children
+
+    cache = fparser.ParseCache(str(tmp_path / "results"),
+                               grammar_file=toy_grammar_file)
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False,
+                                transformer=Unpicklable())
+    path = tmp_path / "toy.f90"
+    path.write_text(TOY_SOURCE)
+    result = fparser.parse_file(str(path), parser, cache)
+    assert result.ok
+    assert cache.get(TOY_SOURCE) is None
+    # Replacing an entry does not count its size twice
+    for value in ("x" * 1000, "y" * 1000, "z" * 10):
+        cache.put(TOY_SOURCE, value)
+    assert cache._size == sum(entry[2] for entry in cache._entries())
+
+
+def test_parse_cache_keyed_on_grammar_and_options(toy_grammar_file,
+                                                  tmp_path):
+    cache = fparser.ParseCache(str(tmp_path), grammar_file=toy_grammar_file)
+    cache.put(TOY_SOURCE, "result")
+    other_grammar = tmp_path / "other.lark"
+    other_grammar.write_text(TOY_GRAMMAR + "\n// A changed grammar\n")
+    other = fparser.ParseCache(str(tmp_path),
+                               grammar_file=str(other_grammar))
+    assert other.get(TOY_SOURCE) is None
+    options = fparser.ParseCache(str(tmp_path),
+                                 grammar_file=toy_grammar_file,
+                                 keep_all_tokens=True)
+    assert options.get(TOY_SOURCE) is None
+    same = fparser.ParseCache(str(tmp_path), grammar_file=toy_grammar_file,
+                              cache_dir="elsewhere")
+    assert same.get(TOY_SOURCE) == "result"
+
+
+def test_parse_cache_evicts_least_recently_used(toy_grammar_file,
+                                                tmp_path):
+    cache = fparser.ParseCache(str(tmp_path), max_size=10**6,
+                               grammar_file=toy_grammar_file)
+    sources = ["source {}".format(i) for i in range(5)]
+    for i, source in enumerate(sources):
+        cache.put(source, "x" * 1000)
+        path = cache._path(cache.key(source))
+        os.utime(path, (i, i))
+    assert cache.get(sources[0]) is not None
+    cache.max_size = 3500
+    cache.evict()
+    assert cache.get(sources[0]) is not None
+    assert cache.get(sources[1]) is None
+    assert cache.get(sources[2]) is None
+    assert cache.get(sources[4]) is not None
+
+
+def test_parse_project_with_cache(toy_grammar_file, tmp_path):
+    paths, bad = write_project(tmp_path)
+    kwargs = {"grammar_file": toy_grammar_file,
+              "cache_dir": str(tmp_path / "cache")}
+    cache = fparser.ParseCache(str(tmp_path / "results"), **kwargs)
+    first = {result.path: result for result in fparser.parse_project(
+        paths, jobs=2, cache=cache, **kwargs)}
+    for path in paths:
+        with open(path) as f:
+            source = f.read()
+        if path == bad:
+            assert cache.get(source) is None
+        else:
+            assert cache.get(source) == first[path].tree
+    second = {result.path: result for result in fparser.parse_project(
+        paths, jobs=1, cache=cache, **kwargs)}
+    assert all(second[path].tree == first[path].tree for path in paths)
+
+
+def test_parse_fixed_form(toy_grammar_file, tmp_path):
+    parser = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    tree = fparser.parse(TOY_FIXED_SOURCE, parser, fixed_form=True)
+    names = [(str(token), token.line, token.column, token.end_line,
+              token.end_column,
+              TOY_FIXED_SOURCE[token.start_pos:token.end_pos])
+             for token in tree.scan_values(lambda v: isinstance(v,
+                                                                lark.Token))
+             if token.type == "NAME"]
+    assert names == [("MAIN", 2, 15, 2, 19, "MAIN"),
+                     ("X", 3, 7, 3, 8, "X"),
+                     ("Y", 3, 23, 3, 24, "Y"),
+                     ("ZZ", 6, 11, 7, 8, "Z\n     2Z"),
+                     ("S", 8, 12, 8, 13, "S")]
+    with pytest.raises(lark.exceptions.UnexpectedInput) as info:
+        fparser.parse(TOY_FIXED_SOURCE.replace("CALL S(1)", "CALL S(1))"),
+                      parser, fixed_form=True)
+    assert (info.value.line, info.value.column) == (8, 16)
+
+    path = tmp_path / "main.f"
+    path.write_text(TOY_FIXED_SOURCE)
+    cache = fparser.ParseCache(str(tmp_path / "results"),
+                               grammar_file=toy_grammar_file)
+    result = fparser.parse_file(str(path), parser, cache)
+    assert result.tree == tree
+    assert cache.get(TOY_FIXED_SOURCE) is None
+    assert cache.get(TOY_FIXED_SOURCE, fixed_form=True) == tree
+
+
+def test_parse_joins_continuations(toy_grammar_file, tmp_path):
+    parser = fparser.get_parser(toy_grammar_file, cache_dir=str(tmp_path))
+    source = TOY_SOURCE.replace("call s(2)",
+                                "call s&\n  ! note\n  &s(2 + &\n 3)")
+    source = source.replace("subroutine s(x)", "subroutine ss(x)")
+    tree = fparser.parse(source, parser)
+    calls = list(tree.find_data("call_stmt"))
+    name = calls[-1].children[0]
+    assert str(name) == "ss"
+    assert (name.line, name.column, name.end_line, name.end_column) == \
+        (11, 8, 13, 5)
+    assert source[name.start_pos:name.end_pos] == "s&\n  ! note\n  &s"
+    three = calls[-1].children[1].children[1]
+    assert (str(three), three.line, three.column) == ("3", 14, 2)
+    with pytest.raises(lark.exceptions.UnexpectedInput) as info:
+        fparser.parse(source.replace(" 3)", " 3))"), parser)
+    assert (info.value.line, info.value.column) == (14, 4)
+
+
+def test_parse_joins_continuations_with_standalone_parser(
+        toy_grammar_file, standalone_parser):
+    parser = fparser.get_parser(toy_grammar_file, use_cache=False)
+    source = TOY_SOURCE.replace("call s(2)", "call s&\n  &s(2 + &\n 3)")
+    expected = token_positions(fparser.parse(source, parser))
+    assert token_positions(fparser.parse(source, standalone_parser)) == \
+        expected
+    assert ("3", 13, 2, 13, 3) in [position[:5] for position in expected]
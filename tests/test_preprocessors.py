@@ -0,0 +1,271 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+
+"""Tests for the preprocessor in fortify.preprocessors.
+
+"""
+
+import os
+import pickle
+
+import pytest
+
+from fortify.preprocessors import (IncludeCache, Preprocessor,
+                                   PreprocessorError, SourceFile)
+
+
+def preprocess(source, **kwargs):
+    """Returns the lines of the preprocessed `source`, without the
+    initial line marker.
+
+    """
+    return Preprocessor(**kwargs).preprocess(source).splitlines()[1:]
+
+
+def test_text_without_directives_is_unchanged():
+    source = "program p\n  x = 'a' ! y\nend program p\n"
+    assert Preprocessor().preprocess(source, "p.F90") == \
+        '# 1 "p.F90"\n' + source
+
+
+def test_macro_expansion():
+    assert preprocess("#define N 10\n"
+                      "#define MAX(a, b) ((a) > (b) ? (a) : (b))\n"
+                      "#define STR(x) #x\n"
+                      "#define CAT(a, b) a ## b\n"
+                      "#define LOG(fmt, ...) print fmt, __VA_ARGS__\n"
+                      "#define F MAX\n"
+                      "x = MAX(N, 2) ! N\n"
+                      "s = 'N' // STR(N \"q\")\n"
+                      "CAT(N, 1) = F(1, N) + N1 + 2N\n"
+                      "LOG(*, a, (b, c))\n") == \
+        ["", "", "", "", "", "",
+         "x = ((10) > (2) ? (10) : (2)) ! N",
+         "s = 'N' // \"N \\\"q\\\"\"",
+         "N1 = ((1) > (10) ? (1) : (10)) + N1 + 2N",
+         "print *, a, (b, c)"]
+
+
+def test_defines_between_lines():
+    source = "".join("#define M{0} {0}\nx = M{0} + M{1}\n#undef M{1}\n"
+                     .format(i, i - 1) for i in range(1, 50))
+    lines = preprocess(source)
+    assert lines[1] == "x = 1 + M0"
+    assert lines[-2] == "x = 49 + 48"
+
+
+def test_recursive_macros_are_not_reexpanded():
+    assert preprocess("#define x x + y\n#define y x\nx\n")[-1] == "x + x"
+
+
+def test_predefined_defines():
+    preprocessor = Preprocessor(defines={"DEBUG": "", "SQR(x)": "x*x"})
+    preprocessor.define("N", "3")
+    preprocessor.undefine("DEBUG")
+    assert preprocessor.preprocess("#ifdef DEBUG\nd\n#endif\nSQR(N)\n") \
+        .splitlines()[-1] == "3*3"
+
+
+@pytest.mark.parametrize("expression, value", [
+    ("1 + 2 * 3 == 7", 1), ("(1 + 2) * 3", 9), ("-7 / 2", -3),
+    ("-7 % 2", -1), ("0x10 << 2 | 1", 65), ("!defined(N) || N > 2", 1),
+    ("defined N && UNDEFINED == 0", 1), ("1 ? 2 : 3", 2),
+    ("0 && 1 / 0", 0), ("~0", -1), ("N >= 3 ? N * 2 : 0", 6),
+    ("1 << 63", -2**63), ("(1 << 62) * 4", 0),
+    ("0x7fffffffffffffff + 1", -2**63),
+    ("-(-9223372036854775807 - 1)", -2**63), ("-1 >> 63", -1),
+    ("0 && 1 << 64", 0)])
+def test_evaluate(expression, value):
+    preprocessor = Preprocessor(defines={"N": "3"})
+    preprocessor.macros = dict(preprocessor.defines)
+    assert preprocessor.evaluate(expression) == value
+
+
+def test_conditionals():
+    source = ("#define A 2\n"
+              "#if A == 1\none\n"
+              "#elif A == 2 /* comment */\ntwo\n"
+              "#  ifndef A\nnested\n#  endif\n"
+              "#else\nother\n"
+              "#endif\n"
+              "#if 0\n#error skipped\n#bogus\n#endif\n")
+    lines = preprocess(source)
+    assert len(lines) == source.count("\n")
+    assert [line for line in lines if line] == ["two"]
+
+
+def test_include_and_line(tmp_path):
+    (tmp_path / "inc").mkdir()
+    (tmp_path / "inc" / "consts.h").write_text(
+        "#ifndef CONSTS_H\n#define CONSTS_H\ninteger :: n = N\n#endif")
+    main = tmp_path / "main.F90"
+    main.write_text("#define N 4\n"
+                    "#include \"consts.h\"\n"
+                    "#include <consts.h>\n"
+                    "#line 20 \"gen.F90\"\n"
+                    "l = __LINE__; f = __FILE__\n")
+    inc = str(tmp_path / "inc" / "consts.h")
+    output = Preprocessor([str(tmp_path / "inc")]).preprocess_file(str(main))
+    assert output.splitlines() == [
+        '# 1 "{}"'.format(main), "",
+        '# 1 "{}" 1'.format(inc), "", "", "integer :: n = 4", "",
+        '# 3 "{}" 2'.format(main),
+        "",
+        '# 20 "gen.F90"',
+        'l = 20; f = "gen.F90"']
+
+
+def test_line_in_macros():
+    source = ("#define L __LINE__\n#define F(x) x __LINE__\n#if 1\n#endif\n"
+              "l = L\nm = F(__LINE__)\nn = F(L)\n")
+    assert preprocess(source)[4:] == ["l = 5", "m = 6 6", "n = 7 7"]
+
+
+def test_macro_calls_spanning_lines():
+    source = ("#define F(a) (a)\n#define G(a, b) a + b\n#define H(a) a a\n"
+              "y = F(1\n   ) + 1\nz = G(1, &\n  2) ! c, )\n"
+              "h = H(( &\n  1)) + F(2\n)\nl = __LINE__\n")
+    preprocessor = Preprocessor(line_markers=False)
+    lines = preprocessor.preprocess(source, "m.F90").splitlines()
+    assert lines[3:] == ["y = (1) + 1", "", "z = 1 + &", "  2 ! c, )",
+                         "h = ( &   1) ( &   1) + (2)", "", "", "l = 11"]
+    assert preprocessor.line_map.map_line(10) == [("m.F90", 10)]
+
+
+@pytest.mark.parametrize("source, message", [
+    ("#if 1\n", "<anonymous>:1: unterminated conditional directive"),
+    ("\n#endif\n", "<anonymous>:2: #endif without #if"),
+    ("#if 1\n#else\n#elif 1\n#endif\n", "<anonymous>:3: #elif after #else"),
+    ("#foo\n", "<anonymous>:1: invalid preprocessing directive #foo"),
+    ("#include \"missing.h\"\n", "missing.h: No such file or directory"),
+    ("#error stop here\n", "<anonymous>:1: #error stop here"),
+    ("#if 1 +\n#endif\n", "unexpected end of expression"),
+    ("\n#if 08\n#endif\n",
+     "<anonymous>:2: invalid integer constant '08' in expression"),
+    ("#define F(a) a\nF(1, 2)\n", "macro F takes 1 arguments but 2"),
+    ("#define F(a) a\n\nx = F(1,\n#if 1\n2)\n#endif\n",
+     "<anonymous>:3: unterminated argument list invoking macro F"),
+    ("#line 7\n#if 1 / 0\n#endif\n", "<anonymous>:7: division by zero"),
+    ("#if 1 << 100000000000\n#endif\n", "shift count 100000000000 out of"),
+    ("#if 1 >> -1\n#endif\n", "shift count -1 out of range")])
+def test_errors(source, message):
+    with pytest.raises(PreprocessorError) as info:
+        Preprocessor().preprocess(source)
+    assert message in str(info.value)
+
+
+@pytest.mark.parametrize("source, guard", [
+    ("#ifndef A_H\n#define A_H\nx\n#endif\n", "A_H"),
+    ("\n! comment\n#if !defined(A_H)\n#if B\n#endif\n#endif /* A_H */",
+     None),
+    ("\n#if !defined(A_H)\n#if B\n#else\n#endif\n#endif /* A_H */\n\n",
+     "A_H"),
+    ("#ifndef A_H\nx\n#else\ny\n#endif\n", None),
+    ("#ifndef A_H\nx\n#endif\ny\n", None),
+    ("#ifndef A_H\nx\n#endif\n#ifndef B_H\ny\n#endif\n", None),
+    ("#ifdef A_H\nx\n#endif\n", None)])
+def test_guard_macros(source, guard):
+    assert SourceFile("a.h", source).guard == guard
+
+
+def test_include_cache(tmp_path):
+    header = tmp_path / "a.h"
+    header.write_text("#ifndef A_H\n#define A_H\nx = N\n#endif\n")
+    main = "#define N 1\n#include \"a.h\"\n#include \"a.h\"\n"
+    path = str(tmp_path / "main.F90")
+    cache = IncludeCache(str(tmp_path / "cache"))
+    preprocessor = Preprocessor(include_cache=cache)
+    first = preprocessor.preprocess(main, path)
+    entry = cache.get(str(header))
+    assert entry.guard == "A_H"
+    assert preprocessor.preprocess(main, path) == first
+
+    # Another process would load the entry from disk
+    shared = pickle.loads(pickle.dumps(cache))
+    loaded = shared.get(str(header))
+    assert loaded is not entry
+    assert loaded.regions == entry.regions
+
+    header.write_text("y = N\n")
+    os.utime(str(header), ns=(entry.mtime + 10**9, entry.mtime + 10**9))
+    assert preprocessor.preprocess(main, path).count("y = 1") == 2
+    assert shared.get(str(header)).guard is None
+
+
+def test_include_cache_resolves_paths(tmp_path, monkeypatch):
+    (tmp_path / "inc").mkdir()
+    (tmp_path / "inc" / "a.h").write_text("x = 1\n")
+    os.symlink("inc", str(tmp_path / "link"))
+    monkeypatch.chdir(tmp_path)
+    cache = IncludeCache()
+    entry = cache.get("inc/a.h")
+    assert cache.get("./inc/a.h") is entry
+    assert cache.get(str(tmp_path / "link" / "a.h")) is entry
+
+
+def test_fortran_include(tmp_path):
+    (tmp_path / "mpif.h").write_text("integer, parameter :: n = N\n")
+    source = "#define N 3\n  INCLUDE 'mpif.h' ! MPI\nx = 1\n"
+    path = str(tmp_path / "main.F90")
+    assert Preprocessor().preprocess(source, path).splitlines()[2] == \
+        "  INCLUDE 'mpif.h' ! MPI"
+    assert Preprocessor(fortran_includes=True).preprocess(
+        source, path).splitlines() == [
+        '# 1 "{}"'.format(path), "",
+        '# 1 "{}" 1'.format(tmp_path / "mpif.h"),
+        "integer, parameter :: n = 3",
+        '# 3 "{}" 2'.format(path),
+        "x = 1"]
+
+
+@pytest.mark.parametrize("line_markers", [True, False])
+def test_line_map(tmp_path, line_markers):
+    (tmp_path / "a.h").write_text("#ifndef A_H\n#define A_H\na1\n#endif\n")
+    (tmp_path / "b.inc").write_text("b1\n#include \"a.h\"\nb3")
+    files = {str(tmp_path / "main.F90"): (
+        "m1\n#include \"a.h\"\n#include \\\n  \"b.inc\"\nm5\n"
+        "  include 'b.inc'\nm7\n#line 20 \"gen.F90\"\nm21\n")}
+    for name in ("a.h", "b.inc"):
+        files[str(tmp_path / name)] = (tmp_path / name).read_text()
+    files["gen.F90"] = "\n" * 19 + "m21\n"
+    preprocessor = Preprocessor(fortran_includes=True,
+                                line_markers=line_markers)
+    path = str(tmp_path / "main.F90")
+    output = preprocessor.preprocess(files[path], path)
+    lines = output.splitlines()
+    assert [line for line in lines if line and line[0] != "#"] == \
+        ["m1", "a1", "b1", "b3", "m5", "b1", "b3", "m7", "m21"]
+    assert any(line.startswith("#") for line in lines) == line_markers
+    assert preprocessor.line_map.line_count == len(lines)
+    other = Preprocessor(line_markers=line_markers)
+    for source in ("", "x", "x\n#define A\n", "x\n#if 0\ny\n#endif"):
+        output = other.preprocess(source)
+        assert other.line_map.line_count == len(output.splitlines())
+    for number, line in enumerate(lines, 1):
+        if line and line[0] != "#":
+            stack = preprocessor.line_map.map_line(number)
+            name, original = stack[-1]
+            assert files[name].splitlines()[original - 1] == line
+            for name, original in stack[:-1]:
+                assert "include" in files[name].splitlines()[original - 1]
+    assert preprocessor.line_map.map_line(lines.index("b3") + 1) == \
+        [(path, 3), (str(tmp_path / "b.inc"), 3)]
@@ -0,0 +1,92 @@
+#
+# Copyright 2019 Chris MacMackin <cmacmackin@gmail.com>
+#
+# This file is part of Fortify
+#
+# Fortify is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Fortify is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with Fortify.  If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+
+"""A small grammar for a Fortran-like language, along with sample source
+code, used to test the parser infrastructure.
+
+"""
+
+# The full Fortran grammar is expensive to analyse, so tests of the
+# parser infrastructure use this small grammar for a Fortran-like
+# language instead.
+TOY_GRAMMAR = r"""
+fortran_file : _NL* (_program_unit _NL+)*
+_program_unit : main_program | module | subroutine_subprogram
+              | function_subprogram
+main_program : program_stmt _NL+ _body end_program_stmt
+program_stmt : "program"i NAME
+end_program_stmt : "end"i ["program"i [NAME]]
+module : module_stmt _NL+ (_statement _NL+)* [_contains] end_module_stmt
+_contains : contains_stmt _NL+ (_subprogram _NL+)*
+module_stmt : "module"i NAME
+end_module_stmt : "end"i ["module"i [NAME]]
+contains_stmt : "contains"i
+_subprogram : subroutine_subprogram | function_subprogram
+subroutine_subprogram : subroutine_stmt _NL+ _body end_subroutine_stmt
+subroutine_stmt : "subroutine"i NAME ["(" [NAME ("," NAME)*] ")"]
+end_subroutine_stmt : "end"i ["subroutine"i [NAME]]
+function_subprogram : function_stmt _NL+ _body end_function_stmt
+function_stmt : "function"i NAME "(" [NAME ("," NAME)*] ")"
+end_function_stmt : "end"i ["function"i [NAME]]
+_body : (_statement _NL+)*
+_statement : call_stmt | assignment_stmt
+call_stmt : "call"i NAME ["(" [expr ("," expr)*] ")"]
+assignment_stmt : NAME "=" expr
+?expr : atom | expr "+" atom -> add
+?atom : NAME | INT | STRING
+
+STRING : /'[^'\n]*'/
+_NL : /(\r?\n|;)/
+COMMENT : /![^\n]*/
+
+%import common.CNAME -> NAME
+%import common.INT
+%ignore /[ \t]+/
+%ignore /&[ \t]*(![^\n]*)?\r?\n[ \t]*&?/
+%ignore COMMENT
+"""
+
+TOY_SOURCE = """! A small program
+module toy
+  a = 1
+contains
+  subroutine s(x)
+    call f(x + 1)
+  end subroutine s
+end module toy
+
+program main
+  call s(2)
+end program main
+"""
+
+# The toy program in fixed form, with a comment between an initial line
+# and its continuation, and a name split across lines
+TOY_FIXED_SOURCE = """C     A small program
+      PROGRAM MAIN
+      X = 'abc!def' + Y ! trailing
+     &  + 1
+c     inside
+     1  + Z
+     2Z
+      CALL S(1)                                                         ignored
+      END
+"""